@@ -0,0 +1,149 @@
+import os
+import json
+import time
+import argparse
+
+import png2png
+import json_codec
+
+# JSON 编解码微基准：对比原来的写法（标准库 json，每张图片重新序列化整个工作流，/prompt 响应解析两次）
+# 和 json_codec（orjson 或标准库）+ 请求体模板的耗时，默认使用生成的多 MB 大工作流，也可以指定真实的工作流文件
+
+def make_large_workflow(size_mb):
+    '''
+    生成一个序列化后约 size_mb MB 的图生图工作流：大量提示词编码、采样和 LoRA 节点，包含中文提示词和长列表
+    '''
+    workflow = {"1": {"class_type": "LoadImage", "inputs": {"image": "placeholder.png", "upload": "image"}}}
+    prompt_text = ("masterpiece, best quality, 高清细节, cinematic lighting, " * 20).strip()
+    target = size_mb * 1024 * 1024
+    size = 0
+    i = 0
+    while size < target:
+        base = 10 + i * 4
+        nodes = {
+            str(base): {"class_type": "CLIPTextEncode",
+                        "inputs": {"text": f"{prompt_text} #{i}", "clip": ["4", 1]}},
+            str(base + 1): {"class_type": "LoraLoader",
+                            "inputs": {"lora_name": f"style_{i % 50}.safetensors", "strength_model": 0.75,
+                                       "strength_clip": 1.0, "model": ["4", 0], "clip": ["4", 1]}},
+            str(base + 2): {"class_type": "KSampler",
+                            "inputs": {"seed": 1234567890123 + i, "steps": 30, "cfg": 7.5,
+                                       "sampler_name": "dpmpp_2m", "scheduler": "karras", "denoise": 0.55,
+                                       "model": [str(base + 1), 0], "positive": [str(base), 0],
+                                       "negative": ["7", 0], "latent_image": ["1", 0]}},
+            str(base + 3): {"class_type": "ControlNetApplyAdvanced",
+                            "inputs": {"strength": 0.8, "start_percent": 0.0, "end_percent": 1.0,
+                                       "weights": [round(0.01 * k, 2) for k in range(64)],
+                                       "positive": [str(base), 0], "negative": ["7", 0]}},
+        }
+        workflow.update(nodes)
+        size += len(json.dumps(nodes, ensure_ascii=False).encode("utf-8"))
+        i += 1
+    return workflow
+
+def measure(fn, number, repeat):
+    '''
+    执行 repeat 轮、每轮 number 次，返回最快一轮中每次的平均耗时（秒）
+    '''
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = (time.perf_counter() - start) / number
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def bench_workflow(path, workflow, images, repeat):
+    '''
+    对一个工作流执行全部场景，返回 [(场景, 原写法耗时, {实现: 耗时})]
+    '''
+    image_node_id = png2png.find_image_input_node(workflow)
+    names = [f"upload_{i:05d}.png" for i in range(images)]
+    prompt_response = json.dumps({"prompt_id": "0f6a3c1e-5d4b-4a8e-9f1e-2b7c9d0a1b2c", "number": 17,
+                                  "node_errors": {}}).encode("utf-8")
+    results = []
+
+    # 读取工作流
+    def old_load():
+        with open(path, "r", encoding="utf-8") as f:
+            json.loads(f.read())
+    new = {}
+    for name in json_codec.BACKENDS:
+        json_codec.use_backend(name)
+        new[name] = measure(lambda: json_codec.load(path), 1, repeat)
+    results.append(("读取工作流", measure(old_load, 1, repeat), new))
+
+    if image_node_id is not None:
+        # 提交请求体：每张图片一次，模板的建立耗时也计入（每轮重新建立）
+        def old_bodies():
+            for server_image in names:
+                prompt = png2png.patch_image_input(workflow, image_node_id, server_image)
+                json.dumps({"prompt": prompt, "client_id": png2png.client_id}).encode("utf-8")
+        def new_bodies():
+            png2png._prompt_templates.clear()
+            for server_image in names:
+                png2png.prompt_body(workflow, image_node_id, server_image)
+        new = {}
+        for name in json_codec.BACKENDS:
+            json_codec.use_backend(name)
+            # 正确性检查：与原写法提交的内容相同
+            png2png._prompt_templates.clear()
+            expected = {"prompt": png2png.patch_image_input(workflow, image_node_id, names[0]),
+                        "client_id": png2png.client_id}
+            if json.loads(png2png.prompt_body(workflow, image_node_id, names[0])) != expected:
+                raise AssertionError(f"{name}: 模板生成的请求体与原写法不一致")
+            new[name] = measure(new_bodies, 1, repeat) / images
+        results.append((f"请求体（每张图片，共 {images} 张）", measure(old_bodies, 1, repeat) / images, new))
+
+    # /prompt 响应：原来解析两次
+    def old_response():
+        json.loads(prompt_response)
+        json.loads(prompt_response)
+    new = {}
+    for name in json_codec.BACKENDS:
+        json_codec.use_backend(name)
+        new[name] = measure(lambda: json_codec.loads(prompt_response), 1000, repeat)
+    results.append(("/prompt 响应解析", measure(old_response, 1000, repeat), new))
+    return results
+
+def print_results(label, size, results):
+    backends = list(json_codec.BACKENDS)
+    print(f"\n📄 {label}（{size / 1024 / 1024:.1f} MB）")
+    header = f"{'场景':<28}{'原写法':>12}" + "".join(f"{name:>12}{'加速':>8}" for name in backends)
+    print(header)
+    for scenario, old, new in results:
+        line = f"{scenario:<28}{old * 1000:>10.3f}ms"
+        for name in backends:
+            line += f"{new[name] * 1000:>10.3f}ms{old / new[name]:>7.1f}x"
+        print(line)
+
+# ============ 主程序入口 ============
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="JSON 编解码微基准：原写法 vs json_codec + 请求体模板")
+    parser.add_argument("--workflow", action="append", default=[], help="使用真实的工作流文件，可重复指定")
+    parser.add_argument("--size-mb", type=float, default=4, help="没有指定 --workflow 时生成的工作流大小（MB）")
+    parser.add_argument("--images", type=int, default=100, help="请求体场景中每个工作流处理的图片数")
+    parser.add_argument("--repeat", type=int, default=5, help="每个场景重复的轮数，取最快一轮")
+    args = parser.parse_args()
+
+    print(f"可用实现: {', '.join(json_codec.BACKENDS)}（默认 {json_codec.backend}）")
+    default_backend = json_codec.backend
+    generated = None
+    paths = args.workflow
+    if not paths:
+        generated = f"bench_workflow_{args.size_mb:g}mb.json"
+        with open(generated, "w", encoding="utf-8") as f:
+            json.dump(make_large_workflow(args.size_mb), f, ensure_ascii=False)
+        paths = [generated]
+    try:
+        for path in paths:
+            with open(path, "r", encoding="utf-8") as f:
+                workflow = json.load(f)
+            results = bench_workflow(path, workflow, args.images, args.repeat)
+            print_results(os.path.basename(path), os.path.getsize(path), results)
+    finally:
+        json_codec.use_backend(default_backend)
+        if generated:
+            os.remove(generated)
@@ -0,0 +1,238 @@
+import os
+import io
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import contextlib
+
+import png2png
+from comfy_mock_server import MockComfyServer, PNG_HEADER
+
+# png2png 端到端压测：启动本地模拟的 ComfyUI 服务器，跑一遍图生图流程，
+# 统计 张/秒、延迟分位数和网络传输字节数，结果可保存为 JSON 并与之前的结果对比
+
+# 压测用的最小图生图工作流
+BENCH_WORKFLOW = {
+    "1": {"class_type": "LoadImage", "inputs": {"image": "placeholder.png"}},
+    "2": {"class_type": "ImageScale", "inputs": {"image": ["1", 0], "width": 512, "height": 512,
+                                                   "upscale_method": "bilinear", "crop": "disabled"}},
+    "9": {"class_type": "SaveImage", "inputs": {"images": ["2", 0], "filename_prefix": "bench"}},
+}
+
+# 对比时关注的指标，以及数值越大越好还是越小越好
+COMPARE_KEYS = (
+    ("images_per_sec", "higher"),
+    ("p50", "lower"),
+    ("p95", "lower"),
+    ("p99", "lower"),
+    ("bytes_up", "lower"),
+    ("bytes_down", "lower"),
+    ("requests", "lower"),
+    ("failed", "lower"),
+    ("model_loads", "lower"),
+)
+
+def bench_workflows(count, models):
+    '''
+    生成 count 个压测工作流，依次轮流使用 models 个不同的模型（按文件名执行时每个工作流都要换模型）
+    '''
+    workflows = []
+    for w in range(count):
+        workflow = dict(BENCH_WORKFLOW)
+        if models:
+            workflow["4"] = {"class_type": "CheckpointLoaderSimple",
+                             "inputs": {"ckpt_name": f"model_{w % models}.safetensors"}}
+        workflows.append((f"bench_{w:03d}.json", workflow))
+    return workflows
+
+def make_images(folder, count, size):
+    '''
+    生成 count 张内容各不相同的假图片
+    '''
+    os.makedirs(folder, exist_ok=True)
+    for i in range(count):
+        with open(os.path.join(folder, f"bench_{i:05d}.png"), "wb") as f:
+            f.write(PNG_HEADER + i.to_bytes(4, "big") + os.urandom(max(0, size - len(PNG_HEADER) - 4)))
+
+def make_real_images(folder, count, dims):
+    '''
+    用 Pillow 生成 count 张能正常解码的 PNG（渐变加噪点，压缩率接近照片），用于测试上传前预处理
+    '''
+    os.makedirs(folder, exist_ok=True)
+    width, height = dims
+    for i in range(count):
+        gradient = png2png.Image.linear_gradient("L").resize((width, height))
+        noise = png2png.Image.effect_noise((width, height), 10 + i % 20)
+        img = png2png.Image.merge("RGB", (gradient, noise, gradient.rotate(90 + i)))
+        img.save(os.path.join(folder, f"bench_{i:05d}.png"))
+
+def configure_png2png(host_urls, args, work_dir):
+    '''
+    重置 png2png 的全局状态，让每次压测互不影响
+    '''
+    png2png.url = host_urls[0]
+    png2png.hosts = list(host_urls)
+    png2png.host_pool = png2png.HostPool(host_urls)
+    png2png.http_pool = png2png.HttpSessionPool(
+        max(png2png.http_pool_size, args.max_inflight + args.upload_workers + args.download_workers))
+    png2png.completion_mode = args.completion
+    png2png.prompt_timeout = args.prompt_timeout
+    png2png.comfy_local_dirs = ({u: os.path.join(work_dir, f"comfy_{i}") for i, u in enumerate(host_urls)}
+                                if args.shared_fs else {})
+    png2png.upload_cache = (png2png.UploadCache(os.path.join(work_dir, "upload_cache.json"))
+                            if args.upload_cache else None)
+    png2png.result_cache = (png2png.ResultCache(os.path.join(work_dir, "result_cache"))
+                            if args.result_cache else None)
+    png2png.metrics = png2png.RunMetrics()
+    png2png.preprocess_format = args.preprocess
+    png2png.preprocess_cache_dir = os.path.join(work_dir, "preprocess_cache")
+    png2png.preprocess_stats.update(images=0, cache_hits=0, bytes_in=0, bytes_out=0)
+    png2png._prepared_paths.clear()
+    png2png.input_manifest_file = os.path.join(work_dir, "input_manifest.json")
+    png2png._manifests.clear()
+    png2png.log_sink = png2png.RunLogSink()
+
+def run_benchmark(args):
+    '''
+    执行一次压测，返回结果字典
+    '''
+    latencies = [float(x) for x in args.latency.split(",")]
+    work_dir = tempfile.mkdtemp(prefix="bench_png2png_")
+    servers = [
+        MockComfyServer(latency=latency, jitter=args.jitter, failure_rate=args.failure_rate,
+                        output_size=args.output_size, images_per_output=args.images_per_output,
+                        prompt_overhead=args.prompt_overhead, hang_rate=args.hang_rate, seed=i,
+                        model_load_time=args.model_load_time,
+                        root_dir=os.path.join(work_dir, f"comfy_{i}") if args.shared_fs else None).start()
+        for i, latency in enumerate(latencies)
+    ]
+    try:
+        read_folder = os.path.join(work_dir, "pic")
+        if args.preprocess or args.image_dims:
+            dims = args.image_dims or "2048x2048"
+            make_real_images(read_folder, args.images, [int(x) for x in dims.split("x")])
+        else:
+            make_images(read_folder, args.images, args.input_size)
+        configure_png2png([s.url for s in servers], args, work_dir)
+
+        quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+        start = time.time()
+        with quiet:
+            workflows = bench_workflows(args.workflows, args.models)
+            if args.order == "model":
+                order = png2png.order_by_model(workflows)[0]
+                workflows = sorted(workflows, key=lambda item: order.index(item[0]))
+            for name, workflow in workflows:
+                write_folder = os.path.join(work_dir, "out", name[:-5])
+                os.makedirs(write_folder, exist_ok=True)
+                png2png.process_image_to_image_workflow(
+                    workflow, "1", read_folder, write_folder,
+                    os.path.join(work_dir, name + ".csv"),
+                    max_inflight=args.max_inflight, workflow_name=name,
+                    pipeline=args.pipeline, upload_workers=args.upload_workers,
+                    download_workers=args.download_workers, batch_size=args.batch_size
+                )
+        elapsed = time.time() - start
+        png2png.log_sink.close()
+
+        totals = {}
+        for server in servers:
+            for key, value in server.stats.items():
+                totals[key] = totals.get(key, 0) + value
+        histogram = png2png.metrics.histogram("total")
+        done = png2png.metrics.success + png2png.metrics.failed
+        return {
+            "config": {k: v for k, v in vars(args).items() if k not in ("save", "compare", "verbose")},
+            "images": done,
+            "elapsed": elapsed,
+            "images_per_sec": done / elapsed if elapsed > 0 else 0.0,
+            "p50": histogram.percentile(50),
+            "p95": histogram.percentile(95),
+            "p99": histogram.percentile(99),
+            "bytes_up": totals["upload_bytes"],
+            "bytes_down": totals["download_bytes"],
+            "uploads": totals["uploads"],
+            "requests": png2png.http_pool.stats()["requests"],
+            "failed": png2png.metrics.failed,
+            "model_loads": totals["model_loads"],
+            "result_cache_hits": png2png.result_cache.hits if png2png.result_cache else 0,
+        }
+    finally:
+        png2png.close_completion_watchers()
+        for server in servers:
+            server.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def print_result(result):
+    print(f"图片数: {result['images']}  耗时: {result['elapsed']:.2f}s  吞吐: {result['images_per_sec']:.2f} 张/秒")
+    if result["p50"] is not None:
+        print(f"单张总耗时 p50={result['p50']:.3f}s p95={result['p95']:.3f}s p99={result['p99']:.3f}s")
+    print(f"上传 {result['uploads']} 次 / {result['bytes_up'] / 1e6:.1f} MB，"
+          f"下载 {result['bytes_down'] / 1e6:.1f} MB，HTTP 请求 {result['requests']} 次，失败 {result['failed']}，"
+          f"模型加载 {result['model_loads']} 次，结果缓存命中 {result.get('result_cache_hits', 0)} 次")
+
+def compare_results(result, baseline):
+    '''
+    打印与基准结果的对比，返回 {指标: 变化百分比}
+    '''
+    changes = {}
+    print(f"\n{'指标':<16}{'基准':>14}{'本次':>14}{'变化':>10}")
+    for key, better in COMPARE_KEYS:
+        old, new = baseline.get(key), result.get(key)
+        if old is None or new is None:
+            continue
+        change = (new - old) / old * 100 if old else 0.0
+        changes[key] = change
+        good = (change > 0) == (better == "higher") or change == 0
+        print(f"{key:<16}{old:>14.3f}{new:>14.3f}{change:>+9.1f}% {'✅' if good else '⚠️'}")
+    return changes
+
+# ============ 主程序入口 ============
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="png2png 端到端压测（使用本地模拟的 ComfyUI 服务器）")
+    parser.add_argument("--images", type=int, default=50, help="输入图片数量")
+    parser.add_argument("--workflows", type=int, default=1, help="对同一批图片执行的工作流数量")
+    parser.add_argument("--input-size", type=int, default=500_000, help="每张输入图片的字节数")
+    parser.add_argument("--output-size", type=int, default=200_000, help="每张输出图片的字节数")
+    parser.add_argument("--images-per-output", type=int, default=1, help="每个任务输出的图片数")
+    parser.add_argument("--shared-fs", action="store_true", help="模拟与服务器共享文件系统，结果图片本地复制")
+    parser.add_argument("--latency", default="0.2",
+                        help="每台模拟服务器的生成耗时，逗号分隔多个值表示多台服务器")
+    parser.add_argument("--prompt-overhead", type=float, default=0.0, help="模拟服务器每个任务固定的额外耗时（秒）")
+    parser.add_argument("--models", type=int, default=0, help="工作流轮流使用的模型数，0 表示工作流不加载模型")
+    parser.add_argument("--model-load-time", type=float, default=0.0, help="模拟服务器加载一个模型的耗时（秒）")
+    parser.add_argument("--order", choices=("model", "name"), default="name", help="工作流执行顺序")
+    parser.add_argument("--jitter", type=float, default=0.0, help="生成耗时的随机波动比例")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="任务失败概率")
+    parser.add_argument("--hang-rate", type=float, default=0.0, help="任务卡住（直到被中断）的概率")
+    parser.add_argument("--prompt-timeout", type=float, default=png2png.prompt_timeout, help="单个任务最长等待时间（秒）")
+    parser.add_argument("--max-inflight", type=int, default=1, help="同时在途的最大任务数")
+    parser.add_argument("--batch-size", type=int, default=1, help="每个任务合并的图片数")
+    parser.add_argument("--pipeline", action="store_true", help="使用分阶段流水线")
+    parser.add_argument("--upload-workers", type=int, default=2, help="流水线上传阶段的线程数")
+    parser.add_argument("--download-workers", type=int, default=2, help="流水线下载阶段的线程数")
+    parser.add_argument("--completion", choices=("auto", "ws", "poll"), default="auto")
+    parser.add_argument("--upload-cache", action="store_true", help="启用上传缓存")
+    parser.add_argument("--result-cache", action="store_true",
+                        help="启用生成结果缓存（--models 0 时各个工作流相同，第二个起全部命中）")
+    parser.add_argument("--preprocess", choices=("webp", "jpeg", "png"), default=None,
+                        help="上传前缩小并转码（会改为生成真实的 PNG 图片，需要 Pillow）")
+    parser.add_argument("--image-dims", default=None, metavar="WxH",
+                        help="生成该尺寸的真实 PNG 图片代替随机字节（--preprocess 时默认 2048x2048）")
+    parser.add_argument("--save", help="把结果保存为 JSON 文件")
+    parser.add_argument("--compare", help="与之前保存的 JSON 结果对比")
+    parser.add_argument("--verbose", action="store_true", help="显示 png2png 的原始输出")
+    args = parser.parse_args()
+
+    result = run_benchmark(args)
+    print_result(result)
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"💾 结果已保存: {args.save}")
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            compare_results(result, json.load(f))
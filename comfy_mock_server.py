@@ -0,0 +1,427 @@
+import os
+import json
+import time
+import uuid
+import base64
+import struct
+import socket
+import random
+import hashlib
+import argparse
+import threading
+import email.parser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+# 本地模拟的 ComfyUI 服务器，用于在没有 GPU 服务器时测试和压测 png2png.py
+# 实现了 /upload/image、/prompt、/history、/view、/queue、/interrupt 和 /ws
+# 生成耗时、失败率、输出图片大小都可以配置
+
+WS_MAGIC = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+PNG_HEADER = b"\x89PNG\r\n\x1a\n"
+OUTPUT_NODE_TYPES = ("SaveImage", "PreviewImage")
+# 这些输入表示要加载的模型；和 ComfyUI 一样只保留上一个任务加载的模型
+MODEL_INPUT_KEYS = ("ckpt_name", "unet_name", "lora_name", "control_net_name", "vae_name", "preprocessor")
+
+class MockComfyServer:
+    '''
+    模拟的 ComfyUI 服务器
+
+    参数:
+        latency: 每张图片的平均生成耗时（秒），任务中有多个图片输入节点时按数量累加
+        prompt_overhead: 每个任务固定的额外耗时（秒），模拟服务器调度、校验等开销
+        jitter: 生成耗时的随机波动比例（0.2 表示 ±20%）
+        failure_rate: 任务执行失败的概率
+        hang_rate: 任务卡住的概率，卡住的任务一直占用 GPU，直到被 /interrupt 中断
+        output_size: 每张输出图片的字节数
+        images_per_output: 每个输出节点生成的图片数量
+        gpu_workers: 同时执行的任务数（真实的 ComfyUI 为 1）
+        model_load_time: 加载一个模型的耗时（秒），任务用到的模型与上一个任务不同时累加
+        root_dir: 模拟的 ComfyUI 根目录，设置后输出图片同时写入 <root_dir>/output，用于测试共享文件系统模式
+    '''
+    def __init__(self, host="127.0.0.1", port=0, latency=0.5, jitter=0.0, failure_rate=0.0,
+                 output_size=200_000, images_per_output=1, gpu_workers=1, seed=None, prompt_overhead=0.0,
+                 hang_rate=0.0, root_dir=None, model_load_time=0.0):
+        self.latency = latency
+        self.prompt_overhead = prompt_overhead
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.hang_rate = hang_rate
+        self.root_dir = root_dir
+        self.model_load_time = model_load_time
+        self.loaded_models = frozenset()
+        self.output_size = output_size
+        self.images_per_output = images_per_output
+        self.random = random.Random(seed)
+
+        self.lock = threading.Lock()
+        self.inputs = {}   # "subfolder/name" -> bytes
+        self.outputs = {}  # "subfolder/name" -> bytes
+        self.history = {}  # prompt_id -> 历史记录
+        self.pending = []  # [(number, prompt_id, prompt, client_id)]
+        self.running = {}  # prompt_id -> (number, prompt, client_id)
+        self.interrupted = set()
+        self.ws_clients = {}  # client_id -> socket
+        self.ws_lock = threading.Lock()
+        self.ws_refused = False  # drop_websockets(refuse=True) 之后拒绝新的 websocket 连接
+        self.connections = set()  # 活动的客户端连接，stop() 时全部断开，模拟服务器宕机
+        self.work_ready = threading.Condition(self.lock)
+        self.number = 0
+        self.stats = {"uploads": 0, "upload_bytes": 0, "prompts": 0, "downloads": 0,
+                      "download_bytes": 0, "history_requests": 0, "failed": 0,
+                      "model_loads": 0}
+
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self.httpd.daemon_threads = True
+        self.url = f"http://{host}:{self.httpd.server_address[1]}"
+        self._stopped = False
+        self._threads = [threading.Thread(target=self.httpd.serve_forever, daemon=True)]
+        self._threads += [threading.Thread(target=self._gpu_loop, daemon=True) for _ in range(gpu_workers)]
+
+    # ============ 启动/停止 ============
+
+    def start(self):
+        for t in self._threads:
+            t.start()
+        return self
+
+    def stop(self):
+        self._stopped = True
+        with self.lock:
+            self.work_ready.notify_all()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        for sock in list(self.connections):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def drop_websockets(self, refuse=True):
+        '''
+        断开全部 websocket 连接（HTTP 接口照常工作），模拟运行中途 websocket 断开；
+        refuse 为 True 时之后的 /ws 请求都返回 404，客户端只能退回轮询
+        '''
+        self.ws_refused = refuse
+        with self.ws_lock:
+            sockets = list(self.ws_clients.values())
+            self.ws_clients.clear()
+        for sock in sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # ============ 模拟 GPU 执行 ============
+
+    def _gpu_loop(self):
+        while True:
+            with self.lock:
+                while not self.pending and not self._stopped:
+                    self.work_ready.wait()
+                if self._stopped:
+                    return
+                number, pid, prompt, cid = self.pending.pop(0)
+                self.running[pid] = (number, prompt, cid)
+            self._execute(number, pid, prompt, cid)
+
+    def _execute(self, number, pid, prompt, cid):
+        start = time.time()
+        messages = [["execution_start", {"prompt_id": pid, "timestamp": int(start * 1000)}]]
+        self._send_ws(cid, {"type": "execution_start", "data": {"prompt_id": pid, "timestamp": int(start * 1000)}})
+
+        image_count = sum(1 for n in prompt.values()
+                          if isinstance(n, dict) and "LoadImage" in n.get("class_type", ""))
+        duration = self.prompt_overhead + self.latency * max(1, image_count) * (
+            1 + self.random.uniform(-self.jitter, self.jitter))
+        models = frozenset((key, value) for n in prompt.values() if isinstance(n, dict)
+                           for key, value in n.get("inputs", {}).items()
+                           if key in MODEL_INPUT_KEYS and isinstance(value, str))
+        with self.lock:
+            new_models = len(models - self.loaded_models)
+            self.loaded_models = models
+            self.stats["model_loads"] += new_models
+        duration += self.model_load_time * new_models
+        deadline = start + max(0.0, duration)
+        if self.random.random() < self.hang_rate:
+            deadline = float("inf")
+        while time.time() < deadline and pid not in self.interrupted and not self._stopped:
+            time.sleep(min(0.01, max(0.0, deadline - time.time())))
+
+        outputs = {}
+        if pid in self.interrupted:
+            status = "error"
+            event = {"type": "execution_interrupted", "data": {"prompt_id": pid}}
+            messages.append(["execution_interrupted", {"prompt_id": pid, "timestamp": int(time.time() * 1000)}])
+        elif self.random.random() < self.failure_rate:
+            status = "error"
+            event = {"type": "execution_error", "data": {"prompt_id": pid, "exception_message": "mock failure"}}
+            messages.append(["execution_error", {"prompt_id": pid, "node_type": "MockNode",
+                                                 "exception_message": "mock failure",
+                                                 "timestamp": int(time.time() * 1000)}])
+        else:
+            status = "success"
+            event = {"type": "execution_success", "data": {"prompt_id": pid}}
+            outputs = self._make_outputs(pid, prompt)
+            messages.append(["execution_success", {"prompt_id": pid, "timestamp": int(time.time() * 1000)}])
+
+        with self.lock:
+            self.running.pop(pid, None)
+            self.interrupted.discard(pid)
+            if status != "success":
+                self.stats["failed"] += 1
+            self.history[pid] = {
+                "prompt": [number, pid, prompt, {}, []],
+                "outputs": outputs,
+                "status": {"status_str": status, "completed": status == "success", "messages": messages},
+            }
+        self._send_ws(cid, event)
+        self._send_ws(cid, {"type": "executing", "data": {"node": None, "prompt_id": pid}})
+
+    def _make_outputs(self, pid, prompt):
+        outputs = {}
+        for node_id, node in prompt.items():
+            if not isinstance(node, dict) or node.get("class_type") not in OUTPUT_NODE_TYPES:
+                continue
+            images = []
+            for i in range(self.images_per_output):
+                filename = f"mock_{pid[:8]}_{node_id}_{i:05d}_.png"
+                body = PNG_HEADER + os.urandom(max(0, self.output_size - len(PNG_HEADER)))
+                with self.lock:
+                    self.outputs[filename] = body
+                if self.root_dir:
+                    os.makedirs(os.path.join(self.root_dir, "output"), exist_ok=True)
+                    with open(os.path.join(self.root_dir, "output", filename), "wb") as f:
+                        f.write(body)
+                images.append({"filename": filename, "subfolder": "", "type": "output"})
+            outputs[node_id] = {"images": images}
+        return outputs
+
+    def submit(self, prompt, cid=None):
+        '''
+        校验并加入队列，返回 (HTTP 状态码, 响应)
+        '''
+        for node_id, node in prompt.items():
+            if isinstance(node, dict) and "LoadImage" in node.get("class_type", ""):
+                image = node.get("inputs", {}).get("image")
+                if image not in self.inputs:
+                    return 400, {"error": {"type": "prompt_outputs_failed_validation",
+                                           "message": f"Invalid image file: {image}"},
+                                 "node_errors": {node_id: {"errors": [{"message": "Invalid image file"}]}}}
+        if not any(isinstance(n, dict) and n.get("class_type") in OUTPUT_NODE_TYPES for n in prompt.values()):
+            return 400, {"error": {"type": "prompt_no_outputs", "message": "Prompt has no outputs"}, "node_errors": {}}
+        pid = str(uuid.uuid4())
+        with self.lock:
+            self.number += 1
+            self.pending.append((self.number, pid, prompt, cid))
+            self.stats["prompts"] += 1
+            self.work_ready.notify()
+            number = self.number
+        return 200, {"prompt_id": pid, "number": number, "node_errors": {}}
+
+    # ============ websocket ============
+
+    def _send_ws(self, cid, message):
+        sock = self.ws_clients.get(cid)
+        if sock is None:
+            return
+        payload = json.dumps(message).encode("utf-8")
+        if len(payload) < 126:
+            header = struct.pack("!BB", 0x81, len(payload))
+        elif len(payload) < 65536:
+            header = struct.pack("!BBH", 0x81, 126, len(payload))
+        else:
+            header = struct.pack("!BBQ", 0x81, 127, len(payload))
+        try:
+            with self.ws_lock:
+                sock.sendall(header + payload)
+        except OSError:
+            self.ws_clients.pop(cid, None)
+
+    # ============ HTTP ============
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True  # 响应头和响应体分两次发送，不关 Nagle 每个请求会多等 40ms
+
+            def log_message(self, *args):
+                pass
+
+            def setup(self):
+                super().setup()
+                server.connections.add(self.connection)
+
+            def finish(self):
+                server.connections.discard(self.connection)
+                super().finish()
+
+            def _send(self, status, body, content_type="application/json"):
+                if not isinstance(body, bytes):
+                    body = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _body(self):
+                length = int(self.headers.get("Content-Length", 0))
+                return self.rfile.read(length) if length else b""
+
+            def do_GET(self):
+                parsed = urlparse(self.path)
+                query = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+                if parsed.path == "/ws":
+                    if server.ws_refused:
+                        return self._send(404, {"error": "websocket disabled"})
+                    return self._websocket(query.get("clientId"))
+                if parsed.path.startswith("/history"):
+                    pid = parsed.path[len("/history/"):]
+                    with server.lock:
+                        server.stats["history_requests"] += 1
+                        if pid:
+                            return self._send(200, {pid: server.history[pid]} if pid in server.history else {})
+                        return self._send(200, dict(server.history))
+                if parsed.path == "/view":
+                    name = query.get("filename", "")
+                    if query.get("subfolder"):
+                        name = query["subfolder"] + "/" + name
+                    store = server.inputs if query.get("type") == "input" else server.outputs
+                    with server.lock:
+                        body = store.get(name)
+                        if body is not None:
+                            server.stats["downloads"] += 1
+                            server.stats["download_bytes"] += len(body)
+                    if body is None:
+                        return self._send(404, {"error": "not found"})
+                    return self._send(200, body, "image/png")
+                if parsed.path == "/queue":
+                    with server.lock:
+                        running = [[n, pid, p, {}, []] for pid, (n, p, _) in server.running.items()]
+                        pending = [[n, pid, p, {}, []] for n, pid, p, _ in server.pending]
+                    return self._send(200, {"queue_running": running, "queue_pending": pending})
+                if parsed.path == "/system_stats":
+                    return self._send(200, {"system": {"os": "mock"}, "devices": []})
+                if parsed.path == "/mock/stats":
+                    with server.lock:
+                        return self._send(200, dict(server.stats))
+                self._send(404, {"error": "not found"})
+
+            def do_POST(self):
+                parsed = urlparse(self.path)
+                body = self._body()
+                if parsed.path == "/upload/image":
+                    return self._upload(body)
+                if parsed.path == "/prompt":
+                    data = json.loads(body or b"{}")
+                    status, response = server.submit(data.get("prompt", {}), data.get("client_id"))
+                    return self._send(status, response)
+                if parsed.path == "/queue":
+                    data = json.loads(body or b"{}")
+                    with server.lock:
+                        if data.get("clear"):
+                            server.pending.clear()
+                        delete = set(data.get("delete", []))
+                        server.pending = [item for item in server.pending if item[1] not in delete]
+                    return self._send(200, {})
+                if parsed.path == "/interrupt":
+                    data = json.loads(body or b"{}")
+                    with server.lock:
+                        targets = [data["prompt_id"]] if data.get("prompt_id") else list(server.running)
+                        server.interrupted.update(pid for pid in targets if pid in server.running)
+                    return self._send(200, {})
+                self._send(404, {"error": "not found"})
+
+            def _upload(self, body):
+                message = email.parser.BytesParser().parsebytes(
+                    b"Content-Type: " + self.headers["Content-Type"].encode() + b"\r\n\r\n" + body
+                )
+                fields, image, filename = {}, None, None
+                for part in message.get_payload():
+                    name = part.get_param("name", header="content-disposition")
+                    if name == "image":
+                        image = part.get_payload(decode=True)
+                        filename = part.get_filename() or "image.png"
+                    else:
+                        fields[name] = part.get_payload(decode=True).decode()
+                if image is None:
+                    return self._send(400, {"error": "no image"})
+                subfolder = fields.get("subfolder", "")
+                filename = os.path.basename(filename)
+                with server.lock:
+                    key = f"{subfolder}/{filename}" if subfolder else filename
+                    if fields.get("overwrite") != "true":
+                        base, ext = os.path.splitext(filename)
+                        counter = 1
+                        while key in server.inputs and server.inputs[key] != image:
+                            filename = f"{base} ({counter}){ext}"
+                            key = f"{subfolder}/{filename}" if subfolder else filename
+                            counter += 1
+                    server.inputs[key] = image
+                    server.stats["uploads"] += 1
+                    server.stats["upload_bytes"] += len(image)
+                self._send(200, {"name": filename, "subfolder": subfolder, "type": "input"})
+
+            def _websocket(self, cid):
+                key = self.headers.get("Sec-WebSocket-Key", "")
+                accept = base64.b64encode(hashlib.sha1((key + WS_MAGIC).encode()).digest()).decode()
+                self.send_response(101)
+                self.send_header("Upgrade", "websocket")
+                self.send_header("Connection", "Upgrade")
+                self.send_header("Sec-WebSocket-Accept", accept)
+                self.end_headers()
+                self.wfile.flush()
+                cid = cid or str(uuid.uuid4())
+                server.ws_clients[cid] = self.connection
+                server._send_ws(cid, {"type": "status", "data": {"sid": cid}})
+                try:
+                    # 客户端发来的帧（包括关闭帧）都忽略，连接断开时退出
+                    while self.connection.recv(4096):
+                        pass
+                except OSError:
+                    pass
+                finally:
+                    if server.ws_clients.get(cid) is self.connection:
+                        server.ws_clients.pop(cid, None)
+                self.close_connection = True
+
+        return Handler
+
+# ============ 主程序入口 ============
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="本地模拟的 ComfyUI 服务器")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8188)
+    parser.add_argument("--latency", type=float, default=0.5, help="每张图片的生成耗时（秒）")
+    parser.add_argument("--jitter", type=float, default=0.0, help="生成耗时的随机波动比例")
+    parser.add_argument("--prompt-overhead", type=float, default=0.0, help="每个任务固定的额外耗时（秒）")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="任务失败概率")
+    parser.add_argument("--hang-rate", type=float, default=0.0, help="任务卡住（直到被中断）的概率")
+    parser.add_argument("--output-size", type=int, default=200_000, help="每张输出图片的字节数")
+    parser.add_argument("--images-per-output", type=int, default=1, help="每个输出节点生成的图片数")
+    parser.add_argument("--gpu-workers", type=int, default=1, help="同时执行的任务数")
+    parser.add_argument("--model-load-time", type=float, default=0.0, help="加载一个模型的耗时（秒）")
+    parser.add_argument("--root-dir", default=None, help="把输出图片同时写入 <目录>/output")
+    args = parser.parse_args()
+
+    server = MockComfyServer(args.host, args.port, args.latency, args.jitter, args.failure_rate,
+                             args.output_size, args.images_per_output, args.gpu_workers,
+                             prompt_overhead=args.prompt_overhead, hang_rate=args.hang_rate,
+                             root_dir=args.root_dir, model_load_time=args.model_load_time)
+    server.start()
+    print(f"🧪 模拟 ComfyUI 服务器已启动: {server.url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,147 @@
+import os
+import sys
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+
+# 目录监视：Linux 上用 inotify（通过 ctypes 调用 libc，不需要第三方库），文件写完或移入目录时立即得到通知；
+# 其他系统或 inotify 不可用（例如网络文件系统、达到监视数量上限）时退回定时扫描
+
+IN_CLOSE_WRITE = 0x00000008 # 以写方式打开的文件被关闭（写入完成）
+IN_MOVED_TO = 0x00000080    # 文件移入目录（包括同一文件系统内的原子改名）
+IN_Q_OVERFLOW = 0x00004000  # 内核事件队列溢出，有事件丢失
+INOTIFY_EVENT = struct.Struct("iIII") # wd, mask, cookie, len，后面跟 len 字节的文件名
+
+class InotifyBackend:
+    '''
+    inotify 监视：wait 返回 (有变化的文件名集合, 是否有事件丢失)
+    '''
+    name = "inotify"
+
+    def __init__(self, folder):
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify 只在 Linux 上可用")
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        if libc.inotify_add_watch(self.fd, os.fsencode(folder), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, os.strerror(err))
+
+    def wait(self, timeout):
+        names = set()
+        overflow = False
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        while ready:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            pos = 0
+            while pos + INOTIFY_EVENT.size <= len(data):
+                _, mask, _, length = INOTIFY_EVENT.unpack_from(data, pos)
+                pos += INOTIFY_EVENT.size
+                name = data[pos:pos + length].rstrip(b"\0")
+                pos += length
+                if mask & IN_Q_OVERFLOW:
+                    overflow = True
+                elif name:
+                    names.add(os.fsdecode(name))
+        return names, overflow
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingBackend:
+    '''
+    定时扫描：比较文件大小和修改时间；文件在连续两次扫描中保持不变才报告，避免拿到写了一半的文件
+    '''
+    name = "polling"
+
+    def __init__(self, folder, interval=2.0):
+        self.folder = folder
+        self.interval = interval
+        self.reported = self._scan()
+        self.pending = {}
+
+    def _scan(self):
+        stats = {}
+        try:
+            with os.scandir(self.folder) as it:
+                for entry in it:
+                    try:
+                        if entry.is_file():
+                            st = entry.stat()
+                            stats[entry.name] = (st.st_size, st.st_mtime_ns)
+                    except OSError:
+                        continue
+        except OSError as e:
+            print(f"⚠️ 无法读取目录 {self.folder}: {e}")
+        return stats
+
+    def wait(self, timeout):
+        time.sleep(min(timeout, self.interval) if timeout is not None else self.interval)
+        names = set()
+        current = self._scan()
+        for name, stat in current.items():
+            if self.reported.get(name) == stat:
+                self.pending.pop(name, None)
+            elif self.pending.get(name) == stat:
+                names.add(name)
+                self.reported[name] = stat
+                del self.pending[name]
+            else:
+                self.pending[name] = stat
+        for name in set(self.reported) - set(current):
+            del self.reported[name]
+        return names, False
+
+    def close(self):
+        pass
+
+class DirWatcher:
+    '''
+    监视一个目录中新增或修改完成的文件
+
+    参数:
+        suffixes: 只报告这些扩展名的文件（不区分大小写），忽略以 . 开头的文件
+        poll_interval: 退回定时扫描时的扫描间隔（秒）
+        use_inotify: False 时直接使用定时扫描
+    '''
+    def __init__(self, folder, suffixes=(".json",), poll_interval=2.0, use_inotify=True):
+        self.folder = folder
+        self.suffixes = tuple(s.lower() for s in suffixes)
+        self._backend = None
+        if use_inotify:
+            try:
+                self._backend = InotifyBackend(folder)
+            except (OSError, AttributeError) as e:
+                print(f"⚠️ inotify 不可用（{e}），改为每 {poll_interval}s 扫描一次目录")
+        if self._backend is None:
+            self._backend = PollingBackend(folder, poll_interval)
+
+    @property
+    def backend(self):
+        return self._backend.name
+
+    def _wanted(self, name):
+        return name.lower().endswith(self.suffixes) and not name.startswith('.')
+
+    def changes(self, timeout=1.0):
+        '''
+        等待最多 timeout 秒，返回这段时间内新增或修改完成的文件名（排序后的列表）
+        事件丢失时返回目录中的全部文件，由调用方判断哪些需要处理
+        '''
+        names, overflow = self._backend.wait(timeout)
+        if overflow:
+            print("⚠️ 目录事件过多，部分事件丢失，重新检查全部文件")
+            names = set(os.listdir(self.folder))
+        return sorted(n for n in names if self._wanted(n) and os.path.isfile(os.path.join(self.folder, n)))
+
+    def close(self):
+        self._backend.close()
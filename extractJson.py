@@ -1,6 +1,187 @@
 import os
+import sys
+import json
 import shutil
-def extract_json_files(root_dir='.',output_folder='json_workflow',handle_duplicate='rename'):
+import hashlib
+import argparse
+
+import run_profiler
+from json_scanner import iter_files, parallel_map, ScanStats
+
+try:
+    import fcntl  # 仅类 Unix 系统提供，用于 reflink（写时复制克隆）
+except ImportError:
+    fcntl = None
+
+FICLONE = 0x40049409 # Linux ioctl：把整个文件克隆为写时复制副本（btrfs、xfs 等文件系统支持）
+MANIFEST_NAME = '.extract_manifest.json' # dedup 模式的清单文件，保存在输出文件夹中
+
+# 各放置方式依次尝试的方法，前面的失败（跨文件系统、不支持等）时退回下一个
+LINK_CHAINS = {
+    'hardlink': ('hardlink', 'copy'),
+    'reflink': ('reflink', 'copy'),
+    'copy': ('copy',),
+}
+
+def reflink(source_path, dest_path):
+    '''
+    用 FICLONE 创建写时复制副本：不复制数据块，之后修改任意一方都不影响另一方
+    '''
+    if fcntl is None or not hasattr(fcntl, 'ioctl'):
+        raise OSError("当前系统不支持 reflink")
+    with open(source_path, 'rb') as src, open(dest_path, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    shutil.copystat(source_path, dest_path)
+
+def place_file(source_path, dest_path, link_mode='reflink'):
+    '''
+    按 link_mode 把文件放到 dest_path（硬链接 / reflink / 复制），前面的方式失败时退回下一个
+
+    返回:
+        str: 实际使用的方式
+    '''
+    chain = LINK_CHAINS[link_mode]
+    for method in chain:
+        try:
+            if method == 'hardlink':
+                os.link(source_path, dest_path)
+            elif method == 'reflink':
+                reflink(source_path, dest_path)
+            else:
+                shutil.copy2(source_path, dest_path)
+            return method
+        except OSError:
+            if method == chain[-1]:
+                raise
+            try:
+                os.remove(dest_path)
+            except OSError:
+                pass
+
+def copy_json_file(task):
+    '''
+    在子进程中复制一个文件，先写临时文件再改名，同名文件并行覆盖时不会出现半个文件
+
+    返回:
+        tuple: (相对路径, 目标路径, 错误信息, 实际使用的放置方式)
+    '''
+    source_path, dest_path, rel_path, link_mode = task
+    tmp_path = f"{dest_path}.{os.getpid()}.tmp"
+    try:
+        method = place_file(source_path, tmp_path, link_mode)
+        os.replace(tmp_path, dest_path)
+        return rel_path, dest_path, None, method
+    except Exception as e:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return rel_path, dest_path, str(e), None
+
+def hash_json_file(source_path):
+    '''
+    在子进程中计算文件内容的 sha256
+
+    返回:
+        tuple: (源路径, sha256, 大小, 错误信息)
+    '''
+    try:
+        digest = hashlib.sha256()
+        size = 0
+        with open(source_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+                size += len(chunk)
+        return source_path, digest.hexdigest(), size, None
+    except OSError as e:
+        return source_path, None, 0, str(e)
+
+class NameRegistry:
+    '''
+    输出文件夹的文件名登记表：开始时用 scandir 读取一次已有文件名，之后只查内存，
+    重命名时记住每个文件名用到的编号，不必从 _1 开始逐个检查是否存在
+    macOS / Windows 的文件系统默认不区分大小写，文件名按小写登记
+    '''
+    def __init__(self, folder):
+        self.fold = sys.platform in ('darwin', 'win32')
+        self.names = set()
+        self.counters = {}
+        with os.scandir(folder) as it:
+            for entry in it:
+                self.names.add(self._key(entry.name))
+
+    def _key(self, name):
+        return name.lower() if self.fold else name
+
+    def __contains__(self, name):
+        return self._key(name) in self.names
+
+    def add(self, name):
+        self.names.add(self._key(name))
+
+    def unique(self, filename):
+        '''
+        返回 name_N.ext 形式的未占用文件名并登记
+        '''
+        name, ext = os.path.splitext(filename)
+        counter = self.counters.get(filename, 1)
+        while f"{name}_{counter}{ext}" in self:
+            counter += 1
+        self.counters[filename] = counter + 1
+        new_filename = f"{name}_{counter}{ext}"
+        self.add(new_filename)
+        return new_filename
+
+def load_manifest(output_path, registry):
+    '''
+    读取上次 dedup 运行的清单，只保留输出文件夹中仍然存在的文件
+    '''
+    manifest = {'objects': {}, 'sources': {}}
+    try:
+        with open(os.path.join(output_path, MANIFEST_NAME), 'r', encoding='utf-8') as f:
+            manifest.update(json.load(f))
+    except (OSError, ValueError):
+        pass
+    manifest['objects'] = {sha: name for sha, name in manifest['objects'].items() if name in registry}
+    stored = set(manifest['objects'].values())
+    manifest['sources'] = {src: name for src, name in manifest['sources'].items() if name in stored}
+    return manifest
+
+def save_manifest(output_path, manifest):
+    path = os.path.join(output_path, MANIFEST_NAME)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def indexed_json_files(index_db,root_dir,output_path,processes=None):
+    '''
+    增量更新索引后，从索引中取出根目录下的全部 JSON 文件（包括解析出错的，跳过输出文件夹和隐藏文件）
+
+    返回:
+        dict: {路径: (大小, sha256)}，dedup 模式直接使用索引中的哈希，不再重新计算
+    '''
+    from workflow_index import WorkflowIndex
+    index=WorkflowIndex(index_db)
+    try:
+        index.update(root_dir,processes)
+        paths=index.query(root=root_dir,include_errors=True)
+        skip_prefix=os.path.abspath(output_path)+os.sep
+        paths=[p for p in paths if not p.startswith(skip_prefix) and not os.path.basename(p).startswith('.')]
+        info=index.file_info(paths)
+    finally:
+        index.close()
+    return {p:info[p] for p in paths if p in info}
+
+def extract_json_files(root_dir='.',output_folder='json_workflow',handle_duplicate='rename',processes=None,index_db=None,link_mode='reflink'):
+    '''
+    把目录树中的全部 JSON 文件提取到一个文件夹
+
+    参数:
+        handle_duplicate: 重名处理方式 rename / skip / overwrite；
+                          dedup 按内容去重，内容相同的文件只保存一份，清单记录每个源文件对应的保存文件
+        link_mode: 放置方式 reflink（默认，写时复制，不支持时复制）/ hardlink（与源文件共用数据，修改会互相影响）/ copy
+    '''
     # 创建输出文件夹
     output_path=os.path.join(root_dir,output_folder)
     os.makedirs(output_path,exist_ok=True)
@@ -9,72 +190,140 @@ def extract_json_files(root_dir='.',output_folder='json_workflow',handle_duplica
     print("-"*60)
     print(f"根目录:{os.path.abspath(root_dir)}")
     print(f"输出目录:{os.path.abspath(output_path)}")
-    print(f"重名处理:{handle_duplicate}\n")
+    print(f"重名处理:{handle_duplicate}")
+    print(f"放置方式:{link_mode}\n")
 
     # 统计信息
     total_found=0 # 总共找到多少json文件
     total_copied=0 # 总复制
     total_skipped=0 # 总共跳过多少文件
     duplicate_count=0 # 重名处理数量
+    overwritten_count=0 # overwrite 模式下被遍历顺序中后面的同名文件覆盖、不再复制的文件数
+    dedup_count=0 # 内容重复、没有再保存的文件数
+    unchanged_count=0 # 上次运行已经提取、清单中已有记录的文件数
+    saved_bytes=0 # 去重节省的字节数
+    methods={} # 各放置方式的使用次数
 
     # 用于追踪已复制的文件名
     copied_files={}
+    # 输出文件夹中已有的和本次运行已分配的文件名：复制是并行进行的，还没复制完的文件也要算作已存在
+    registry=NameRegistry(output_path)
 
-    # 遍历所有文件
-    for root,dirs,files in os.walk(root_dir):
-        # 跳过输出文件夹本身
-        if os.path.abspath(root)==os.path.abspath(output_path):
-            continue
+    # 文件列表：索引（在开始复制前取出）或边遍历边产出
+    known_hashes={}
+    if index_db:
+        with run_profiler.stage("读取索引"):
+            known_hashes=indexed_json_files(index_db,root_dir,output_path,processes)
+        sources=list(known_hashes)
+    else:
+        sources=iter_files(root_dir,skip_dirs=[output_path])
 
-        # 过滤JSON文件
-        json_files=[f for f in files if f.lower().endswith('.json') and not f.startswith('.')]
-
-        for filename in json_files:
+    def plan_copies():
+        # 依次决定每个文件的目标路径
+        nonlocal total_found,total_skipped,duplicate_count
+        for source_path in sources:
             total_found+=1
-            source_path=os.path.join(root,filename)
+            filename=os.path.basename(source_path)
 
             # 相对路径
             rel_path=os.path.relpath(source_path,root_dir)
 
-            # 目标文件路径
-            dest_path=os.path.join(output_path,filename)
-
             # 处理重名文件
-            if os.path.exists(dest_path):
+            if filename in registry:
                 if handle_duplicate=='skip':
                     print(f"➡️ 跳过(已存在):{rel_path}")
                     total_skipped+=1
                     continue
                 elif handle_duplicate=='rename':
                     # 生成新文件名
-                    name,ext=os.path.splitext(filename)
-                    counter=1
-                    new_filename=f"{name}_{counter}{ext}"
-                    dest_path=os.path.join(output_path,new_filename)
-                    while os.path.exists(dest_path):
-                        counter+=1
-                        new_filename=f"{name}_{counter}{ext}"
-                        dest_path=os.path.join(output_path,new_filename)
-                    print(f"♻️ 重命名:{rel_path}->{new_filename}")
+                    filename=registry.unique(filename)
+                    print(f"♻️ 重命名:{rel_path}->{filename}")
                     duplicate_count+=1
                 elif handle_duplicate=='overwrite':
                     print(f"♻️ 覆盖:{rel_path}")
-                
+
             else:
                 print(f"♻️ 复制:{rel_path}")
-            
-            # 复制文件
-            try:
-                shutil.copy2(source_path,dest_path)
-                total_coped+=1
+                registry.add(filename)
+            yield source_path,os.path.join(output_path,filename),rel_path,link_mode
 
-                # 记录已经复制的文件（统计用）
-                final_filename=os.path.basename(dest_path)
-                if final_filename not in copied_files:
-                    copied_files[final_filename]=[]
-                copied_files[final_filename].append(rel_path)
-            except Exception as e:
-                print(f"❌ 复制失败:{rel_path}-{e}")
+    manifest=None
+    def plan_dedup():
+        # 先并行计算全部文件的哈希（索引中已有的直接使用），再按路径顺序决定保存哪些文件，重名编号每次运行都一样
+        nonlocal total_found,duplicate_count,dedup_count,unchanged_count,saved_bytes,manifest
+        manifest=load_manifest(output_path,registry)
+        objects,stored_sources=manifest['objects'],manifest['sources']
+        if known_hashes:
+            hashed=[(p,sha,size,None) for p,(size,sha) in known_hashes.items()]
+        else:
+            hashed=list(parallel_map(hash_json_file,sources,processes))
+        tasks=[]
+        for source_path,sha,size,error in sorted(hashed):
+            total_found+=1
+            rel_path=os.path.relpath(source_path,root_dir)
+            if error is not None or sha is None:
+                print(f"❌ 读取失败:{rel_path}-{error or '未能计算哈希'}")
+                continue
+            if sha in objects:
+                # 内容已经保存过：只在清单中记录对应关系
+                if stored_sources.get(rel_path)==objects[sha]:
+                    unchanged_count+=1
+                    continue
+                print(f"🔗 内容重复:{rel_path}->{objects[sha]}")
+                stored_sources[rel_path]=objects[sha]
+                dedup_count+=1
+                saved_bytes+=size
+                continue
+            filename=os.path.basename(source_path)
+            if filename in registry:
+                filename=registry.unique(filename)
+                print(f"♻️ 重命名:{rel_path}->{filename}")
+                duplicate_count+=1
+            else:
+                print(f"♻️ 复制:{rel_path}")
+                registry.add(filename)
+            objects[sha]=filename
+            stored_sources[rel_path]=filename
+            tasks.append((source_path,os.path.join(output_path,filename),rel_path,link_mode))
+        return tasks
+
+    # 复制文件（多个进程并行）；非 dedup 模式下遍历目录和复制同时进行，耗时都计入“复制文件”
+    if handle_duplicate=='dedup':
+        with run_profiler.stage("计算哈希与去重"):
+            tasks=plan_dedup()
+    elif handle_duplicate=='overwrite':
+        # 同名文件并行复制时哪个最后写完是不确定的：先列出全部文件，每个目标只保留遍历顺序中最后一个源文件，
+        # 结果与逐个复制时相同（后遍历到的覆盖前面的）
+        latest={}
+        for task in plan_copies():
+            key=registry._key(os.path.basename(task[1]))
+            overwritten_count+=latest.pop(key,None) is not None
+            latest[key]=task
+        tasks=list(latest.values())
+    else:
+        tasks=plan_copies()
+    stats=ScanStats()
+    with run_profiler.stage("复制文件"):
+        for rel_path,dest_path,error,method in parallel_map(copy_json_file,tasks,processes,stats=stats):
+            final_filename=os.path.basename(dest_path)
+            if error is not None:
+                print(f"❌ 复制失败:{rel_path}-{error}")
+                if manifest is not None:
+                    # 没有保存成功的内容从清单中去掉，下次运行重新保存
+                    manifest['objects']={sha:name for sha,name in manifest['objects'].items() if name!=final_filename}
+                    manifest['sources']={src:name for src,name in manifest['sources'].items() if name!=final_filename}
+                continue
+            total_copied+=1
+            methods[method]=methods.get(method,0)+1
+
+            # 记录已经复制的文件（统计用）
+            if final_filename not in copied_files:
+                copied_files[final_filename]=[]
+            copied_files[final_filename].append(rel_path)
+
+    if manifest is not None:
+        with run_profiler.stage("保存清单"):
+            save_manifest(output_path,manifest)
 
     # 输出统计信息
     print('\n'+'-'*60)
@@ -84,6 +333,14 @@ def extract_json_files(root_dir='.',output_folder='json_workflow',handle_duplica
     print(f"成功复制:{total_copied}")
     print(f"跳过文件:{total_skipped}")
     print(f"重命名文件:{duplicate_count}")
+    if handle_duplicate=='overwrite':
+        print(f"被同名文件覆盖:{overwritten_count}")
+    if handle_duplicate=='dedup':
+        print(f"内容重复:{dedup_count}（节省 {saved_bytes/1024/1024:.1f} MB）")
+        print(f"清单中已有:{unchanged_count}")
+        print(f"清单文件:{os.path.join(os.path.abspath(output_path),MANIFEST_NAME)}")
+    print(f"放置方式:{', '.join(f'{m} {n}' for m,n in methods.items()) or '-'}")
+    print(f"速度:{stats.summary()}")
     print(f"\n✅ 所有文件已经保存到:{os.path.abspath(output_path)}")
 
     # 显示重命名文件的来源
@@ -96,6 +353,18 @@ def extract_json_files(root_dir='.',output_folder='json_workflow',handle_duplica
                 print(f"\n{filename}:")
                 for idx,source in enumerate(sources,1):
                     print(f"{idx}.{source}")
-                    
+
 if __name__=='__main__':
-    extract_json_files()
\ No newline at end of file
+    parser=argparse.ArgumentParser(description="把目录树中的全部 JSON 文件提取到一个文件夹")
+    parser.add_argument("--root",default='.',help="要遍历的根目录")
+    parser.add_argument("--output",default='json_workflow',help="输出文件夹（位于根目录下）")
+    parser.add_argument("--duplicate",choices=("rename","skip","overwrite","dedup"),default='rename',
+                        help="重名处理方式；dedup 按内容去重，内容相同的文件只保存一份并记录清单")
+    parser.add_argument("--link",choices=tuple(LINK_CHAINS),default='reflink',
+                        help="放置方式：reflink 写时复制（不支持时复制）；hardlink 硬链接，与源文件共用数据；copy 复制（默认 %(default)s）")
+    parser.add_argument("--processes",type=int,default=None,help="并行复制的进程数（默认 CPU 核数）")
+    parser.add_argument("--from-index",default=None,metavar="DB",help="从 workflow_index 的索引数据库获取文件列表（先增量更新索引）")
+    run_profiler.add_arguments(parser,"extractJson_profile.txt")
+    args=parser.parse_args()
+    run_profiler.start_from_args(args)
+    extract_json_files(args.root,args.output,args.duplicate,args.processes,args.from_index,args.link)
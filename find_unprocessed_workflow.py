@@ -1,55 +1,60 @@
 import os
 import shutil
+import argparse
 
-def find_unprocessed_workflows():
+import run_profiler
+from run_logs import workflow_log_status, workflow_expected_inputs, count_input_images
+
+def find_unprocessed_workflows(workflow_dir='workflow', output_dir='workflow_left', log_dir='.', read_folder=None):
     """
-    查找在 'workflow' 文件夹中但没有对应 '.json.csv' 日志的 '.json' 文件，
-    并将它们复制到 'workflow_left' 文件夹中。
+    查找 'workflow' 文件夹中还没有全部处理成功的 '.json' 文件，并将它们复制到 'workflow_left' 文件夹中。
+    完成状态来自运行日志（'<工作流>.json.csv' 或 '.json.jsonl'）中的 success / fail 行：
+    没有日志、有失败的图片、日志中的图片数少于 read_folder 中的图片数（图生图，文生图为 1）、
+    或工作流在日志之后被修改过，都算未处理。read_folder 为 None 时无法判断图生图是否处理完，
+    这些工作流只列出（状态 unknown），不复制。
+    需要自动处理新增工作流时，使用 png2png.py --watch。
     """
-    # 定义目录路径
-    # 当前目录
-    current_dir = '.'
-    # JSON 工作流文件所在目录
-    workflow_dir = os.path.join(current_dir, 'workflow')
-    # 输出结果的目标目录
-    output_dir = os.path.join(current_dir, 'workflow_left')
-
     # --- 步骤 1: 检查所需目录是否存在 ---
     if not os.path.isdir(workflow_dir):
-        print(f"错误：找不到 'workflow' 子文件夹。请确保脚本在正确的目录下运行。")
-        return
-
-    # --- 步骤 2: 获取所有已生成的 CSV 日志所对应的 JSON 文件名 ---
-    # CSV 文件名为 'workflow_name.json.csv'
-    # 我们需要提取出 'workflow_name.json' 这部分作为已处理的标记
-    try:
-        # 使用集合（set）以获得更快的查找速度
-        processed_files = {
-            f.replace('.csv', '') # 直接去掉末尾的 .csv
-            for f in os.listdir(current_dir)
-            if f.endswith('.json.csv') and os.path.isfile(os.path.join(current_dir, f))
-        }
-        print(f"成功找到 {len(processed_files)} 个 CSV 日志文件。")
-    except Exception as e:
-        print(f"读取当前目录下的 CSV 文件时出错: {e}")
+        print(f"错误：找不到 '{workflow_dir}' 子文件夹。请确保脚本在正确的目录下运行。")
         return
 
-    # --- 步骤 3: 找到未处理的 JSON 文件 ---
+    # --- 步骤 2 / 3: 根据运行日志判断每个 JSON 文件的完成状态 ---
     unprocessed_json_files = []
+    unknown_json_files = []
+    status_counts = {}
+    # 图生图工作流应处理的图片数；不知道读取文件夹时图生图的完成状态为 unknown
+    image_count = count_input_images(read_folder) if read_folder else None
     try:
-        for filename in os.listdir(workflow_dir):
-            if filename.endswith('.json'):
-                # 检查这个完整的 JSON 文件名（例如 'workflow1.json'）
-                # 是否在已处理的集合中
-                if filename not in processed_files:
-                    unprocessed_json_files.append(filename)
+        with run_profiler.stage("读取运行日志"):
+            for filename in sorted(os.listdir(workflow_dir)):
+                if filename.endswith('.json'):
+                    workflow_path = os.path.join(workflow_dir, filename)
+                    status = workflow_log_status(filename, workflow_expected_inputs(workflow_path, image_count),
+                                                 log_dir=log_dir, workflow_path=workflow_path)
+                    status_counts[status] = status_counts.get(status, 0) + 1
+                    if status == "unknown":
+                        unknown_json_files.append(filename)
+                    elif status != "done":
+                        unprocessed_json_files.append(filename)
     except Exception as e:
-        print(f"遍历 'workflow' 文件夹时出错: {e}")
+        print(f"遍历 '{workflow_dir}' 文件夹时出错: {e}")
         return
+    labels = {"done": "全部成功", "pending": "没有日志", "failed": "有失败", "partial": "没有处理完", "changed": "日志之后修改过",
+              "unknown": "图生图图片数未知"}
+    print("运行日志状态: " + "，".join(f"{labels[k]} {v} 个" for k, v in sorted(status_counts.items())))
+    if unknown_json_files:
+        print(f"\n⚠️ 没有指定 --read-folder，以下 {len(unknown_json_files)} 个图生图工作流的日志没有失败，"
+              f"但无法判断是否处理完全部图片（未复制）：")
+        for json_file in unknown_json_files:
+            print(f"  - {json_file}")
 
     # --- 步骤 4: 处理找到的文件 ---
     if not unprocessed_json_files:
-        print("\n恭喜！所有 'workflow' 文件夹下的 JSON 文件都已处理，没有遗漏。")
+        if unknown_json_files:
+            print(f"\n没有确定未处理的 JSON 文件；上面的图生图工作流请指定 --read-folder 再检查。")
+        else:
+            print(f"\n恭喜！所有 '{workflow_dir}' 文件夹下的 JSON 文件都已处理，没有遗漏。")
         return
 
     print(f"\n找到了 {len(unprocessed_json_files)} 个未处理的 JSON 工作流文件。")
@@ -61,12 +66,13 @@ def find_unprocessed_workflows():
             os.makedirs(output_dir)
             print(f"已创建输出文件夹: '{output_dir}'")
 
-        print("\n开始将未处理的 JSON 文件复制到 'workflow_left' 文件夹...")
-        for json_file in unprocessed_json_files:
-            source_path = os.path.join(workflow_dir, json_file)
-            destination_path = os.path.join(output_dir, json_file)
-            shutil.copy2(source_path, destination_path) # copy2 会同时复制元数据
-            print(f"  - 已复制: {json_file}")
+        print(f"\n开始将未处理的 JSON 文件复制到 '{output_dir}' 文件夹...")
+        with run_profiler.stage("复制文件"):
+            for json_file in unprocessed_json_files:
+                source_path = os.path.join(workflow_dir, json_file)
+                destination_path = os.path.join(output_dir, json_file)
+                shutil.copy2(source_path, destination_path) # copy2 会同时复制元数据
+                print(f"  - 已复制: {json_file}")
             
         print(f"\n处理完成！总共有 {len(unprocessed_json_files)} 个文件被复制到了 '{output_dir}' 文件夹中。")
 
@@ -74,4 +80,14 @@ def find_unprocessed_workflows():
         print(f"\n在创建目录或复制文件时发生错误: {e}")
 
 if __name__ == "__main__":
-    find_unprocessed_workflows()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="根据运行日志找出还没有全部处理成功的工作流，复制到单独的文件夹")
+    parser.add_argument("--workflow-dir", default='workflow', help="JSON 工作流文件所在目录")
+    parser.add_argument("--output-dir", default='workflow_left', help="未处理工作流的复制目标目录")
+    parser.add_argument("--log-dir", default='.', help="运行日志所在目录（png2png 的运行目录）")
+    parser.add_argument("--read-folder", default=None,
+                        help="png2png 图生图读取图片的文件夹；给出时日志中图片数不足的工作流也算未处理，"
+                             "不给出时无法判断图生图工作流是否处理完")
+    run_profiler.add_arguments(parser, "find_unprocessed_profile.txt")
+    args = parser.parse_args()
+    run_profiler.start_from_args(args)
+    find_unprocessed_workflows(args.workflow_dir, args.output_dir, args.log_dir, args.read_folder)
\ No newline at end of file
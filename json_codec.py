@@ -0,0 +1,92 @@
+import json
+
+try:
+    import orjson  # 可选依赖；安装后解析和序列化都快很多，没有安装时使用标准库 json
+except ImportError:
+    orjson = None
+
+# 统一的 JSON 编解码：dumps 返回紧凑的 UTF-8 bytes，loads 接受 str 或 bytes
+# orjson 不支持的少数情况（超过 64 位的整数、NaN / Infinity 字面量等）自动退回标准库，结果与标准库一致
+
+UTF8_BOM = b"\xef\xbb\xbf"
+
+def _stdlib_loads(data):
+    return json.loads(data)
+
+def _stdlib_dumps(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def _orjson_loads(data):
+    try:
+        return orjson.loads(data)
+    except orjson.JSONDecodeError:
+        return json.loads(data)  # 标准库能解析的扩展写法，或者由标准库给出错误信息
+
+def _orjson_dumps(obj):
+    try:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    except TypeError:
+        return _stdlib_dumps(obj)
+
+BACKENDS = {"stdlib": (_stdlib_loads, _stdlib_dumps)}
+if orjson is not None:
+    BACKENDS["orjson"] = (_orjson_loads, _orjson_dumps)
+
+backend = "orjson" if orjson is not None else "stdlib" # 当前使用的实现
+_loads, _dumps = BACKENDS[backend]
+
+def use_backend(name):
+    '''
+    切换实现（压测对比用）
+
+    返回:
+        str: 切换前的实现名
+    '''
+    global backend, _loads, _dumps
+    if name not in BACKENDS:
+        raise ValueError(f"JSON 实现 {name} 不可用，可用: {', '.join(BACKENDS)}")
+    previous, backend = backend, name
+    _loads, _dumps = BACKENDS[name]
+    return previous
+
+def loads(data):
+    '''
+    解析 JSON 文本（str 或 bytes，bytes 可以带 UTF-8 BOM）
+    '''
+    if isinstance(data, (bytes, bytearray)) and data[:3] == UTF8_BOM:
+        data = data[3:]
+    return _loads(data)
+
+def dumps(obj):
+    '''
+    序列化为紧凑的 UTF-8 bytes
+    '''
+    return _dumps(obj)
+
+def load(path):
+    '''
+    读取并解析一个 JSON 文件（按 bytes 读取，不先解码成 str）
+    '''
+    with open(path, "rb") as f:
+        return loads(f.read())
+
+class PromptTemplate:
+    '''
+    请求体模板：请求体只序列化一次，之后每次只把占位值替换成新的值
+    同一个工作流处理很多张图片时，不必为每张图片重新序列化整个工作流
+
+    参数:
+        body: 要序列化的对象，其中恰好有一处值为 marker 字符串
+        marker: 占位字符串，应足够独特，不会出现在工作流的其他地方
+    '''
+    def __init__(self, body, marker):
+        self.backend = backend
+        self._parts = dumps(body).split(dumps(marker))
+        if len(self._parts) != 2:
+            raise ValueError(f"占位值在请求体中出现了 {len(self._parts) - 1} 次，应为 1 次")
+
+    def render(self, value):
+        '''
+        返回占位值替换为 value 后的请求体（bytes）
+        '''
+        return self._parts[0] + dumps(value) + self._parts[1]
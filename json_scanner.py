@@ -0,0 +1,97 @@
+import os
+import time
+import multiprocessing
+
+# 工作流扫描脚本共用的扫描引擎：
+# 基于 os.scandir 边遍历边产出文件路径，交给进程池并行读取/解析/匹配，结果按完成顺序流式返回，
+# 大目录不必等遍历结束就能开始处理匹配结果
+
+def iter_files(root, suffixes=(".json",), skip_dirs=(), include_hidden=False):
+    '''
+    基于 os.scandir 的目录遍历，边遍历边返回文件路径（先序，与 os.walk 的顺序相近）
+
+    参数:
+        suffixes: 要查找的扩展名，不区分大小写
+        skip_dirs: 不遍历的目录（连同其子目录），例如脚本自己的输出目录
+        include_hidden: 是否包含以 . 开头的文件
+    '''
+    suffixes = tuple(s.lower() for s in suffixes)
+    skip = {os.path.abspath(d) for d in skip_dirs}
+    stack = [root]
+    while stack:
+        current = stack.pop()
+        try:
+            it = os.scandir(current)
+        except OSError as e:
+            print(f"⚠️ 无法读取目录 {current}: {e}")
+            continue
+        subdirs = []
+        with it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if not skip or os.path.abspath(entry.path) not in skip:
+                            subdirs.append(entry.path)
+                    elif entry.name.lower().endswith(suffixes) and (include_hidden or not entry.name.startswith('.')):
+                        yield entry.path
+                except OSError:
+                    continue
+        stack.extend(reversed(subdirs))
+
+class ScanStats:
+    '''
+    统计处理的文件数和速度
+    '''
+    def __init__(self):
+        self.files = 0
+        self.start = time.time()
+
+    @property
+    def elapsed(self):
+        return time.time() - self.start
+
+    @property
+    def rate(self):
+        elapsed = self.elapsed
+        return self.files / elapsed if elapsed > 0 else 0.0
+
+    def summary(self):
+        return f"共处理 {self.files} 个文件，耗时 {self.elapsed:.2f}s，{self.rate:.0f} 文件/秒"
+
+def default_processes():
+    '''
+    默认进程数：当前进程可用的 CPU 核数（容器中可能少于机器的核数）
+    '''
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0)) or 1
+    return os.cpu_count() or 1
+
+def parallel_map(worker, items, processes=None, chunksize=16, stats=None):
+    '''
+    用进程池并行执行 worker(item)，按完成顺序边处理边返回结果（不保证与输入顺序一致）
+    worker 必须是模块顶层函数（子进程需要按名字找到它）
+    processes 为 1 时直接在当前进程执行，便于调试；stats 为 ScanStats 时累计处理数量
+    '''
+    processes = processes or default_processes()
+    if processes <= 1:
+        results = map(worker, items)
+    else:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap_unordered(worker, items, chunksize)
+    try:
+        for result in results:
+            if stats is not None:
+                stats.files += 1
+            yield result
+    finally:
+        if processes > 1:
+            pool.terminate()  # 调用方提前停止时不再等待剩余任务
+            pool.join()
+
+def scan(root, worker, suffixes=(".json",), skip_dirs=(), include_hidden=False,
+         processes=None, chunksize=16, stats=None):
+    '''
+    遍历 root 下的文件并用进程池执行 worker(文件路径)，流式返回结果
+    '''
+    files = iter_files(root, suffixes, skip_dirs, include_hidden)
+    return parallel_map(worker, files, processes, chunksize, stats)
@@ -8,47 +8,326 @@ import csv
 import random 
 import os
 import shutil
+import threading
+import argparse
+import uuid
+import hashlib
+import queue
+import atexit
+import glob
+import statistics
+import math
+import bisect
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+
+import json_codec
+import run_profiler
+from workflow_utils import find_image_input_node, workflow_model_refs, MODEL_INPUT_WEIGHTS
+from run_logs import RUN_LOG_FIELDS, RUN_LOG_TIMING_FIELDS, read_run_log, workflow_log_status, workflow_expected_inputs
+
+try:
+    import websocket  # websocket-client，可选依赖；没有安装时退回 /history 轮询
+except ImportError:
+    websocket = None
+
+try:
+    from PIL import Image, ImageOps  # Pillow，可选依赖；没有安装时不做上传前预处理
+except ImportError:
+    Image = ImageOps = None
 
 url = "www.comfyweb.com" # 此处填写comfyui线上环境的网址
 image_exts = ('.png', '.jpg', '.jpeg', '.bmp', '.webp')
+max_inflight = 1 # 图生图时同时在途的最大任务数，1 表示逐张串行处理
+completion_mode = "auto" # 任务完成检测方式: auto(优先websocket) / ws / poll
+prompt_timeout = 1800 # 单个任务最长等待时间（秒）
+poll_min_delay = 0.2 # 轮询的初始间隔（秒），之后指数增长
+poll_max_delay = 3 # 轮询的最大间隔（秒）
+ws_recheck_interval = 15 # websocket 模式下兜底查询一次 /history 的间隔（秒）
+client_id = str(uuid.uuid4()) # 提交任务时带上，服务器只会把该任务的事件推送给这个客户端
+upload_cache_file = ".upload_cache.json" # 图片哈希 -> 服务器路径 的持久化索引
+upload_cache = None # 运行时的 UploadCache 实例，为 None 时每次都重新上传
+input_manifest_file = ".input_manifest.json" # 输入图片清单（路径、大小、修改时间、内容哈希），按目录修改时间增量刷新
+manifest_with_hash = False # 建立清单时是否同时计算全部图片的内容哈希（之后上传缓存直接复用）
+journal_file = ".png2png_journal.jsonl" # 已完成的 (工作流, 输入图片, 输出) 记录，--resume 时据此跳过
+job_order = "name" # 工作流执行顺序: name(按文件名) / model(使用相同模型的工作流连续执行，减少服务器重新加载模型，需要先解析全部工作流)
+log_format = "csv" # 运行日志格式: csv / jsonl
+log_sink = None # 运行时的 RunLogSink 实例，为 None 时自动创建
+metrics = None # 运行时的 RunMetrics 实例，为 None 时自动创建
+hosts = [] # 多台 ComfyUI 服务器时在此列出全部网址，任务会派给排队最少的服务器；为空时只用 url
+host_pool = None # 运行时的 HostPool 实例，为 None 时按 hosts 自动创建
+http_pool_size = 16 # 每台服务器保持的最大 keep-alive 连接数
+retry_base_delay = 1 # 请求失败后重试的基础等待时间（秒），之后指数增长并加随机抖动
+retry_max_delay = 30 # 重试等待时间的上限（秒）
+prompt_retries = 1 # 任务超时被取消后重新派发的次数，0 表示直接记为失败
+breaker_threshold = 3 # 同一台服务器连续失败多少次后熔断（移出轮换）
+download_chunk_size = 1 << 20 # 下载结果图片时每次写入磁盘的字节数
+download_parallelism = 4 # 一个任务输出多张图片时同时下载的数量
+preprocess_format = None # 上传前把输入图片转码的格式: webp / jpeg / png，None 表示原样上传（需要安装 Pillow）
+preprocess_quality = 90 # 转码为有损格式时的压缩质量
+preprocess_size = None # 预处理的目标尺寸 (宽, 高)；None 表示按工作流中图片输入后面的缩放节点自动确定
+preprocess_cache_dir = ".preprocess_cache" # 转码结果的磁盘缓存目录，以 源文件哈希 + 参数 命名
+result_cache = None # 运行时的 ResultCache 实例，为 None 时不使用生成结果缓存（--result-cache 开启）
+result_cache_dir = ".result_cache" # 生成结果缓存目录，每个条目是以 任务+输入哈希 命名的子目录
+result_cache_budget = 10 * 1024 ** 3 # 生成结果缓存的磁盘上限（字节），超出时删除最久没用过的条目
+work_claims = None # 运行时的 work_lease.WorkClaims 实例（--shard / --lease-dir），为 None 时处理全部任务
+comfy_local_dirs = {} # 服务器网址 -> ComfyUI 根目录；与本机共享文件系统时填写，结果图片直接本地复制，不走 HTTP
+# 各接口的超时时间（秒），按路径前缀匹配，未列出的接口使用 default
+endpoint_timeouts = {
+    "/upload/image": 60,
+    "/prompt": 30,
+    "/history": 10,
+    "/view": 120,
+    "/queue": 5,
+    "default": 10,
+}
+
+# ============ HTTP 连接池 ============
+
+class HttpSessionPool:
+    '''
+    所有网络请求共用的 requests.Session
+    同一台服务器的上传、提交、轮询、下载复用 keep-alive 连接，不再每次新建 TCP/TLS 连接
+    urllib3 的连接池本身是线程安全的，这里只需要保证 Session 只创建一次
+    '''
+    def __init__(self, pool_size=http_pool_size):
+        self.pool_size = pool_size
+        self._session = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=self.pool_size)
+                    session.mount("http://", adapter)
+                    session.mount("https://", adapter)
+                    self._session = session
+        return self._session
+
+    def request(self, method, target_url, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = endpoint_timeout(target_url)
+        return self.session.request(method, target_url, timeout=timeout, **kwargs)
+
+    def stats(self):
+        '''
+        统计连接复用情况：请求数、新建连接数、复用次数
+        '''
+        requests_count = connections = 0
+        if self._session is not None:
+            for adapter in set(self._session.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for key in list(pools.keys()):
+                    pool = pools.get(key)
+                    if pool is not None:
+                        requests_count += pool.num_requests
+                        connections += pool.num_connections
+        return {
+            "requests": requests_count,
+            "connections": connections,
+            "reused": max(0, requests_count - connections),
+        }
+
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+def endpoint_timeout(target_url):
+    '''
+    根据接口路径返回超时时间
+    '''
+    path = urlsplit(target_url if "://" in target_url else "http://" + target_url).path
+    for prefix, value in endpoint_timeouts.items():
+        if prefix != "default" and path.startswith(prefix):
+            return value
+    return endpoint_timeouts["default"]
+
+http_pool = HttpSessionPool()
 
 # ============ 通用重试方法 ============
 
-def request_with_retry(method, url, max_retries=3, delay=3, timeout=10, **kwargs):
+def backoff_delay(attempt, base=None, cap=None):
+    '''
+    第 attempt 次（从0开始）重试前的等待时间
+    指数退避加全抖动：在 [0, min(cap, base * 2^attempt)] 中随机取值，避免多个线程同时重试
+    '''
+    base = retry_base_delay if base is None else base
+    cap = retry_max_delay if cap is None else cap
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+def request_with_retry(method, url, max_retries=3, delay=None, timeout=None, **kwargs):
     '''
     一种增加网络请求健壮性的设计，为所有的http请求增加了自动重试机制
+    请求统一走 http_pool 的连接池，timeout 为 None 时按接口取 endpoint_timeouts 中的值
+    delay 为退避的基础等待时间，为 None 时使用 retry_base_delay
+    4xx 错误（408/429 除外）说明请求本身有问题，不再重试
     '''
     for attempt in range(max_retries):
         try:
-            response = requests.request(method, url, timeout=timeout, **kwargs)
+            response = http_pool.request(method, url, timeout=timeout, **kwargs)
             response.raise_for_status()
             return response
         except Exception as e:
             print(f"[{method.upper()}] Attempt {attempt + 1}/{max_retries} failed: {e}")
+            status = getattr(getattr(e, "response", None), "status_code", None)
+            if status is not None and 400 <= status < 500 and status not in (408, 429):
+                raise
             if attempt < max_retries - 1:
-                time.sleep(delay)
+                time.sleep(backoff_delay(attempt, delay))
             else:
                 raise
 
+# ============ 超时与取消 ============
+
+class PromptTimeout(TimeoutError):
+    '''
+    任务超过截止时间仍未完成（已尝试从服务器取消），可以重新派发
+    started 为 False 表示任务还在排队就被删除了，问题不在这台服务器本身
+    '''
+    def __init__(self, message, started=True):
+        super().__init__(message)
+        self.started = started
+
+class PromptExecutionError(RuntimeError):
+    '''
+    服务器执行任务时出错或任务被中断，原样重试通常没有意义
+    '''
+
+def cancel_prompt(pid, base_url=None):
+    '''
+    取消一个任务：还在排队时从 /queue 删除，已经开始执行时调用 /interrupt
+    只在确认任务正在执行时才中断，避免旧版 ComfyUI 忽略 prompt_id 误停其他任务
+
+    返回:
+        str: "deleted" / "interrupted"
+        None: 队列中找不到该任务（可能刚好结束）或取消失败
+    '''
+    base_url = base_url or url
+    try:
+        data = request_with_retry("GET", base_url + "/queue", max_retries=1).json()
+        running = {item[1] for item in data.get("queue_running", [])}
+        pending = {item[1] for item in data.get("queue_pending", [])}
+        if pid in pending:
+            request_with_retry("POST", base_url + "/queue", max_retries=1, json={"delete": [pid]})
+            return "deleted"
+        if pid in running:
+            request_with_retry("POST", base_url + "/interrupt", max_retries=1, json={"prompt_id": pid})
+            return "interrupted"
+    except Exception as e:
+        print(f"⚠️  取消任务 {pid} 失败: {e}")
+    return None
+
 # ============ 网络相关函数 ============
 
+def output_paths(save_path, count):
+    '''
+    一个任务的 count 张输出图片的保存路径：第 i 张把 save_path 中的 .png 替换成 _i.png
+    '''
+    return [save_path.replace(".png", "_" + str(i) + ".png") for i in range(count)]
+
 def download_image(prefix, urls, save_path):
     '''
     作用：从服务器下载处理好的图片
+    第 i 张图片保存为把 save_path 中的 .png 替换成 _i.png 的文件
+    一个任务输出多张图片时并行下载，每张图片分块写入磁盘
     '''
-    count = 0
-    for url_tail in urls:
-        url_tail = prefix + url_tail
+    targets = list(zip(urls, output_paths(save_path, len(urls))))
+
+    def fetch(target):
         try:
-            response = request_with_retry("GET", url_tail)
-            save_path_new = save_path.replace(".png", "_" + str(count) + ".png")
-            with open(save_path_new, 'wb') as file:
-                file.write(response.content)
-            count += 1
+            fetch_output(prefix, *target)
         except Exception as e:
             print(f"Download failed: {e}")
+
+    if len(targets) <= 1:
+        for target in targets:
+            fetch(target)
+    else:
+        list(get_download_executor().map(fetch, targets))
     return
 
+_download_executor = None
+_download_executor_lock = threading.Lock()
+
+def get_download_executor():
+    '''
+    所有任务共用的下载线程池，线程数为 download_parallelism
+    '''
+    global _download_executor
+    with _download_executor_lock:
+        if _download_executor is None:
+            _download_executor = ThreadPoolExecutor(max_workers=download_parallelism,
+                                                    thread_name_prefix="download")
+        return _download_executor
+
+def write_atomic(save_path, chunks):
+    '''
+    把数据块依次写入同目录下的临时文件，全部写完后改名为 save_path
+    中途出错时删除临时文件，输出目录里不会留下半张图片
+    '''
+    tmp_path = f"{save_path}.{uuid.uuid4().hex[:8]}.part"
+    try:
+        with open(tmp_path, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.replace(tmp_path, save_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def local_output_path(base_url, url_values):
+    '''
+    共享文件系统模式下，返回结果图片在本机上的路径
+    该服务器没有配置 comfy_local_dirs、路径越出 ComfyUI 目录或文件不存在时返回 None
+    '''
+    root = comfy_local_dirs.get(base_url.rstrip("/"))
+    if not root:
+        return None
+    query = parse.parse_qs(url_values)
+    if "filename" not in query:
+        return None
+    folder_type = query.get("type", ["output"])[0]
+    subfolder = query.get("subfolder", [""])[0]
+    type_dir = os.path.realpath(os.path.join(root, folder_type))
+    path = os.path.realpath(os.path.join(type_dir, subfolder, query["filename"][0]))
+    if not path.startswith(type_dir + os.sep) or not os.path.isfile(path):
+        return None
+    return path
+
+def fetch_output(prefix, url_values, save_path, max_retries=3):
+    '''
+    把一张结果图片保存到 save_path
+    能在共享文件系统上找到时直接复制，否则通过 /view 流式下载，传输中途断开时重新下载
+
+    返回:
+        str: "local"（本地复制）或 "http"
+    '''
+    local_path = local_output_path(prefix.split("/view?")[0], url_values)
+    if local_path is not None:
+        with open(local_path, "rb") as src:
+            write_atomic(save_path, iter(lambda: src.read(download_chunk_size), b""))
+        return "local"
+    for attempt in range(max_retries):
+        response = request_with_retry("GET", prefix + url_values, stream=True)
+        try:
+            with response:
+                write_atomic(save_path, response.iter_content(download_chunk_size))
+            return "http"
+        except requests.RequestException as e:
+            if attempt == max_retries - 1:
+                raise
+            print(f"Download interrupted, retrying ({attempt + 1}/{max_retries}): {e}")
+            time.sleep(backoff_delay(attempt))
+
 def get_image(filename, subfolder, folder_type):
     '''
     生成一个用于查看或下载图片的URL查询字符串
@@ -57,10 +336,12 @@ def get_image(filename, subfolder, folder_type):
     url_values = urllib.parse.urlencode(data)
     return url_values
 
-def upload_file(file, subfolder="", overwrite=False):
+def upload_file(file, subfolder="", overwrite=False, base_url=None):
     '''
     上传本地图片到ComfyUI服务器
+    file 可以是文件对象，也可以是 (文件名, 文件对象) 元组
     '''
+    base_url = base_url or url
     path = ""
     try:
         body = {"image": file}
@@ -71,7 +352,7 @@ def upload_file(file, subfolder="", overwrite=False):
         if subfolder:
             data["subfolder"] = subfolder
 
-        resp = request_with_retry("POST", url + "/upload/image", files=body, data=data)
+        resp = request_with_retry("POST", base_url + "/upload/image", files=body, data=data)
         if resp.status_code == 200:
             data = resp.json()
             path = data["name"]
@@ -83,50 +364,1378 @@ def upload_file(file, subfolder="", overwrite=False):
         print(f"Upload error: {error}")
     return path
 
-def queue_prompt(pid):
+def close_completion_watchers():
+    '''
+    关闭全部 websocket 监听器（运行结束时调用）
+    '''
+    with _watchers_lock:
+        for watcher in _watchers.values():
+            watcher.close()
+        _watchers.clear()
+
+def close_completion_watcher(base_url):
+    '''
+    关闭一台服务器的 websocket 监听器（服务器下线时由 HostPool 调用），
+    后台线程不再反复重连；服务器恢复后下一个任务重新建立连接
+    '''
+    with _watchers_lock:
+        watcher = _watchers.pop(base_url, None)
+    if watcher is not None:
+        watcher.close()
+
+def fetch_history(pid, base_url=None, info=None):
+    '''
+    查询一次任务历史，任务还没完成时返回 None，完成时返回输出图片的查询字符串列表
+    服务器记录的状态为 error（节点报错或被中断）时抛出 PromptExecutionError
+    info 为字典时，写入服务器记录的开始执行时间 execution_start（秒级时间戳），
+    以及按输出节点分组的查询字符串 outputs_by_node（批量模式据此把结果分回各张图片）
+    '''
+    base_url = base_url or url
+    response = request_with_retry("GET", base_url + "/history/" + pid)
+    history = json_codec.loads(response.content)  # 每个响应只解析一次
+    if pid not in history:
+        return None
+    status = history[pid].get("status", {})
+    messages = status.get("messages", [])
+    if info is not None:
+        for name, data in messages:
+            if name == "execution_start" and "timestamp" in data:
+                info["execution_start"] = data["timestamp"] / 1000
+    if status.get("status_str") == "error":
+        reason = "执行出错"
+        for name, data in messages:
+            if name == "execution_interrupted":
+                reason = "被中断"
+            elif name == "execution_error":
+                reason = f"执行出错: {data.get('node_type', '')} {data.get('exception_message', '')}".rstrip()
+        raise PromptExecutionError(f"任务 {pid} {reason}")
+    out_urls = []
+    outputs_by_node = {}
+    for node_id, node_output in history[pid]['outputs'].items():
+        if 'images' in node_output:
+            for image in node_output['images']:
+                url_values = get_image(image['filename'], image['subfolder'], image['type'])
+                out_urls.append(url_values)
+                outputs_by_node.setdefault(node_id, []).append(url_values)
+    if info is not None:
+        info["outputs_by_node"] = outputs_by_node
+    return out_urls
+
+def queue_prompt(pid, timeout=None, base_url=None, info=None):
+    '''
+    等待一个任务完成，返回输出图片的查询字符串列表
+    优先等待 websocket 推送的完成事件，事件到达后只查询一次 /history；
+    没有 websocket 或连接断开时退回轮询，轮询间隔指数增长
+    超过 timeout 秒仍未完成时从服务器取消该任务并抛出 PromptTimeout
+    info 见 fetch_history
+    '''
+    print("wait", time.time())
+    timeout = prompt_timeout if timeout is None else timeout
+    deadline = time.time() + timeout
+    watcher = get_completion_watcher(base_url)
+    delay = poll_min_delay
+    while True:
+        # 先等待完成事件（或轮询间隔），再查询结果
+        remaining = deadline - time.time()
+        if watcher is not None and watcher.connected.is_set():
+            watcher.wait(pid, max(0, min(remaining, ws_recheck_interval)))
+        else:
+            time.sleep(max(0, min(delay, remaining)))
+            delay = min(delay * 2, poll_max_delay)
+
+        try:
+            out_urls = fetch_history(pid, base_url, info)
+            if out_urls is not None:
+                print("generate", time.time())
+                return out_urls
+        except HOST_ERRORS + (PromptExecutionError,):
+            raise  # 服务器已经连不上（交给调用方换服务器）或任务已经失败
+        except Exception as e:
+            print(f"Polling error, retrying: {e}")
+
+        if time.time() >= deadline:
+            result = cancel_prompt(pid, base_url)
+            print(f"⏰ 任务 {pid} 超过 {timeout}s 仍未完成，取消结果: {result}")
+            raise PromptTimeout(f"任务 {pid} 超过 {timeout}s 仍未完成", started=result != "deleted")
+
+def push_prompt(prompt, base_url=None):
+    '''
+    提交任务，返回 prompt_id
+    prompt 为工作流字典，或 prompt_body 生成的已序列化的请求体（bytes）
+    '''
+    base_url = base_url or url
+    if isinstance(prompt, bytes):
+        data = prompt
+    else:
+        with run_profiler.stage("提交任务: JSON 编码"):
+            data = json_codec.dumps({"prompt": prompt, "client_id": client_id})
+    with run_profiler.stage("提交任务: HTTP 请求"):
+        response = request_with_retry("POST", base_url + '/prompt', data=data)
+    result = json_codec.loads(response.content)  # 每个响应只解析一次
+    print(result)
+    return result['prompt_id']
+
+_prompt_templates = {} # (id(工作流), 图片节点ID) -> (工作流, PromptTemplate)，保留工作流的引用避免 id 被复用
+_prompt_templates_lock = threading.Lock()
+prompt_template_limit = 8 # 最多保留的请求体模板数（按工作流）
+
+def prompt_body(workflow, image_node_id, server_image):
+    '''
+    图生图任务的请求体（bytes）：每个工作流只序列化一次成模板，每张图片只替换图片字段
+    结果与 push_prompt(patch_image_input(workflow, image_node_id, server_image)) 提交的内容相同
+    '''
+    key = (id(workflow), image_node_id)
+    with _prompt_templates_lock:
+        entry = _prompt_templates.get(key)
+    if entry is None or entry[0] is not workflow or entry[1].backend != json_codec.backend:
+        with run_profiler.stage("提交任务: JSON 编码"):
+            marker = f"@@png2png-image-{uuid.uuid4().hex}@@"
+            body = {"prompt": patch_image_input(workflow, image_node_id, marker), "client_id": client_id}
+            entry = (workflow, json_codec.PromptTemplate(body, marker))
+        with _prompt_templates_lock:
+            if len(_prompt_templates) >= prompt_template_limit:
+                _prompt_templates.pop(next(iter(_prompt_templates)))
+            _prompt_templates[key] = entry
+    return entry[1].render(server_image)
+
+# ============ 任务完成检测 ============
+
+class CompletionWatcher:
+    '''
+    监听 ComfyUI 的 /ws 事件来等待任务完成
+    后台线程持续接收 executing / execution_success / execution_error 消息，
+    某个任务结束时立即唤醒等待它的线程，不再反复请求 /history
+    每个任务只记录一个结束事件：ComfyUI 会先后发送 execution_success 和 executing(node=None)，
+    已被取走的任务之后再到达的结束事件直接丢弃；没人取走的事件最多保留 finished_limit 个
+    '''
+    finished_limit = 1000
+
+    def __init__(self, base_url, cid=None):
+        if "://" not in base_url:
+            base_url = "http://" + base_url
+        scheme, rest = base_url.split("://", 1)
+        ws_scheme = "wss" if scheme == "https" else "ws"
+        self.client_id = cid or client_id
+        self.ws_url = f"{ws_scheme}://{rest.rstrip('/')}/ws?clientId={self.client_id}"
+        self.connected = threading.Event()
+        self._lock = threading.Lock()
+        self._waiters = {}   # prompt_id -> threading.Event
+        self._finished = {}  # prompt_id -> 结束状态（success / error / interrupted），按到达顺序
+        self._consumed = {}  # 最近已被 wait 取走结束状态的 prompt_id（按取走顺序，最多 finished_limit 个）
+        self._ws = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self, connect_timeout=5):
+        '''
+        启动后台线程，返回是否在 connect_timeout 秒内连上了服务器
+        '''
+        self._thread.start()
+        return self.connected.wait(connect_timeout)
+
+    def close(self):
+        self._closed = True
+        self._disconnected()
+        if self._ws is not None:
+            try:
+                self._ws.abort()  # 直接断开连接，唤醒阻塞在 recv 上的后台线程
+            except Exception:
+                pass
+
+    def _run(self):
+        retry_delay = 1
+        while not self._closed:
+            try:
+                self._ws = websocket.create_connection(self.ws_url, timeout=10)
+                self._ws.settimeout(ws_recheck_interval)
+                self.connected.set()
+                retry_delay = 1
+                while not self._closed:
+                    try:
+                        message = self._ws.recv()
+                    except websocket.WebSocketTimeoutException:
+                        continue
+                    if isinstance(message, str):  # 二进制消息是预览图，忽略
+                        self._dispatch(json_codec.loads(message))
+            except Exception as e:
+                if not self._closed:
+                    print(f"⚠️  websocket 连接中断，{retry_delay}s 后重连: {e}")
+            self._disconnected()
+            if not self._closed:
+                time.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, 30)
+
+    def _disconnected(self):
+        '''
+        连接断开或关闭：唤醒全部等待中的线程，让它们立即改为轮询 /history，不必等到 ws_recheck_interval
+        '''
+        self.connected.clear()
+        with self._lock:
+            waiters = list(self._waiters.values())
+        for event in waiters:
+            event.set()
+
+    def _dispatch(self, message):
+        msg_type = message.get("type")
+        data = message.get("data") or {}
+        pid = data.get("prompt_id")
+        if not pid:
+            return
+        if msg_type == "executing" and data.get("node") is None:
+            status = "success"
+        elif msg_type == "execution_success":
+            status = "success"
+        elif msg_type == "execution_error":
+            status = "error"
+        elif msg_type == "execution_interrupted":
+            status = "interrupted"
+        else:
+            return
+        with self._lock:
+            if pid in self._consumed or pid in self._finished:
+                return
+            self._finished[pid] = status
+            self._trim(self._finished)
+            event = self._waiters.get(pid)
+        if event is not None:
+            event.set()
+
+    def _trim(self, records):
+        while len(records) > self.finished_limit:
+            del records[next(iter(records))]
+
+    def _take(self, pid):
+        status = self._finished.pop(pid, None)
+        if status is not None:
+            self._consumed[pid] = True
+            self._trim(self._consumed)
+        return status
+
+    def wait(self, pid, timeout):
+        '''
+        等待任务结束事件，返回结束状态；超时或连接断开时返回 None
+        '''
+        with self._lock:
+            if pid in self._finished:
+                return self._take(pid)
+            event = self._waiters.setdefault(pid, threading.Event())
+        event.wait(timeout)
+        with self._lock:
+            self._waiters.pop(pid, None)
+            return self._take(pid)
+
+_watchers = {}
+_watchers_lock = threading.Lock()
+
+def get_completion_watcher(base_url=None):
+    '''
+    返回该服务器的 websocket 监听器（每个服务器只建立一个连接）
+    不可用时返回 None，调用方退回轮询
+    '''
+    base_url = base_url or url
+    if completion_mode == "poll" or websocket is None:
+        if completion_mode == "ws" and websocket is None:
+            raise RuntimeError("completion_mode='ws' 需要安装 websocket-client")
+        return None
+    with _watchers_lock:
+        watcher = _watchers.get(base_url)
+        if watcher is None:
+            watcher = CompletionWatcher(base_url)
+            if not watcher.start() and completion_mode == "auto":
+                print("⚠️  websocket 连接失败，先使用 /history 轮询")
+            _watchers[base_url] = watcher
+    return watcher
+
+# ============ 上传缓存 ============
+
+def file_sha256(path, chunk_size=1 << 20):
+    '''
+    分块计算文件内容的 sha256
+    '''
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+class UploadCache:
+    '''
+    记录 (图片内容哈希, 服务器) -> 服务器上的图片路径
+    同一张图片在同一台服务器上只上传一次，多个工作流直接引用已上传的文件
+
+    索引保存在 JSON 文件中，跨运行复用。每台服务器在本次运行中第一次查询时，
+    会检查最近上传的一个文件是否还在服务器的 input 目录里，
+    不在说明 input 目录被清空过，该服务器的全部记录作废
+    '''
+    def __init__(self, cache_file=upload_cache_file, save_every=50):
+        self.cache_file = cache_file
+        self.save_every = save_every
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()  # 保证索引文件按顺序写入，后保存的内容不会被先保存的覆盖
+        self._entries = {}  # server -> {digest: {"path": ..., "time": ...}}
+        self._verified = set()
+        self._dirty = 0
+        self.hits = 0
+        self.misses = 0
+        if os.path.exists(cache_file):
+            try:
+                with open(cache_file, "r", encoding="utf-8") as f:
+                    self._entries = json.load(f)
+            except Exception as e:
+                print(f"⚠️  上传缓存读取失败，重新建立: {e}")
+
+    def get(self, digest, server):
+        if server not in self._verified:
+            self._verify_server(server)
+        with self._lock:
+            entry = self._entries.get(server, {}).get(digest)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry["path"]
+
+    def put(self, digest, server, server_path):
+        with self._lock:
+            self._entries.setdefault(server, {})[digest] = {"path": server_path, "time": time.time()}
+            self._dirty += 1
+            need_save = self._dirty >= self.save_every
+        if need_save:
+            self.save()
+
+    def invalidate(self, server, digest=None):
+        '''
+        删除某台服务器的一条记录；digest 为 None 时删除该服务器的全部记录
+        '''
+        with self._lock:
+            if digest is None:
+                self._entries.pop(server, None)
+            else:
+                self._entries.get(server, {}).pop(digest, None)
+            self._dirty += 1
+
+    def _verify_server(self, server):
+        with self._lock:
+            entries = self._entries.get(server)
+            self._verified.add(server)
+            if not entries:
+                return
+            newest = max(entries.values(), key=lambda e: e["time"])
+        subfolder, _, filename = newest["path"].rpartition("/")
+        try:
+            request_with_retry("GET", server + "/view?" + get_image(filename, subfolder, "input"),
+                               max_retries=1, stream=True).close()
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                print(f"♻️  服务器 {server} 的 input 目录已被清空，作废 {len(entries)} 条上传缓存")
+                self.invalidate(server)
+        except Exception as e:
+            print(f"⚠️  上传缓存校验失败（保留缓存）: {e}")
+
+    def save(self):
+        '''
+        写入索引文件；多个线程同时保存时依次写入，每次使用独立的临时文件
+        保存失败只打印警告（下次再保存），不影响已经上传成功的任务
+        '''
+        with self._save_lock:
+            with self._lock:
+                data = json.dumps(self._entries, ensure_ascii=False)
+                dirty, self._dirty = self._dirty, 0
+            tmp_file = f"{self.cache_file}.{uuid.uuid4().hex[:8]}.tmp"
+            try:
+                with open(tmp_file, "w", encoding="utf-8") as f:
+                    f.write(data)
+                os.replace(tmp_file, self.cache_file)
+            except OSError as e:
+                print(f"⚠️  上传缓存保存失败: {e}")
+                with self._lock:
+                    self._dirty += dirty
+                try:
+                    os.remove(tmp_file)
+                except OSError:
+                    pass
+
+def upload_image_cached(path, base_url=None, prep=None):
+    '''
+    上传图片，命中缓存时直接返回服务器上已有的路径
+    prep 为 preprocess_params 返回的预处理参数时，上传的是预处理后的图片
+
+    返回:
+        tuple: (服务器路径, 是否命中缓存)
+    '''
+    base_url = base_url or url
+    path = prepare_upload(path, prep)
+    if upload_cache is None:
+        with open(path, 'rb') as f:
+            return upload_file(f, "", True, base_url), False
+
+    digest = input_digest(path)
+    cached = upload_cache.get(digest, base_url)
+    if cached:
+        return cached, True
+    # 以内容哈希命名，内容相同的图片在服务器上只有一份，不同目录下的同名图片也不会互相覆盖
+    name = digest[:32] + os.path.splitext(path)[1].lower()
+    with open(path, 'rb') as f:
+        server_path = upload_file((name, f), "", True, base_url)
+    if server_path:
+        upload_cache.put(digest, base_url, server_path)
+    return server_path, False
+
+def invalidate_cached_upload(path, base_url, prep=None):
+    '''
+    作废一张图片在某台服务器上的上传缓存记录（按实际上传的文件计算哈希）
+    '''
+    upload_cache.invalidate(base_url, input_digest(prepare_upload(path, prep)))
+
+# ============ 生成结果缓存 ============
+
+class ResultCache:
+    '''
+    生成结果缓存：规范化后的任务和输入图片内容都相同时，直接复用上次下载的输出图片，不再提交到服务器
+    每个条目是缓存目录下以键命名的子目录（0.png、1.png ...），目录的修改时间就是最近使用时间；
+    总大小超过 budget 字节时删除最久没用过的条目（LRU）。条目信息启动时扫描目录得到，没有单独的索引文件，
+    运行中断也不会出现索引与文件不一致
+    '''
+    def __init__(self, cache_dir=result_cache_dir, budget=result_cache_budget):
+        self.cache_dir = cache_dir
+        self.budget = budget
+        self._lock = threading.Lock()
+        self._entries = {}  # 键 -> [字节数, 最近使用时间]
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        with os.scandir(cache_dir) as it:
+            for entry in it:
+                if entry.name.endswith(".tmp"):
+                    shutil.rmtree(entry.path, ignore_errors=True)  # 上次运行中断时留下的临时目录
+                elif entry.is_dir():
+                    with os.scandir(entry.path) as files:
+                        size = sum(f.stat().st_size for f in files if f.is_file())
+                    self._entries[entry.name] = [size, entry.stat().st_mtime]
+                    self._size += size
+        with self._lock:
+            self._evict()
+
+    @property
+    def size(self):
+        return self._size
+
+    def get(self, key, out_path):
+        '''
+        命中时把缓存的图片复制到 out_path 对应的输出路径（与 download_image 的命名相同）
+
+        返回:
+            int: 恢复的图片数量；没有命中时返回 None
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None:
+            entry_dir = os.path.join(self.cache_dir, key)
+            try:
+                names = sorted(os.listdir(entry_dir), key=lambda name: int(os.path.splitext(name)[0]))
+                for name, dest in zip(names, output_paths(out_path, len(names))):
+                    with open(os.path.join(entry_dir, name), "rb") as f:
+                        write_atomic(dest, iter(lambda: f.read(download_chunk_size), b""))
+                os.utime(entry_dir)
+                with self._lock:
+                    entry[1] = time.time()
+                    self.hits += 1
+                return len(names)
+            except (OSError, ValueError):
+                # 条目被其他进程淘汰或损坏
+                with self._lock:
+                    self._drop(key)
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, out_path, count):
+        '''
+        把刚下载的 count 张输出图片存入缓存；有图片没下载成功时不缓存
+        '''
+        sources = output_paths(out_path, count)
+        if not sources or not all(os.path.isfile(path) for path in sources):
+            return
+        tmp_dir = os.path.join(self.cache_dir, f"{key}.{uuid.uuid4().hex[:8]}.tmp")
+        size = 0
+        try:
+            os.makedirs(tmp_dir)
+            for i, src in enumerate(sources):
+                dest = os.path.join(tmp_dir, f"{i}{os.path.splitext(src)[1]}")
+                shutil.copyfile(src, dest)
+                size += os.path.getsize(dest)
+            os.rename(tmp_dir, os.path.join(self.cache_dir, key))
+        except OSError:
+            # 同一个键已经被其他线程或进程存入
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = [size, time.time()]
+            self._size += size
+            self._evict()
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry[0]
+
+    def _evict(self):
+        if self._size <= self.budget:
+            return
+        for key in sorted(self._entries, key=lambda k: self._entries[k][1]):
+            if self._size <= self.budget:
+                break
+            self._drop(key)
+            shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+
+_prompt_key_memo = None # (工作流, 图片节点ID, 键)：同一个工作流的全部图片共用，工作流只序列化一次
+
+def prompt_cache_key(workflow, image_node_id=None):
+    '''
+    工作流部分的键：图片输入换成空字符串后，按固定的键顺序紧凑序列化再计算 sha256
+    '''
+    global _prompt_key_memo
+    memo = _prompt_key_memo
+    if memo is not None and memo[0] is workflow and memo[1] == image_node_id:
+        return memo[2]
+    prompt = patch_image_input(workflow, image_node_id, "") if image_node_id is not None else workflow
+    canonical = json.dumps(prompt, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    key = hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+    _prompt_key_memo = (workflow, image_node_id, key)
+    return key
+
+def result_cache_key(workflow, image_node_id=None, path=None):
+    '''
+    结果缓存的键：工作流部分的键 + 输入图片内容哈希 + 上传前预处理参数（文生图只有工作流部分）
+    服务器上的图片文件名不参与计算，同一张图片换一台服务器或重新上传后仍能命中；未开启缓存时返回 None
+    '''
+    if result_cache is None:
+        return None
+    parts = [prompt_cache_key(workflow, image_node_id)]
+    if path is not None:
+        parts += [input_digest(path), json.dumps(preprocess_params(workflow, image_node_id), sort_keys=True)]
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+def restore_cached_result(key, out_path):
+    '''
+    结果缓存命中时恢复输出图片
+
+    返回:
+        dict: 与 run_prompt 相同格式的耗时，host 为 "cache"；没有命中时返回 None
+    '''
+    if key is None or result_cache is None:
+        return None
+    start = time.time()
+    count = result_cache.get(key, out_path)
+    if count is None:
+        return None
+    elapsed = time.time() - start
+    print(f"♻️  结果缓存命中: {os.path.basename(out_path)}")
+    return {"host": "cache", "submit": 0.0, "generate": 0.0, "download": elapsed, "total": elapsed,
+            "outputs": count, "cache": "hit"}
+
+def cache_result(key, out_path, timings, count=None):
+    '''
+    任务完成后把输出图片存入结果缓存，并在耗时中标记为未命中（写入运行日志）
+    '''
+    if key is None or result_cache is None:
+        return
+    timings["cache"] = "miss"
+    count = timings.get("outputs") if count is None else count
+    if count:
+        result_cache.put(key, out_path, count)
+
+# ============ 上传前预处理 ============
+
+# 这些节点把输入图片缩放到 width x height，图片只被它们使用时可以先在本地缩小
+RESIZE_NODE_HINTS = ("Scale", "Resize")
+PREPROCESS_MODES = ("1", "L", "LA", "P", "RGB", "RGBA")
+PREPROCESS_EXTS = {"jpeg": ".jpg", "png": ".png", "webp": ".webp"}
+preprocess_stats = {"images": 0, "cache_hits": 0, "bytes_in": 0, "bytes_out": 0}
+_prepared_paths = {}  # (源路径, 修改时间, 大小, 参数) -> 上传用的路径，同一次运行中不再重复计算哈希
+_prepared_lock = threading.Lock()
+
+def workflow_target_size(workflow, image_node_id):
+    '''
+    根据图片输入节点的下游推断需要的最小尺寸 (宽, 高)，0 表示该方向不限制
+    只有图片输入节点的全部输出都直接连到带 width/height 的缩放节点时才返回尺寸，否则返回 None（不能缩小）
+    '''
+    target = None
+    for node in workflow.values():
+        if not isinstance(node, dict):
+            continue
+        inputs = node.get("inputs", {})
+        if not any(isinstance(v, list) and len(v) == 2 and str(v[0]) == str(image_node_id)
+                   for v in inputs.values()):
+            continue
+        width, height = inputs.get("width"), inputs.get("height")
+        if (not any(hint in node.get("class_type", "") for hint in RESIZE_NODE_HINTS)
+                or not isinstance(width, int) or not isinstance(height, int) or width < 0 or height < 0
+                or (width == 0 and height == 0)):
+            return None
+        target = (max(width, target[0]), max(height, target[1])) if target else (width, height)
+    return target
+
+def preprocess_params(workflow, image_node_id):
+    '''
+    返回该工作流的上传前预处理参数，未启用或没有安装 Pillow 时返回 None
+    '''
+    if preprocess_format is None or Image is None:
+        return None
+    size = preprocess_size or workflow_target_size(workflow, image_node_id)
+    return {"format": preprocess_format.lower(), "quality": preprocess_quality,
+            "size": list(size) if size else None}
+
+def preprocess_image(src, dest_stem, prep):
+    '''
+    按 prep 缩小并转码一张图片，写入 dest_stem + 扩展名
+    缩放后的图片仍然覆盖目标尺寸（下游节点只会继续缩小，不会放大），按 EXIF 方向旋转，保留透明通道（LoadImage 用作遮罩）
+
+    返回:
+        str: 生成的文件路径
+        None: 图片模式不支持，调用方直接上传原图
+    '''
+    with Image.open(src) as img:
+        img = ImageOps.exif_transpose(img)
+        if img.mode not in PREPROCESS_MODES:
+            return None
+        if img.mode == "P":
+            img = img.convert("RGBA" if "transparency" in img.info else "RGB")
+        if prep["size"]:
+            width, height = prep["size"]
+            scale = max(width / img.width if width else 0, height / img.height if height else 0)
+            if scale < 1:
+                img = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))),
+                                 Image.LANCZOS)
+        fmt = prep["format"]
+        if fmt == "jpeg" and img.mode in ("LA", "RGBA"):
+            fmt = "png"  # JPEG 不支持透明通道
+        if fmt == "jpeg" and img.mode != "L":
+            img = img.convert("RGB")
+        dest = dest_stem + PREPROCESS_EXTS.get(fmt, "." + fmt)
+        tmp_path = f"{dest}.{uuid.uuid4().hex[:8]}.part"
+        try:
+            img.save(tmp_path, format=fmt.upper(), quality=prep["quality"])
+            os.replace(tmp_path, dest)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+    return dest
+
+def prepare_upload(path, prep):
+    '''
+    返回实际要上传的文件路径
+    转码结果缓存在 preprocess_cache_dir 中，文件名由源文件哈希和参数决定，再次运行时直接复用；
+    转码失败或结果比原图还大时上传原图
+    '''
+    if not prep:
+        return path
+    st = os.stat(path)
+    params = json.dumps(prep, sort_keys=True)
+    memo_key = (path, st.st_mtime_ns, st.st_size, params)
+    with _prepared_lock:
+        if memo_key in _prepared_paths:
+            return _prepared_paths[memo_key]
+
+    key = hashlib.sha256(f"{input_digest(path)}:{params}".encode()).hexdigest()[:32]
+    stem = os.path.join(preprocess_cache_dir, key)
+    # 透明图片转 JPEG 时会改存为 PNG，两种扩展名都要找
+    prepared = next((stem + e for e in set(PREPROCESS_EXTS.values()) if os.path.exists(stem + e)), None)
+    with _prepared_lock:
+        preprocess_stats["images"] += 1
+        preprocess_stats["bytes_in"] += st.st_size
+        if prepared:
+            preprocess_stats["cache_hits"] += 1
+    if prepared is None:
+        try:
+            os.makedirs(preprocess_cache_dir, exist_ok=True)
+            prepared = preprocess_image(path, stem, prep)
+        except Exception as e:
+            print(f"⚠️  预处理失败，上传原图 {path}: {e}")
+    if not prepared or os.path.getsize(prepared) >= st.st_size:
+        prepared = path
+    with _prepared_lock:
+        preprocess_stats["bytes_out"] += os.path.getsize(prepared)
+        _prepared_paths[memo_key] = prepared
+    return prepared
+
+# ============ 多服务器调度 ============
+
+# 这些异常说明服务器本身不可用，任务应该换一台服务器重新执行
+HOST_ERRORS = (requests.ConnectionError, requests.Timeout)
+
+class HostPool:
+    '''
+    多台 ComfyUI 服务器组成的服务器池
+    每个任务派给 /queue 中排队最少的服务器；上传、提交、等待、下载都在同一台服务器上完成
+    连接失败的服务器移出轮换，retry_down_after 秒后重新做健康检查
+    每台服务器带一个熔断器：任务超时等失败连续 breaker_threshold 次后同样移出轮换；
+    恢复后处于半开状态，再失败一次立即重新熔断，冷却时间翻倍（最长 max_down_after 秒），成功一次后复位
+    '''
+    def __init__(self, host_list, queue_ttl=1.0, retry_down_after=60, breaker_threshold=3, max_down_after=600):
+        self.hosts = [h.rstrip("/") for h in host_list]
+        self.queue_ttl = queue_ttl
+        self.retry_down_after = retry_down_after
+        self.breaker_threshold = breaker_threshold
+        self.max_down_after = max_down_after
+        self._lock = threading.Lock()
+        self._state = {
+            h: {"up": None, "backlog": 0, "checked": 0.0, "dispatched": 0, "inflight": 0, "down_until": 0.0,
+                "failures": 0, "trips": 0}
+            for h in self.hosts
+        }
+
+    def check_health(self, host):
+        '''
+        查询一次服务器的 /queue，更新排队数量；失败时把服务器移出轮换
+        '''
+        try:
+            data = request_with_retry("GET", host + "/queue", max_retries=1).json()
+            backlog = len(data.get("queue_running", [])) + len(data.get("queue_pending", []))
+        except Exception as e:
+            self.mark_failed(host, e)
+            return False
+        with self._lock:
+            state = self._state[host]
+            if state["up"] is False:
+                print(f"✅ 服务器 {host} 恢复，重新加入轮换")
+            state.update(up=True, backlog=backlog, checked=time.time(), dispatched=0)
+        return True
+
+    def check_all(self):
+        '''
+        检查全部服务器，返回可用的服务器列表
+        '''
+        return [h for h in self.hosts if self.check_health(h)]
+
+    def _claim_checks(self, now):
+        '''
+        找出需要重新检查的服务器，并先占位，避免多个线程同时检查同一台
+        '''
+        to_check = []
+        with self._lock:
+            for host, state in self._state.items():
+                if state["up"] and now - state["checked"] > self.queue_ttl:
+                    state["checked"] = now
+                    to_check.append(host)
+                elif not state["up"] and now >= state["down_until"]:
+                    state["down_until"] = now + self.retry_down_after
+                    to_check.append(host)
+        return to_check
+
+    def acquire(self, wait_timeout=300):
+        '''
+        选出当前排队最少的服务器
+        排队数 = 上次查询到的 /queue 长度 + 之后本客户端新派发、还没有结束的任务数（结束的任务已不在服务器上，
+        不扣掉的话快的服务器在下次查询前看起来反而更忙，任务会被平均分配而不是按速度分配）
+        所有服务器都不可用时等待恢复，超过 wait_timeout 秒抛出 RuntimeError
+        '''
+        give_up_at = time.time() + wait_timeout
+        while True:
+            for host in self._claim_checks(time.time()):
+                self.check_health(host)
+            with self._lock:
+                candidates = [h for h in self.hosts if self._state[h]["up"] is True]
+                if candidates:
+                    host = min(candidates, key=lambda h: self._state[h]["backlog"] + self._state[h]["dispatched"])
+                    self._state[host]["dispatched"] += 1
+                    self._state[host]["inflight"] += 1
+                    return host
+                checking = any(self._state[h]["up"] is None for h in self.hosts)
+                next_retry = min(self._state[h]["down_until"] for h in self.hosts)
+            if time.time() >= give_up_at:
+                raise RuntimeError("没有可用的 ComfyUI 服务器")
+            if checking:
+                time.sleep(0.1)  # 其他线程正在做首次健康检查
+            else:
+                time.sleep(min(max(0.1, next_retry - time.time()), 5))
+
+    def release(self, host):
+        with self._lock:
+            self._state[host]["inflight"] -= 1
+            self._state[host]["dispatched"] -= 1
+
+    def mark_failed(self, host, error):
+        '''
+        立即熔断：把服务器移出轮换，连续熔断时冷却时间翻倍
+        '''
+        with self._lock:
+            state = self._state[host]
+            cooldown = min(self.retry_down_after * 2 ** state["trips"], self.max_down_after)
+            if state["up"] is not False:
+                print(f"⚠️  服务器 {host} 不可用，移出轮换 {cooldown}s: {error}")
+            state["trips"] += 1
+            state.update(up=False, down_until=time.time() + cooldown, failures=self.breaker_threshold - 1)
+        close_completion_watcher(host)
+
+    def record_failure(self, host, error):
+        '''
+        记录一次任务失败（超时、请求超时等），连续失败达到阈值时熔断
+        '''
+        with self._lock:
+            state = self._state[host]
+            state["failures"] += 1
+            tripped = state["failures"] >= self.breaker_threshold
+        if tripped:
+            self.mark_failed(host, error)
+
+    def record_success(self, host):
+        with self._lock:
+            self._state[host].update(failures=0, trips=0)
+
+def get_host_pool():
+    global host_pool
+    if host_pool is None:
+        host_pool = HostPool(hosts or [url], breaker_threshold=breaker_threshold)
+    return host_pool
+
+def report_host_error(pool, host, error):
+    '''
+    把一次失败计入服务器的熔断器：连接失败立即熔断，超时类错误累计到阈值才熔断
+    排在卡住的任务后面、还没开始执行就超时的任务不计入
+    '''
+    if isinstance(error, requests.ConnectionError):
+        pool.mark_failed(host, error)
+    elif getattr(error, "started", True):
+        pool.record_failure(host, error)
+
+def run_with_failover(job, pool=None):
+    '''
+    从服务器池选一台服务器执行 job(host)
+    服务器连接失败时把它移出轮换，任务重新派给其他服务器，最多尝试服务器数量次；
+    任务超时（已在服务器上取消）时重新派发，最多 prompt_retries 次
+    '''
+    pool = pool or get_host_pool()
+    host_failures = 0
+    timeouts = 0
+    while True:
+        host = pool.acquire()
+        try:
+            result = job(host)
+            pool.record_success(host)
+            return result
+        except PromptTimeout as e:
+            report_host_error(pool, host, e)
+            timeouts += 1
+            if timeouts > prompt_retries:
+                raise
+            print(f"🔁 任务超时，重新派发（第 {timeouts}/{prompt_retries} 次）: {e}")
+        except HOST_ERRORS as e:
+            report_host_error(pool, host, e)
+            host_failures += 1
+            if host_failures >= max(1, len(pool.hosts)):
+                raise
+            print(f"🔁 任务重新派发到其他服务器: {e}")
+        finally:
+            pool.release(host)
+
+def run_prompt(prompt, out_path, host):
+    '''
+    在指定服务器上提交任务、等待完成并下载结果
+
+    返回:
+        dict: 各阶段耗时（submit / queue_wait / generate / download / total）和所用服务器 host
+              服务器没有返回开始执行时间时没有 queue_wait
+    '''
+    total_start = time.time()
+    submit_start = time.time()
+    prompt_id = push_prompt(prompt, host)
+    submit_end = time.time()
+
+    generate_start = time.time()
+    info = {}
+    url_values = queue_prompt(prompt_id, base_url=host, info=info)
+    generate_end = time.time()
+
+    download_start = time.time()
+    download_image(host + "/view?", url_values, out_path)
+    download_end = time.time()
+    total_end = time.time()
+
+    timings = {
+        "host": host,
+        "submit": submit_end - submit_start,
+        "generate": generate_end - generate_start,
+        "download": download_end - download_start,
+        "total": total_end - total_start,
+        "outputs": len(url_values),
+    }
+    if "execution_start" in info:
+        # 服务器时钟与本机可能有偏差，限制在 [0, generate] 之间
+        timings["queue_wait"] = min(max(0.0, info["execution_start"] - submit_end), timings["generate"])
+    return timings
+
+# ============ 断点续跑日志 ============
+
+class CheckpointJournal:
+    '''
+    只追加的完成记录，每行一个 JSON: {"workflow": ..., "input": ..., "output": ...}
+    写入后每 fsync_every 条或每 fsync_interval 秒统一 fsync 一次，兼顾安全和速度
+    启动时读入内存集合，判断某张图片是否已完成是 O(1) 的
+    文生图工作流的 input 记为空字符串
+    '''
+    def __init__(self, path=journal_file, fsync_every=50, fsync_interval=5.0):
+        self.path = path
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self._lock = threading.Lock()
+        self._done = set()
+        self._pending = 0
+        self._last_sync = time.time()
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # 崩溃时写了一半的最后一行
+                    self._done.add((entry["workflow"], entry["input"]))
+        self._file = open(path, "a", encoding="utf-8")
+
+    def __len__(self):
+        return len(self._done)
+
+    def is_done(self, workflow_name, input_path=""):
+        return (workflow_name, input_path) in self._done
+
+    def record(self, workflow_name, input_path, output_path):
+        line = json.dumps({"workflow": workflow_name, "input": input_path, "output": output_path},
+                          ensure_ascii=False)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._done.add((workflow_name, input_path))
+            self._pending += 1
+            if self._pending >= self.fsync_every or time.time() - self._last_sync >= self.fsync_interval:
+                self._sync()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._pending = 0
+        self._last_sync = time.time()
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._sync()
+                self._file.close()
+
+# ============ 运行日志 ============
+
+# 每个工作流日志（<工作流>.json.csv）的列见 run_logs.RUN_LOG_FIELDS
+# 错误工作流日志（error_workflows.csv）的列
+ERROR_LOG_FIELDS = ['工作流文件名', '错误时间', '工作流类型', '处理阶段', '错误信息']
+
+class RunLogSink:
+    '''
+    本次运行的日志写入器
+    调用方只把一行数据放进队列，由后台线程写文件，写日志不会阻塞上传/提交/下载；
+    每个日志文件在运行期间只打开一次，攒够 flush_every 行或每 flush_interval 秒刷新一次
+    格式由文件扩展名决定：.jsonl 每行写一个 JSON 对象，其他写入与原来相同的 CSV 行
+    '''
+    def __init__(self, flush_every=100, flush_interval=1.0, max_open_files=32):
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.max_open_files = max_open_files
+        self._queue = queue.Queue()
+        self._files = {}  # path -> [文件对象, csv writer 或 None, 未刷新行数]
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, log_file, row, fields=RUN_LOG_FIELDS, header=False):
+        '''
+        追加一行日志；header 为 True 时，CSV 文件第一次创建时先写入表头
+        '''
+        if self._closed:
+            raise RuntimeError("日志写入器已关闭")
+        self._queue.put((log_file, row, fields, header))
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._queue.put(None)
+            self._thread.join()
+
+    def _open(self, log_file, fields, header):
+        entry = self._files.get(log_file)
+        if entry is None:
+            if len(self._files) >= self.max_open_files:
+                # 关闭最早打开的文件（dict 保持插入顺序）
+                oldest = next(iter(self._files))
+                self._files.pop(oldest)[0].close()
+            is_new = not os.path.exists(log_file) or os.path.getsize(log_file) == 0
+            f = open(log_file, 'a', newline='', encoding='utf-8')
+            writer = None if log_file.endswith(".jsonl") else csv.writer(f)
+            if writer is not None and header and is_new:
+                writer.writerow(fields)
+            entry = self._files[log_file] = [f, writer, 0]
+        return entry
+
+    def _write_row(self, log_file, row, fields, header):
+        entry = self._open(log_file, fields, header)
+        if entry[1] is not None:
+            entry[1].writerow(row)
+        else:
+            record = dict(zip(fields, row))
+            for key in RUN_LOG_TIMING_FIELDS:
+                if record.get(key) not in (None, ""):
+                    record[key] = float(record[key])
+            entry[0].write(json.dumps(record, ensure_ascii=False) + "\n")
+        entry[2] += 1
+
+    def _flush(self, force=False):
+        for entry in self._files.values():
+            if entry[2] and (force or entry[2] >= self.flush_every):
+                entry[0].flush()
+                entry[2] = 0
+
+    def _run(self):
+        last_flush = time.time()
+        while True:
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                item = False
+            if item is None:
+                break
+            if item:
+                try:
+                    with run_profiler.stage("写运行日志"):
+                        self._write_row(*item)
+                except Exception as e:
+                    print(f"⚠️  写日志失败 {item[0]}: {e}")
+            if time.time() - last_flush >= self.flush_interval:
+                self._flush(force=True)
+                last_flush = time.time()
+            else:
+                self._flush()
+        self._flush(force=True)
+        for entry in self._files.values():
+            entry[0].close()
+        self._files.clear()
+
+def get_log_sink():
+    global log_sink
+    if log_sink is None:
+        log_sink = RunLogSink()
+        atexit.register(log_sink.close)
+    return log_sink
+
+def summarize_run_logs(patterns):
+    '''
+    汇总多个运行日志的耗时列
+    patterns 为 glob 模式列表（如 "*.json.csv"），返回每个日志一行的统计和全部日志的总计
+
+    返回:
+        list[dict]: 每个字典包含 log / success / fail 以及各耗时列的 mean / p50 / p95 / max
+    '''
+    files = sorted({f for pattern in patterns for f in glob.glob(pattern)})
+    summaries = []
+    all_records = []
+
+    def summarize(name, records):
+        summary = {
+            "log": name,
+            "success": sum(1 for r in records if r.get("status") == "success"),
+            "fail": sum(1 for r in records if r.get("status") == "fail"),
+            "cache_hit": sum(1 for r in records if r.get("cache") == "hit"),
+            "cache_miss": sum(1 for r in records if r.get("cache") == "miss"),
+        }
+        for key in RUN_LOG_TIMING_FIELDS:
+            values = sorted(r[key] for r in records if r.get(key) is not None)
+            if values:
+                summary[f"{key}_mean"] = statistics.fmean(values)
+                summary[f"{key}_p50"] = values[int(0.50 * (len(values) - 1))]
+                summary[f"{key}_p95"] = values[int(0.95 * (len(values) - 1))]
+                summary[f"{key}_max"] = values[-1]
+        return summary
+
+    for log_file in files:
+        try:
+            records = read_run_log(log_file)
+        except Exception as e:
+            print(f"⚠️  跳过无法读取的日志 {log_file}: {e}")
+            continue
+        all_records.extend(records)
+        summaries.append(summarize(log_file, records))
+    if summaries:
+        summaries.append(summarize("TOTAL", all_records))
+    return summaries
+
+def print_log_summary(summaries):
+    header = (f"{'log':<40} {'ok':>6} {'fail':>5} {'hit/miss':>11}"
+              + "".join(f" {k + ' p50/p95':>18}" for k in RUN_LOG_TIMING_FIELDS))
+    print(header)
+    print("-" * len(header))
+    for summary in summaries:
+        line = (f"{summary['log'][-40:]:<40} {summary['success']:>6} {summary['fail']:>5}"
+                f" {str(summary['cache_hit']) + '/' + str(summary['cache_miss']):>11}")
+        for key in RUN_LOG_TIMING_FIELDS:
+            if f"{key}_p50" in summary:
+                line += f" {summary[key + '_p50']:>8.2f}/{summary[key + '_p95']:<9.2f}"
+            else:
+                line += f" {'-':>18}"
+        print(line)
+
+# ============ 耗时统计与进度 ============
+
+METRIC_STAGES = ("upload", "submit", "queue_wait", "generate", "download", "total")
+# 导出 Prometheus 文本时使用的桶边界（秒）
+PROMETHEUS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+class LatencyHistogram:
+    '''
+    对数分桶的延迟直方图，相邻桶边界相差 growth 倍，桶 i 包含 [下边界, 上边界) 的值（桶 0 为 [0, min_value]）
+    只保存每个桶的计数，内存与样本数无关；分位数取所在桶的上边界，相对误差不超过 growth - 1
+    另外按固定边界 bounds（导出 Prometheus 的 le）精确计数，导出的累计计数与真实值完全一致
+    '''
+    min_value = 0.001
+
+    def __init__(self, growth=1.05, bounds=PROMETHEUS_BUCKETS):
+        self.growth = growth
+        self._log_growth = math.log(growth)
+        self.buckets = {}  # 桶序号 -> 计数
+        self.bounds = tuple(bounds)
+        self.bound_counts = [0] * len(self.bounds)  # 落在 (上一个边界, 该边界] 的样本数
+        self.count = 0
+        self.sum = 0.0
+
+    def _index(self, value):
+        if value <= self.min_value:
+            return 0
+        return int(math.log(value / self.min_value) / self._log_growth) + 1
+
+    def _upper(self, index):
+        return self.min_value * self.growth ** index
+
+    def observe(self, value):
+        index = self._index(value)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        position = bisect.bisect_left(self.bounds, value)
+        if position < len(self.bounds):
+            self.bound_counts[position] += 1
+        self.count += 1
+        self.sum += value
+
+    def merge(self, other):
+        if other.bounds != self.bounds:
+            raise ValueError("只能合并固定边界相同的直方图")
+        for index, n in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + n
+        self.bound_counts = [a + b for a, b in zip(self.bound_counts, other.bound_counts)]
+        self.count += other.count
+        self.sum += other.sum
+
+    def percentile(self, q):
+        '''
+        返回第 q 分位数（0-100）所在桶的上边界
+        '''
+        if not self.count:
+            return None
+        rank = max(1, math.ceil(self.count * q / 100))
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return self._upper(index)
+
+    def cumulative(self):
+        '''
+        返回 self.bounds 每个边界的累计计数（Prometheus 的 le 桶，即不大于该边界的样本数）
+        '''
+        result = []
+        total = 0
+        for n in self.bound_counts:
+            total += n
+            result.append(total)
+        return result
+
+class RunMetrics:
+    '''
+    记录本次运行各阶段的耗时直方图（按 阶段 x 工作流 x 服务器 分别统计）
+    以及完成/失败数量，用于实时的 张/秒 与剩余时间估算，和运行结束时导出 Prometheus 文本
+    '''
+    def __init__(self, report_interval=10.0):
+        self.report_interval = report_interval
+        self._lock = threading.Lock()
+        self._histograms = {}  # (stage, workflow, host) -> LatencyHistogram
+        self.success = 0
+        self.failed = 0
+        self.total = 0
+        self.started = time.time()
+        self._reporter = None
+        self._stop = threading.Event()
+
+    def record(self, timings, workflow=""):
+        host = timings.get("host", "")
+        with self._lock:
+            for stage in METRIC_STAGES:
+                if stage in timings:
+                    key = (stage, workflow or "", host)
+                    histogram = self._histograms.get(key)
+                    if histogram is None:
+                        histogram = self._histograms[key] = LatencyHistogram()
+                    histogram.observe(timings[stage])
+            self.success += 1
+
+    def record_failure(self, workflow=""):
+        with self._lock:
+            self.failed += 1
+
+    def add_total(self, n):
+        '''
+        增加（或用负数减少）预计要处理的任务数，用于估算剩余时间
+        '''
+        with self._lock:
+            self.total += n
+
+    def histogram(self, stage, workflow=None, host=None):
+        '''
+        合并满足条件的直方图；workflow / host 为 None 时不限
+        '''
+        merged = LatencyHistogram()
+        with self._lock:
+            for (s, w, h), histogram in self._histograms.items():
+                if s == stage and (workflow is None or w == workflow) and (host is None or h == host):
+                    merged.merge(histogram)
+        return merged
+
+    def progress_line(self):
+        elapsed = max(time.time() - self.started, 1e-9)
+        done = self.success + self.failed
+        rate = done / elapsed
+        line = f"📈 进度 {done}/{self.total or '?'} | {rate:.2f} 张/秒 | 失败 {self.failed}"
+        if self.total and rate > 0:
+            remaining = max(0, self.total - done) / rate
+            line += f" | 剩余约 {time.strftime('%H:%M:%S', time.gmtime(remaining))}"
+        return line
+
+    def start_reporter(self):
+        '''
+        后台每 report_interval 秒打印一次吞吐量和剩余时间
+        '''
+        def loop():
+            while not self._stop.wait(self.report_interval):
+                print(self.progress_line())
+        self._reporter = threading.Thread(target=loop, daemon=True)
+        self._reporter.start()
+
+    def stop_reporter(self):
+        self._stop.set()
+
+    def summary_lines(self, workflow=None, host=None):
+        lines = []
+        for stage in METRIC_STAGES:
+            histogram = self.histogram(stage, workflow, host)
+            if histogram.count:
+                lines.append(
+                    f"  {stage:<10} n={histogram.count:<6} p50={histogram.percentile(50):.2f}s "
+                    f"p95={histogram.percentile(95):.2f}s p99={histogram.percentile(99):.2f}s"
+                )
+        return lines
+
+    def print_summary(self):
+        print(self.progress_line())
+        print("⏱️  各阶段耗时（全部）:")
+        for line in self.summary_lines():
+            print(line)
+        with self._lock:
+            host_list = sorted({h for (_, _, h) in self._histograms})
+        for host in host_list:
+            print(f"⏱️  服务器 {host}:")
+            for line in self.summary_lines(host=host):
+                print(line)
+
+    def write_prometheus(self, path):
+        '''
+        导出 Prometheus 文本格式（可被 node_exporter 的 textfile collector 读取）
+        '''
+        def label(value):
+            return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+        lines = [
+            "# HELP png2png_stage_seconds Time spent in each png2png stage.",
+            "# TYPE png2png_stage_seconds histogram",
+        ]
+        with self._lock:
+            items = sorted(self._histograms.items())
+            success, failed = self.success, self.failed
+        for (stage, workflow, host), histogram in items:
+            labels = f'stage="{label(stage)}",workflow="{label(workflow)}",host="{label(host)}"'
+            for bound, n in zip(histogram.bounds, histogram.cumulative()):
+                lines.append(f'png2png_stage_seconds_bucket{{{labels},le="{bound}"}} {n}')
+            lines.append(f'png2png_stage_seconds_bucket{{{labels},le="+Inf"}} {histogram.count}')
+            lines.append(f"png2png_stage_seconds_sum{{{labels}}} {histogram.sum:.6f}")
+            lines.append(f"png2png_stage_seconds_count{{{labels}}} {histogram.count}")
+        lines += [
+            "# HELP png2png_images_total Images processed by status.",
+            "# TYPE png2png_images_total counter",
+            f'png2png_images_total{{status="success"}} {success}',
+            f'png2png_images_total{{status="fail"}} {failed}',
+        ]
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, path)
+
+def get_metrics():
+    global metrics
+    if metrics is None:
+        metrics = RunMetrics()
+    return metrics
+
+# ============ 模型亲和排序 ============
+
+def model_sort_key(refs):
     '''
-    轮流查询服务器，检查一个任务是否已经完成
-    若返回数据包含含pid的结果，说明任务成功了
+    排序键：按加载代价从大到小排列的模型列表，排序后主模型相同的工作流相邻，其次是 ControlNet、LoRA 等
     '''
-    print("wait", time.time())
-    while True:
-        try:
-            response_new = request_with_retry("GET", url + "/history/" + pid)
-            if response_new and len(response_new.json()) > 0:
-                out_urls = []
-                for node_id in response_new.json()[pid]['outputs']:
-                    node_output = response_new.json()[pid]['outputs'][node_id]
-                    if 'images' in node_output:
-                        for image in node_output['images']:
-                            url_values = get_image(image['filename'], image['subfolder'], image['type'])
-                            out_urls.append(url_values)
-                print("generate", time.time())
-                return out_urls
-        except Exception as e:
-            print(f"Polling error, retrying in 3s: {e}")
-            time.sleep(3)
+    return tuple(sorted((-MODEL_INPUT_WEIGHTS[key], key, value) for key, value in refs))
+
+def estimate_model_loads(ref_sets):
+    '''
+    估计按给定顺序执行时服务器加载模型的次数：每个工作流中上一个工作流没用到的模型都要重新加载一次
+    '''
+    loads = 0
+    loaded = frozenset()
+    for refs in ref_sets:
+        loads += len(refs - loaded)
+        loaded = refs
+    return loads
+
+def order_by_model(items):
+    '''
+    按模型亲和性重新排列工作流，同一个工作流的全部图片本来就连续执行，所以只需要排列工作流
+
+    参数:
+        items: [(工作流名, 工作流字典)]，读取失败的工作流字典为 None，排在最后交给主循环记录错误
 
-def find_image_input_node(workflow):
-    """
-    查找工作流中的图片输入节点
-    
     返回:
-        str: 节点ID（如果找到）
-        None: 如果没有找到（表示这是文生图工作流）
-    """
-    for node_id, node in workflow.items():
-        if isinstance(node, dict) and ("class_type" in node or "type" in node):
-            if "LoadImageFromUrlOrPath" in node.get("class_type", "") or "LoadImage" in node.get("class_type", ""):
-                return node_id
-    return None  # 没有找到图片输入节点
-
-def push_prompt(prompt):
-    p = {"prompt": prompt}
-    data = json.dumps(p).encode('utf-8')
-    response = request_with_retry("POST", url + '/prompt', data=data)
-    print(response.json())
-    prompt_id = response.json()['prompt_id']
-    return prompt_id
+        tuple: (排序后的工作流名列表, 原顺序预计加载次数, 新顺序预计加载次数)
+    '''
+    return order_by_refs([(name, workflow_model_refs(workflow) if isinstance(workflow, dict) else None)
+                          for name, workflow in items])
+
+def order_by_refs(items):
+    '''
+    与 order_by_model 相同，但直接使用已知的模型集合（例如来自 workflow_index 的索引），不需要读取工作流
+
+    参数:
+        items: [(工作流名, 模型集合)]，读取失败的工作流模型集合为 None
+    '''
+    refs = {name: value for name, value in items if value is not None}
+    readable = [name for name, _ in items if name in refs]
+    ordered = sorted(readable, key=lambda name: (model_sort_key(refs[name]), name))
+    ordered += [name for name, _ in items if name not in refs]
+    before = estimate_model_loads(refs[name] for name in readable)
+    after = estimate_model_loads(refs[name] for name in ordered if name in refs)
+    return ordered, before, after
 
 # ============ 保存错误工作流函数 ============
 
@@ -149,9 +1758,10 @@ def save_error_workflow(workflow_path, error_folder="error_workflow"):
 
 # ============ 新增：处理文生图工作流 ============
 
-def process_text_to_image_workflow(workflow, write_folder, log_file, workflow_name):
+def process_text_to_image_workflow(workflow, write_folder, log_file, workflow_name, journal=None, journal_key=None):
     """
     处理文生图工作流（不需要输入图片）
+    journal: 断点续跑日志，成功后以 (journal_key, "") 记录
     
     返回:
         tuple: (是否成功, 错误信息)
@@ -164,299 +1774,1302 @@ def process_text_to_image_workflow(workflow, write_folder, log_file, workflow_na
             os.path.join(write_folder, f"{workflow_name}_output.png")
         )
         
-        # 执行任务
-        total_start = time.time()
-        submit_start = time.time()
-        prompt_id = push_prompt(workflow)
-        submit_end = time.time()
-        
-        generate_start = time.time()
-        url_values = queue_prompt(prompt_id)
-        generate_end = time.time()
-        
-        download_start = time.time()
-        download_image(url + "/view?", url_values, out_path)
-        download_end = time.time()
-        total_end = time.time()
+        # 执行任务（由服务器池选择服务器）；结果缓存命中时不提交
+        cache_key = result_cache_key(workflow)
+        timings = restore_cached_result(cache_key, out_path)
+        if timings is None:
+            timings = run_with_failover(lambda host: run_prompt(workflow, out_path, host))
+            cache_result(cache_key, out_path, timings)
         
-        print(f"⏱️  Total time for text-to-image: {total_end - total_start:.2f}s")
+        print(f"⏱️  Total time for text-to-image: {timings['total']:.2f}s")
+        get_metrics().record(timings, journal_key or workflow_name)
         
         # 记录成功日志
-        with open(log_file, 'a', newline='', encoding='utf-8') as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow([
-                "0001",
-                "N/A (text-to-image)",
-                out_path,
-                f"{submit_end - submit_start:.2f}",
-                f"{generate_end - generate_start:.2f}",
-                f"{download_end - download_start:.2f}",
-                f"{total_end - total_start:.2f}",
-                "success",
-                ""
-            ])
+        get_log_sink().write(log_file, [
+            "0001",
+            "N/A (text-to-image)",
+            out_path,
+            f"{timings['submit']:.2f}",
+            f"{timings['generate']:.2f}",
+            f"{timings['download']:.2f}",
+            f"{timings['total']:.2f}",
+            "success",
+            "",
+            timings.get("cache", "")
+        ])
+        if journal is not None:
+            journal.record(journal_key, "", out_path)
         
         return True, ""
         
     except Exception as e:
         err_msg = traceback.format_exc()
         print(f"❌ 文生图处理失败: {e}")
+        get_metrics().record_failure(journal_key or workflow_name)
         
         # 记录失败日志
-        with open(log_file, 'a', newline='', encoding='utf-8') as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow([
-                "0001",
-                "N/A (text-to-image)",
-                out_path if 'out_path' in locals() else "N/A",
-                "", "", "", "",
-                "fail",
-                err_msg.replace("\n", " | ")
-            ])
+        get_log_sink().write(log_file, [
+            "0001",
+            "N/A (text-to-image)",
+            out_path if 'out_path' in locals() else "N/A",
+            "", "", "", "",
+            "fail",
+            err_msg.replace("\n", " | "),
+            ""
+        ])
         
         return False, str(e)
 
+# ============ 输入图片清单 ============
+
+class InputManifest:
+    '''
+    读取文件夹的图片清单：每张图片的相对路径、大小、修改时间和可选的内容哈希
+    清单保存在 JSON 文件中，每次运行只刷新一次，全部图生图工作流共用
+
+    刷新时对每个目录只做一次 stat：目录的修改时间没变，说明其中没有增删文件，直接沿用上次的文件列表；
+    只有变化过的目录才重新列出。刚修改过的目录（2 秒内）不记录时间，下次一定重新列出，避免同一时刻的改动被漏掉
+    '''
+    def __init__(self, root, manifest_file=input_manifest_file):
+        self.root = os.path.abspath(root)
+        self.manifest_file = manifest_file
+        self._lock = threading.Lock()
+        self._dirs = {}    # 相对目录 -> {"mtime": ..., "files": [...], "subdirs": [...]}
+        self._files = {}   # 相对路径 -> {"size": ..., "mtime": ..., "sha256": ...}
+        self._order = []   # 图片的相对路径，按目录先序、文件名排序
+        self.listed = self.reused = 0
+        if os.path.exists(manifest_file):
+            try:
+                with open(manifest_file, "r", encoding="utf-8") as f:
+                    data = json.load(f).get(self.root, {})
+                self._dirs = data.get("dirs", {})
+                self._files = data.get("files", {})
+            except Exception as e:
+                print(f"⚠️  输入清单读取失败，重新建立: {e}")
+
+    def __len__(self):
+        return len(self._order)
+
+    def refresh(self, with_hash=False):
+        '''
+        按目录修改时间增量刷新清单；with_hash 为 True 时补算缺少的内容哈希
+        '''
+        self.listed = self.reused = 0
+        dirs, files = {}, {}
+        now = time.time()
+        stack = [""]
+        while stack:
+            rel = stack.pop()
+            full = os.path.join(self.root, rel)
+            try:
+                mtime = os.stat(full).st_mtime_ns
+            except OSError:
+                continue
+            prev = self._dirs.get(rel)
+            prefix = rel + os.sep if rel else ""  # 文件很多时 os.path.join 本身就是主要开销
+            if prev and prev["mtime"] == mtime:
+                self.reused += 1
+                names, subdirs = [], prev["subdirs"]
+                for name in prev["files"]:
+                    key = prefix + name
+                    entry = self._files.get(key) or self._stat_entry(key)
+                    if entry is not None:
+                        names.append(name)
+                        files[key] = entry
+            else:
+                self.listed += 1
+                names, subdirs = [], []
+                with os.scandir(full) as it:
+                    for e in it:
+                        if e.is_dir():
+                            if not e.is_symlink():  # 与 os.walk 一致，不进入符号链接的目录
+                                subdirs.append(e.name)
+                        elif e.name.lower().endswith(image_exts) and not e.name.startswith('.'):
+                            key = prefix + e.name
+                            entry = self._stat_entry(key)
+                            if entry is not None:
+                                names.append(e.name)
+                                files[key] = entry
+                names.sort()
+                subdirs.sort()
+            recent = now - mtime / 1e9 < 2
+            dirs[rel] = {"mtime": None if recent else mtime, "files": names, "subdirs": subdirs}
+            stack.extend(prefix + d for d in subdirs)
+
+        order = []
+        def collect(rel):
+            entry = dirs.get(rel)
+            if entry is None:
+                return
+            prefix = rel + os.sep if rel else ""
+            order.extend(prefix + name for name in entry["files"])
+            for d in entry["subdirs"]:
+                collect(prefix + d)
+        collect("")
+
+        with self._lock:
+            self._dirs, self._files, self._order = dirs, files, order
+        if with_hash:
+            missing = [key for key in order if not files[key].get("sha256")]
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                for key, digest in zip(missing, executor.map(
+                        lambda k: file_sha256(os.path.join(self.root, k)), missing)):
+                    files[key]["sha256"] = digest
+        return self
+
+    def _stat_entry(self, key):
+        '''
+        stat 一个文件，大小和修改时间与旧记录一致时保留旧记录的哈希
+        '''
+        try:
+            st = os.stat(os.path.join(self.root, key))
+        except OSError:
+            return None
+        old = self._files.get(key)
+        if old and old["size"] == st.st_size and old["mtime"] == st.st_mtime_ns:
+            return old
+        return {"size": st.st_size, "mtime": st.st_mtime_ns}
+
+    def images(self):
+        '''
+        依次返回 (图片完整路径, 文件名)
+        '''
+        prefix = self.root + os.sep
+        for key in self._order:
+            yield prefix + key, key.rpartition(os.sep)[2]
+
+    def digest(self, path):
+        '''
+        返回图片的内容哈希
+        先 stat 一次文件，与清单记录一致时直接用记录的哈希，否则重新计算并写回清单；不在清单中的文件返回 None
+        '''
+        key = os.path.relpath(os.path.abspath(path), self.root)
+        with self._lock:
+            entry = self._files.get(key)
+        if entry is None:
+            return None
+        st = os.stat(path)
+        if entry.get("sha256") and entry["size"] == st.st_size and entry["mtime"] == st.st_mtime_ns:
+            return entry["sha256"]
+        digest = file_sha256(path)
+        with self._lock:
+            self._files[key] = {"size": st.st_size, "mtime": st.st_mtime_ns, "sha256": digest}
+        return digest
+
+    def save(self):
+        '''
+        保存清单；同一个文件中可以有多个读取文件夹的清单，按根目录区分
+        '''
+        data = {}
+        if os.path.exists(self.manifest_file):
+            try:
+                with open(self.manifest_file, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+            except Exception:
+                data = {}
+        with self._lock:
+            data[self.root] = {"dirs": self._dirs, "files": self._files}
+            text = json.dumps(data, ensure_ascii=False)
+        tmp_file = self.manifest_file + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_file, self.manifest_file)
+
+_manifests = {}
+_manifests_lock = threading.Lock()
+
+def get_input_manifest(read_folder):
+    '''
+    返回读取文件夹的输入清单，本次运行中第一次使用时刷新并保存
+    '''
+    root = os.path.abspath(read_folder)
+    with _manifests_lock:
+        manifest = _manifests.get(root)
+        if manifest is None:
+            start = time.time()
+            manifest = InputManifest(root, input_manifest_file).refresh(with_hash=manifest_with_hash)
+            manifest.save()
+            print(f"🗂️  输入清单: {len(manifest)} 张图片，重新列出 {manifest.listed} 个目录，"
+                  f"沿用 {manifest.reused} 个目录，耗时 {time.time() - start:.2f}s")
+            _manifests[root] = manifest
+    return manifest
+
+def save_input_manifests():
+    with _manifests_lock:
+        for manifest in _manifests.values():
+            manifest.save()
+
+def input_digest(path):
+    '''
+    图片的内容哈希：在输入清单中时复用清单记录的哈希，否则直接计算
+    '''
+    path = os.path.abspath(path)
+    with _manifests_lock:
+        manifests = [m for m in _manifests.values() if path.startswith(m.root + os.sep)]
+    for manifest in manifests:
+        digest = manifest.digest(path)
+        if digest:
+            return digest
+    return file_sha256(path)
+
 # ============ 新增：处理图生图工作流 ============
 
-def process_image_to_image_workflow(workflow, image_node_id, read_folder, write_folder, log_file):
+def patch_image_input(workflow, image_node_id, image_path):
+    '''
+    返回替换了图片输入的工作流副本
+    只复制被修改的节点，并发执行时各个任务不会互相覆盖同一个工作流
+    '''
+    patched = dict(workflow)
+    node = dict(workflow[image_node_id])
+    node["inputs"] = dict(node["inputs"])
+    node["inputs"]['image'] = image_path
+    patched[image_node_id] = node
+    return patched
+
+def iter_input_images(read_folder):
+    '''
+    依次返回读取文件夹中的 (图片完整路径, 文件名)
+    图片列表来自本次运行共用的输入清单，不再为每个工作流重新遍历目录
+    '''
+    return get_input_manifest(read_folder).images()
+
+def run_image_prompt(workflow, image_node_id, path, out_path, host):
+    '''
+    在指定服务器上处理一张图片：上传 -> 提交 -> 等待 -> 下载
+
+    返回:
+        dict: 各阶段耗时
+    '''
+    # 上传图片（已上传过的图片直接引用）
+    prep = preprocess_params(workflow, image_node_id)
+    upload_start = time.time()
+    comfyui_path_image, cache_hit = upload_image_cached(path, host, prep)
+    upload_time = time.time() - upload_start
+    print(f"📤 {'已缓存' if cache_hit else '上传'}: {comfyui_path_image}")
+
+    # 修改工作流（副本）
+    prompt = prompt_body(workflow, image_node_id, comfyui_path_image)
+    try:
+        timings = run_prompt(prompt, out_path, host)
+    except requests.HTTPError as e:
+        # 只处理提交被拒绝的情况：缓存的图片可能已被服务器删除，作废该记录后重新上传一次
+        if not cache_hit or e.request is None or not e.request.url.endswith("/prompt"):
+            raise
+        invalidate_cached_upload(path, host, prep)
+        upload_start = time.time()
+        comfyui_path_image, _ = upload_image_cached(path, host, prep)
+        upload_time += time.time() - upload_start
+        prompt = prompt_body(workflow, image_node_id, comfyui_path_image)
+        timings = run_prompt(prompt, out_path, host)
+    timings["upload"] = upload_time
+    return timings
+
+def record_image_success(log_file, index, path, out_path, timings, journal=None, workflow_name=None):
+    '''
+    记录一张图片处理成功：耗时统计、运行日志、断点续跑日志
+    '''
+    get_metrics().record(timings, workflow_name)
+    get_log_sink().write(log_file, [
+        f"{index:04d}",
+        path,
+        out_path,
+        f"{timings['submit']:.2f}",
+        f"{timings['generate']:.2f}",
+        f"{timings['download']:.2f}",
+        f"{timings['total']:.2f}",
+        "success",
+        "",
+        timings.get("cache", "")
+    ])
+    if journal is not None:
+        journal.record(workflow_name, path, out_path)
+    if work_claims is not None:
+        work_claims.finish(workflow_name, path)
+
+def record_image_failure(log_file, index, path, out_path, err_msg, workflow_name=None):
+    '''
+    记录一张图片处理失败
+    '''
+    get_metrics().record_failure(workflow_name)
+    get_log_sink().write(log_file, [
+        f"{index:04d}",
+        path,
+        out_path,
+        "", "", "", "",
+        "fail",
+        err_msg.replace("\n", " | "),
+        ""
+    ])
+    if work_claims is not None:
+        work_claims.finish(workflow_name, path, ok=False)
+
+def process_single_image(workflow, image_node_id, path, p, index, write_folder, log_file,
+                         journal=None, workflow_name=None):
+    """
+    处理单张图片：上传 -> 提交 -> 等待 -> 下载 -> 记录日志
+
+    参数:
+        index: 图片序号（从1开始），写入日志的第一列
+        journal: 断点续跑日志，成功后记录 (workflow_name, path, out_path)
+
+    返回:
+        tuple: (是否成功, 错误信息)
+    """
+    start = time.time()
+    out_path = os.path.abspath(os.path.join(write_folder, p.strip()))
+
+    try:
+        # 结果缓存命中时直接恢复；否则选择服务器执行，服务器失败时自动换一台（上传也跟着任务走）
+        cache_key = result_cache_key(workflow, image_node_id, path)
+        timings = restore_cached_result(cache_key, out_path)
+        if timings is None:
+            timings = run_with_failover(
+                lambda host: run_image_prompt(workflow, image_node_id, path, out_path, host)
+            )
+            cache_result(cache_key, out_path, timings)
+
+        print(f"⏱️  Total time for image {index}: {timings['total']:.2f}s")
+        record_image_success(log_file, index, path, out_path, timings, journal, workflow_name)
+        ok, error_msg = True, ""
+
+    except Exception as e:
+        print(f"❌ Error processing image {index}: {e}")
+        record_image_failure(log_file, index, path, out_path, traceback.format_exc(), workflow_name)
+        ok, error_msg = False, str(e)
+
+    end = time.time()
+    print(f"⏱  diff {end - start:.2f}s")
+    return ok, error_msg
+
+def process_image_to_image_workflow(workflow, image_node_id, read_folder, write_folder, log_file, max_inflight=1,
+                                    journal=None, workflow_name=None, resume=False,
+                                    pipeline=False, upload_workers=2, download_workers=2, batch_size=1):
     """
     处理图生图工作流（需要输入图片）
-    
+
+    参数:
+        max_inflight: 同时在服务器上执行的最大任务数
+                      1 为串行；大于1时用线程池并发上传/提交/等待/下载，
+                      让客户端的网络传输和服务器的GPU计算互相重叠
+        journal: 断点续跑日志；resume 为 True 时跳过日志中已完成的图片
+        pipeline: 使用分阶段流水线（见 run_image_pipeline），上传/生成/下载各有独立的线程，
+                  max_inflight 为生成阶段的线程数
+        batch_size: 大于1时每 batch_size 张图片合并为一个任务提交（见 build_batched_prompt），
+                    max_inflight 为同时在途的批次数
+
     返回:
         tuple: (是否有错误, 错误信息, 处理数量)
     """
     count = 0
+    skipped = 0
+    unclaimed = 0
     has_error = False
     error_msg = ""
-    
-    for roots, dirs, files in os.walk(read_folder):
-        image_files = [f for f in files if f.lower().endswith(image_exts) and not f.startswith('.')]
-        if not image_files:
+
+    def pending_images():
+        # 图片序号按遍历顺序编号，跳过的图片也占一个序号，续跑前后同一张图片的序号不变
+        nonlocal skipped, unclaimed
+        for index, (path, p) in enumerate(iter_input_images(read_folder), 1):
+            if resume and journal is not None and journal.is_done(workflow_name, path):
+                skipped += 1
+                continue
+            # 多客户端时只处理本客户端认领到的图片（任务名用相对路径，与各客户端的挂载位置无关）
+            if work_claims is not None and not work_claims.claim(
+                    workflow_name, os.path.relpath(path, read_folder).replace(os.sep, "/"), path):
+                unclaimed += 1
+                continue
+            yield index, path, p
+
+    if batch_size > 1:
+        with ThreadPoolExecutor(max_workers=max(1, max_inflight)) as executor:
+            pending = set()
+            for batch in iter_batches(pending_images(), batch_size):
+                count += len(batch)
+                pending.add(executor.submit(
+                    process_image_batch,
+                    workflow, image_node_id, batch, write_folder, log_file, journal, workflow_name
+                ))
+                if len(pending) >= max_inflight:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        ok, err = future.result()
+                        if not ok:
+                            has_error, error_msg = True, err
+            for future in pending:
+                ok, err = future.result()
+                if not ok:
+                    has_error, error_msg = True, err
+    elif pipeline:
+        has_error, error_msg, count = run_image_pipeline(
+            workflow, image_node_id, pending_images(), write_folder, log_file,
+            upload_workers, max_inflight, download_workers, journal, workflow_name
+        )
+    elif max_inflight <= 1:
+        for index, path, p in pending_images():
+            count += 1
+            ok, err = process_single_image(
+                workflow, image_node_id, path, p, index, write_folder, log_file,
+                journal, workflow_name
+            )
+            if not ok:
+                has_error, error_msg = True, err
+    else:
+        # 并发模式：最多保持 max_inflight 个任务在途，边遍历边提交，避免一次性堆积所有任务
+        with ThreadPoolExecutor(max_workers=max_inflight) as executor:
+            pending = set()
+            for index, path, p in pending_images():
+                count += 1
+                pending.add(executor.submit(
+                    process_single_image,
+                    workflow, image_node_id, path, p, index, write_folder, log_file,
+                    journal, workflow_name
+                ))
+                if len(pending) >= max_inflight:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        ok, err = future.result()
+                        if not ok:
+                            has_error, error_msg = True, err
+            for future in pending:
+                ok, err = future.result()
+                if not ok:
+                    has_error, error_msg = True, err
+
+    if skipped:
+        print(f"⏭️  续跑：跳过 {skipped} 张已完成的图片")
+        get_metrics().add_total(-skipped)
+    if unclaimed:
+        print(f"🤝 {unclaimed} 张图片属于其他分片或由其他客户端处理")
+        get_metrics().add_total(-unclaimed)
+    return has_error, error_msg, count
+
+# ============ 批量提交 ============
+
+def downstream_nodes(workflow, node_id):
+    '''
+    返回直接或间接依赖 node_id 输出的全部节点（包括 node_id 本身）
+    节点输入中形如 [来源节点ID, 输出序号] 的列表表示连线
+    '''
+    children = {}
+    for nid, node in workflow.items():
+        if not isinstance(node, dict):
             continue
-            
-        for p in image_files:
-            if not p.startswith('.'):
-                path = os.path.join(roots, p)
-                
+        for value in node.get("inputs", {}).values():
+            if isinstance(value, list) and len(value) == 2 and str(value[0]) in workflow:
+                children.setdefault(str(value[0]), set()).add(nid)
+    result = {node_id}
+    stack = [node_id]
+    while stack:
+        for child in children.get(stack.pop(), ()):
+            if child not in result:
+                result.add(child)
+                stack.append(child)
+    return result
+
+def build_batched_prompt(workflow, image_node_id, server_images):
+    '''
+    把 N 张图片合并到一个任务里
+    依赖图片输入的子图（从图片节点往下的所有节点）为每张图片复制一份，节点ID加上 "b<序号>_" 前缀；
+    不依赖图片的节点（加载模型、提示词编码等）保持一份，所有副本共用；
+    其中没有被其他节点引用的末端节点（不依赖图片的输出节点，例如单独保存的文生图分支）也为每张图片复制一份，
+    与逐张提交时一样，每张图片都能拿到这些节点的输出
+
+    返回:
+        tuple: (合并后的工作流, {输出节点ID: 图片序号})
+    '''
+    subgraph = downstream_nodes(workflow, image_node_id)
+    referenced = {str(value[0]) for node in workflow.values() if isinstance(node, dict)
+                  for value in node.get("inputs", {}).values()
+                  if isinstance(value, list) and len(value) == 2}
+    per_image = subgraph | {nid for nid, node in workflow.items()
+                            if isinstance(node, dict) and nid not in subgraph and nid not in referenced}
+    prompt = {nid: node for nid, node in workflow.items() if nid not in per_image}
+    output_owner = {}
+    for i, server_image in enumerate(server_images):
+        prefix = f"b{i}_"
+        for nid in per_image:
+            node = dict(workflow[nid])
+            inputs = {}
+            for key, value in node.get("inputs", {}).items():
+                if isinstance(value, list) and len(value) == 2 and str(value[0]) in subgraph:
+                    value = [prefix + str(value[0]), value[1]]
+                inputs[key] = value
+            if nid == image_node_id:
+                inputs['image'] = server_image
+            node["inputs"] = inputs
+            prompt[prefix + nid] = node
+            output_owner[prefix + nid] = i
+    return prompt, output_owner
+
+def run_batch_prompt(workflow, image_node_id, paths, out_paths, host):
+    '''
+    在指定服务器上把一批图片作为一个任务执行：上传全部图片 -> 提交一次 -> 等待 -> 按图片分别下载
+
+    返回:
+        dict: 整批的各阶段耗时
+    '''
+    prep = preprocess_params(workflow, image_node_id)
+    upload_start = time.time()
+    uploaded = [upload_image_cached(path, host, prep) for path in paths]
+    upload_time = time.time() - upload_start
+
+    prompt, output_owner = build_batched_prompt(workflow, image_node_id, [u[0] for u in uploaded])
+    total_start = time.time()
+    try:
+        prompt_id = push_prompt(prompt, host)
+    except requests.HTTPError:
+        # 缓存的图片可能已被服务器删除，作废这一批的缓存记录后重新上传一次
+        if not any(hit for _, hit in uploaded):
+            raise
+        for path, (_, hit) in zip(paths, uploaded):
+            if hit:
+                invalidate_cached_upload(path, host, prep)
+        upload_start = time.time()
+        uploaded = [upload_image_cached(path, host, prep) for path in paths]
+        upload_time += time.time() - upload_start
+        prompt, output_owner = build_batched_prompt(workflow, image_node_id, [u[0] for u in uploaded])
+        total_start = time.time()
+        prompt_id = push_prompt(prompt, host)
+    submit_end = time.time()
+
+    info = {}
+    queue_prompt(prompt_id, base_url=host, info=info)
+    generate_end = time.time()
+
+    # 每张图片的结果按原来的命名规则下载到各自的输出路径
+    per_image = [[] for _ in paths]
+    for node_id, url_values in info.get("outputs_by_node", {}).items():
+        if node_id in output_owner:
+            per_image[output_owner[node_id]].extend(url_values)
+    for url_values, out_path in zip(per_image, out_paths):
+        download_image(host + "/view?", url_values, out_path)
+    download_end = time.time()
+
+    timings = {
+        "host": host,
+        "upload": upload_time,
+        "submit": submit_end - total_start,
+        "generate": generate_end - submit_end,
+        "download": download_end - generate_end,
+        "total": download_end - total_start,
+        "outputs_per_image": [len(url_values) for url_values in per_image],
+    }
+    if "execution_start" in info:
+        timings["queue_wait"] = min(max(0.0, info["execution_start"] - submit_end), timings["generate"])
+    return timings
+
+def process_image_batch(workflow, image_node_id, batch, write_folder, log_file,
+                        journal=None, workflow_name=None):
+    """
+    处理一批图片并为每张图片写一行日志（各行的耗时为整批的耗时）
+
+    参数:
+        batch: [(序号, 图片路径, 文件名), ...]
+
+    返回:
+        tuple: (是否成功, 错误信息)
+    """
+    # 结果缓存命中的图片直接恢复，其余的合并提交
+    pending = []
+    for index, path, p in batch:
+        out_path = os.path.abspath(os.path.join(write_folder, p.strip()))
+        cache_key = result_cache_key(workflow, image_node_id, path)
+        cached = restore_cached_result(cache_key, out_path)
+        if cached is not None:
+            record_image_success(log_file, index, path, out_path, cached, journal, workflow_name)
+        else:
+            pending.append(((index, path, p), out_path, cache_key))
+    if not pending:
+        return True, ""
+    batch = [item for item, _, _ in pending]
+    paths = [path for _, path, _ in batch]
+    out_paths = [out_path for _, out_path, _ in pending]
+    try:
+        timings = run_with_failover(
+            lambda host: run_batch_prompt(workflow, image_node_id, paths, out_paths, host)
+        )
+        print(f"⏱️  Total time for batch {batch[0][0]}-{batch[-1][0]} ({len(batch)} 张): {timings['total']:.2f}s")
+        for (_, out_path, cache_key), count in zip(pending, timings["outputs_per_image"]):
+            cache_result(cache_key, out_path, timings, count)
+        for (index, path, _), out_path in zip(batch, out_paths):
+            record_image_success(log_file, index, path, out_path, timings, journal, workflow_name)
+        return True, ""
+    except Exception as e:
+        print(f"❌ Error processing batch {batch[0][0]}-{batch[-1][0]}: {e}")
+        err_msg = traceback.format_exc()
+        for (index, path, _), out_path in zip(batch, out_paths):
+            record_image_failure(log_file, index, path, out_path, err_msg, workflow_name)
+        return False, str(e)
+
+def iter_batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+# ============ 流水线模式 ============
+
+class _ImageJob:
+    '''
+    流水线中的一张图片，记录它所在的服务器和各阶段的中间结果
+    '''
+    def __init__(self, index, path, p, out_path):
+        self.index = index
+        self.path = path
+        self.p = p
+        self.out_path = out_path
+        self.host = None
+        self.server_image = None
+        self.cache_hit = False
+        self.url_values = None
+        self.timings = {}
+        self.attempts = 0
+        self.timeouts = 0
+        self.cache_key = None
+
+def run_image_pipeline(workflow, image_node_id, images, write_folder, log_file,
+                       upload_workers=2, generate_workers=2, download_workers=2,
+                       journal=None, workflow_name=None, queue_size=None):
+    """
+    分阶段流水线：遍历 -> 上传 -> 提交/等待 -> 下载/记录日志
+    每个阶段有自己的线程，阶段之间用有界队列连接：
+    当前图片在 GPU 上生成时，下一张图片已经在上传，上一张图片的结果正在下载
+    下游阶段处理不过来时上游会阻塞（背压），所以即使输入文件夹很大内存也保持平稳
+
+    参数:
+        images: (序号, 图片路径, 文件名) 的迭代器，按需读取
+        queue_size: 每个队列的容量，默认为下游线程数的 2 倍
+        服务器连接失败的图片会回到上传阶段，换一台服务器重新执行
+
+    返回:
+        tuple: (是否有错误, 错误信息, 处理数量)
+    """
+    pool = get_host_pool()
+    prep = preprocess_params(workflow, image_node_id)
+    upload_q = queue.Queue(queue_size or upload_workers * 2)
+    generate_q = queue.Queue(queue_size or generate_workers * 2)
+    download_q = queue.Queue(queue_size or download_workers * 2)
+    retry_q = queue.Queue()  # 换服务器重试的任务，不设上限，避免阶段之间互相等待而死锁
+
+    state_lock = threading.Lock()
+    state = {"outstanding": 0, "scan_done": False, "count": 0, "has_error": False, "error_msg": ""}
+
+    def finished():
+        with state_lock:
+            return state["scan_done"] and state["outstanding"] == 0
+
+    def job_done(job, error=None, err_msg=""):
+        if job.host is not None:
+            if error is None:
+                pool.record_success(job.host)
+            pool.release(job.host)
+            job.host = None
+        if error is None:
+            print(f"⏱️  Total time for image {job.index}: {job.timings['total']:.2f}s")
+            record_image_success(log_file, job.index, job.path, job.out_path, job.timings, journal, workflow_name)
+        else:
+            print(f"❌ Error processing image {job.index}: {error}")
+            record_image_failure(log_file, job.index, job.path, job.out_path, err_msg, workflow_name)
+        with state_lock:
+            state["outstanding"] -= 1
+            if error is not None:
+                state["has_error"], state["error_msg"] = True, str(error)
+
+    def handle_error(job, error):
+        # 服务器不可用或任务超时：换一台服务器从上传阶段重新开始；其他错误直接记为失败
+        if isinstance(error, HOST_ERRORS + (PromptTimeout,)) and job.host is not None:
+            report_host_error(pool, job.host, error)
+            if isinstance(error, PromptTimeout):
+                job.timeouts += 1
+                retry = job.timeouts <= prompt_retries
+            else:
+                retry = job.attempts - job.timeouts < max(1, len(pool.hosts))
+            if retry:
+                pool.release(job.host)
+                job.host = None
+                print(f"🔁 任务重新派发: {error}")
+                retry_q.put(job)
+                return
+        job_done(job, error, traceback.format_exc())
+
+    def next_job(q, retry=False):
+        # 取任务时定期检查是否已经全部完成，完成后线程退出；上传阶段优先处理换服务器重试的任务
+        while True:
+            if retry:
                 try:
-                    # 上传图片
-                    with open(path, 'rb') as f:
-                        comfyui_path_image = upload_file(f, "", True)
-                    print(f"📤 上传: {comfyui_path_image}")
-                    
-                    # 修改工作流
-                    workflow[image_node_id]["inputs"]['image'] = comfyui_path_image
-                    
-                    start = time.time()
-                    out_path = os.path.abspath(
-                        os.path.join(write_folder, p.strip())
-                    )
-                    
-                    # 执行任务
-                    total_start = time.time()
-                    submit_start = time.time()
-                    prompt_id = push_prompt(workflow)
-                    submit_end = time.time()
-                    
-                    generate_start = time.time()
-                    url_values = queue_prompt(prompt_id)
-                    generate_end = time.time()
-                    
-                    download_start = time.time()
-                    download_image(url + "/view?", url_values, out_path)
-                    download_end = time.time()
-                    total_end = time.time()
-                    
-                    print(f"⏱️  Total time for image {count + 1}: {total_end - total_start:.2f}s")
-                    
-                    # 记录成功日志
-                    with open(log_file, 'a', newline='', encoding='utf-8') as csvfile:
-                        writer = csv.writer(csvfile)
-                        writer.writerow([
-                            f"{count + 1:04d}",
-                            path,
-                            out_path,
-                            f"{submit_end - submit_start:.2f}",
-                            f"{generate_end - generate_start:.2f}",
-                            f"{download_end - download_start:.2f}",
-                            f"{total_end - total_start:.2f}",
-                            "success",
-                            ""
-                        ])
-                        
-                except Exception as e:
-                    err_msg = traceback.format_exc()
-                    print(f"❌ Error processing image {count + 1}: {e}")
-                    
-                    has_error = True
-                    error_msg = str(e)
-                    
-                    # 记录失败日志
-                    with open(log_file, 'a', newline='', encoding='utf-8') as csvfile:
-                        writer = csv.writer(csvfile)
-                        writer.writerow([
-                            f"{count + 1:04d}",
-                            path,
-                            out_path if 'out_path' in locals() else "N/A",
-                            "", "", "", "",
-                            "fail",
-                            err_msg.replace("\n", " | ")
-                        ])
-                
-                count += 1
+                    return retry_q.get_nowait()
+                except queue.Empty:
+                    pass
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                if finished():
+                    return None
+
+    def upload_stage():
+        while True:
+            job = next_job(upload_q, retry=True)
+            if job is None:
+                return
+            try:
+                job.attempts += 1
+                job.host = pool.acquire()
+                start = time.time()
+                job.server_image, job.cache_hit = upload_image_cached(job.path, job.host, prep)
+                job.timings["upload"] = time.time() - start
+                print(f"📤 {'已缓存' if job.cache_hit else '上传'}: {job.server_image}")
+                generate_q.put(job)
+            except Exception as e:
+                handle_error(job, e)
+
+    def submit_and_wait(job):
+        prompt = prompt_body(workflow, image_node_id, job.server_image)
+        start = time.time()
+        try:
+            prompt_id = push_prompt(prompt, job.host)
+        except requests.HTTPError:
+            # 缓存的图片可能已被服务器删除，作废该记录后重新上传一次
+            if not job.cache_hit:
+                raise
+            invalidate_cached_upload(job.path, job.host, prep)
+            job.server_image, job.cache_hit = upload_image_cached(job.path, job.host, prep)
+            prompt = prompt_body(workflow, image_node_id, job.server_image)
+            start = time.time()
+            prompt_id = push_prompt(prompt, job.host)
+        submit_end = time.time()
+        info = {}
+        job.url_values = queue_prompt(prompt_id, base_url=job.host, info=info)
+        generate_end = time.time()
+        job.timings.update(host=job.host, submit=submit_end - start, generate=generate_end - submit_end,
+                           total_start=start)
+        if "execution_start" in info:
+            job.timings["queue_wait"] = min(max(0.0, info["execution_start"] - submit_end),
+                                            job.timings["generate"])
+
+    def generate_stage():
+        while True:
+            job = next_job(generate_q)
+            if job is None:
+                return
+            try:
+                submit_and_wait(job)
+                download_q.put(job)
+            except Exception as e:
+                handle_error(job, e)
+
+    def download_stage():
+        while True:
+            job = next_job(download_q)
+            if job is None:
+                return
+            try:
+                start = time.time()
+                download_image(job.host + "/view?", job.url_values, job.out_path)
                 end = time.time()
-                print(f"⏱  diff {end - start:.2f}s")
+                job.timings["download"] = end - start
+                job.timings["total"] = end - job.timings.pop("total_start")
+                cache_result(job.cache_key, job.out_path, job.timings, len(job.url_values))
+                job_done(job)
+            except Exception as e:
+                handle_error(job, e)
+
+    threads = (
+        [threading.Thread(target=upload_stage, daemon=True) for _ in range(upload_workers)]
+        + [threading.Thread(target=generate_stage, daemon=True) for _ in range(generate_workers)]
+        + [threading.Thread(target=download_stage, daemon=True) for _ in range(download_workers)]
+    )
+    for t in threads:
+        t.start()
+
+    # 遍历阶段在当前线程执行，upload_q 满时阻塞；结果缓存命中的图片直接恢复，不进入后续阶段
+    for index, path, p in images:
+        job = _ImageJob(index, path, p, os.path.abspath(os.path.join(write_folder, p.strip())))
+        job.cache_key = result_cache_key(workflow, image_node_id, path)
+        cached = restore_cached_result(job.cache_key, job.out_path)
+        with state_lock:
+            state["count"] += 1
+            if cached is None:
+                state["outstanding"] += 1
+        if cached is not None:
+            record_image_success(log_file, index, path, job.out_path, cached, journal, workflow_name)
+            continue
+        upload_q.put(job)
+    with state_lock:
+        state["scan_done"] = True
+
+    for t in threads:
+        t.join()
+    return state["has_error"], state["error_msg"], state["count"]
+
+# ============ 处理单个工作流文件 ============
+
+class WorkflowRun:
+    '''
+    一次运行中全部工作流共用的状态：断点续跑日志、耗时统计、图生图的处理选项和各类计数
+    批量处理和监视模式（--watch）都通过 process_workflow_file 处理工作流
+
+    参数:
+        image_options: 传给 process_image_to_image_workflow 的选项（max_inflight、pipeline、batch_size 等）
+    '''
+    def __init__(self, read_folder, journal, metrics, resume=False, error_folder="error_workflow", **image_options):
+        self.read_folder = read_folder
+        self.journal = journal
+        self.metrics = metrics
+        self.resume = resume
+        self.error_folder = error_folder
+        self.error_log_file = f"error_workflows.{log_format}"
+        self.image_options = image_options
+        # 输入清单只建立一次，全部图生图工作流共用
+        self.images_per_workflow = len(get_input_manifest(read_folder)) if os.path.isdir(read_folder) else 0
+        self.processed = 0
+        self.errors = 0
+        self.text_to_image = 0
+        self.image_to_image = 0
+
+def process_workflow_file(run, pro, workflow_path, position="", resume=None, workflow=None):
+    '''
+    处理一个工作流文件：读取、判断类型、处理全部图片，出错时保存到错误文件夹并写错误日志
+
+    参数:
+        run: WorkflowRun
+        pro: 工作流文件名，同时用作运行日志名和断点续跑日志中的工作流名
+        position: 打印在标题中的进度，例如 "[3/10]"
+        resume: 是否跳过断点续跑日志中已完成的图片，None 时使用 run.resume
+        workflow: 已经解析好的工作流字典（例如按模型排序时读取的），为 None 时从 workflow_path 读取
+
+    返回:
+        bool: 是否没有任何错误
+    '''
+    resume = run.resume if resume is None else resume
+    workflow_has_error = False
+    workflow_error_msg = ""
+    error_stage = ""
+    workflow_type = "未知"
     
-    return has_error, error_msg, count
+    try:
+        print(f"\n{'='*60}")
+        print(f"🔄 Processing workflow {position}: {pro}")
+        print(f"{'='*60}")
+        
+        # ============ 阶段1: 读取工作流 ============
+        try:
+            if workflow is None:
+                with run_profiler.stage("读取工作流"):
+                    workflow = json_codec.load(workflow_path)
+            print("✅ 工作流读取成功")
+        except Exception as e:
+            error_stage = "文件读取/解析"
+            raise Exception(f"工作流文件读取失败: {e}")
+        
+        # ============ 阶段2: 准备输出目录 ============
+        write_folder_name = os.path.splitext(pro)[0]
+        write_folder = os.path.join("out", f"{write_folder_name}")
+        os.makedirs(write_folder, exist_ok=True)
+        
+        log_file = f"{pro}.{log_format}"
+        
+        # ============ 阶段3: 判断工作流类型 ============
+        image_node_id = find_image_input_node(workflow)
+        
+        if image_node_id is None:
+            # 文生图工作流
+            workflow_type = "文生图"
+            print(f"🎨 检测到 [{workflow_type}] 工作流")
+            run.text_to_image += 1
+            
+            error_stage = "文生图处理"
+            run.metrics.add_total(1 - run.images_per_workflow)
+            if resume and run.journal.is_done(pro):
+                print(f"⏭️  续跑：{pro} 已完成，跳过")
+                success, err_msg = True, ""
+            elif work_claims is not None and not work_claims.claim(pro, ""):
+                print(f"🤝 {pro} 属于其他分片或由其他客户端处理，跳过")
+                run.metrics.add_total(-1)
+                success, err_msg = True, ""
+            else:
+                success, err_msg = process_text_to_image_workflow(
+                    workflow, write_folder, log_file, write_folder_name, run.journal, pro
+                )
+                if work_claims is not None:
+                    work_claims.finish(pro, "", success)
+            
+            if not success:
+                workflow_has_error = True
+                workflow_error_msg = err_msg
+            
+        else:
+            # 图生图工作流
+            workflow_type = "图生图"
+            print(f"🖼️  检测到 [{workflow_type}] 工作流")
+            print(f"✅ 找到图片输入节点: {image_node_id}")
+            run.image_to_image += 1
+            
+            error_stage = "图生图处理"
+            has_error, err_msg, count = process_image_to_image_workflow(
+                workflow, image_node_id, run.read_folder, write_folder, log_file,
+                journal=run.journal, workflow_name=pro, resume=resume, **run.image_options
+            )
+            
+            if has_error:
+                workflow_has_error = True
+                workflow_error_msg = err_msg
+            
+            print(f"✅ 工作流 {pro} 处理完成 (处理了 {count} 张图片)")
+            for line in run.metrics.summary_lines(workflow=pro):
+                print(line)
+        
+        # 工作流处理完成
+        run.processed += 1
+        
+        # 如果有错误，保存到错误文件夹
+        if workflow_has_error:
+            save_error_workflow(workflow_path, run.error_folder)
+            run.errors += 1
+            
+            get_log_sink().write(run.error_log_file, [
+                pro,
+                time.strftime('%Y-%m-%d %H:%M:%S'),
+                workflow_type,
+                error_stage,
+                workflow_error_msg
+            ], fields=ERROR_LOG_FIELDS, header=True)
+        return not workflow_has_error
+    
+    except Exception as e:
+        # 工作流级别的致命错误
+        print(f"\n❌ 工作流 {pro} 处理失败: {e}")
+        print(traceback.format_exc())
+        
+        run.errors += 1
+        
+        # 保存到错误文件夹
+        try:
+            save_error_workflow(workflow_path, run.error_folder)
+        except:
+            pass
+        
+        # 记录到错误日志
+        get_log_sink().write(run.error_log_file, [
+            pro,
+            time.strftime('%Y-%m-%d %H:%M:%S'),
+            workflow_type,
+            error_stage if error_stage else "工作流初始化",
+            str(e)
+        ], fields=ERROR_LOG_FIELDS, header=True)
+        
+        print(f"⏭️  跳过该工作流，继续处理下一个...\n")
+        return False
 
 # ============ 主程序入口 ============
 
 if __name__ == '__main__':
-    input_folder = '/Users/xxx/xxx/xxx/workflow' # 此处填写工作流文件夹
-    read_folder = "/Users/xxx/xxx/xxx/pic"  # 此处填写图生图时读取图片的文件夹
+    parser = argparse.ArgumentParser(description="批量执行ComfyUI工作流")
+    parser.add_argument("--input-folder", default='/Users/xxx/xxx/xxx/workflow', # 此处填写工作流文件夹
+                        help="工作流文件夹（默认 %(default)s）")
+    parser.add_argument("--read-folder", default="/Users/xxx/xxx/xxx/pic", # 此处填写图生图时读取图片的文件夹
+                        help="图生图时读取图片的文件夹（默认 %(default)s）")
+    parser.add_argument("--max-inflight", type=int, default=max_inflight,
+                        help="图生图时同时在途的最大任务数（默认 %(default)s）")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="图生图使用分阶段流水线，上传/生成/下载互相重叠；生成阶段线程数为 --max-inflight")
+    parser.add_argument("--upload-workers", type=int, default=2, help="流水线上传阶段的线程数（默认 %(default)s）")
+    parser.add_argument("--download-workers", type=int, default=2, help="流水线下载阶段的线程数（默认 %(default)s）")
+    parser.add_argument("--batch-size", type=int, default=1,
+                        help="每个任务合并的图片数，大于1时复制图片相关的子图批量提交（默认 %(default)s）")
+    parser.add_argument("--completion", choices=("auto", "ws", "poll"), default=completion_mode,
+                        help="任务完成检测方式（默认 %(default)s）")
+    parser.add_argument("--prompt-timeout", type=float, default=prompt_timeout,
+                        help="单个任务最长等待时间，单位秒，超时后取消并重新派发（默认 %(default)s）")
+    parser.add_argument("--prompt-retries", type=int, default=prompt_retries,
+                        help="任务超时后重新派发的次数（默认 %(default)s）")
+    parser.add_argument("--breaker-threshold", type=int, default=breaker_threshold,
+                        help="同一台服务器连续失败多少次后暂时移出轮换（默认 %(default)s）")
+    parser.add_argument("--no-upload-cache", action="store_true",
+                        help="不使用上传缓存，每个工作流都重新上传全部图片")
+    parser.add_argument("--clear-upload-cache", action="store_true",
+                        help="运行前清空上传缓存（服务器 input 目录被清理后使用）")
+    parser.add_argument("--preprocess", choices=("webp", "jpeg", "png"), default=preprocess_format,
+                        help="上传前把输入图片缩小并转码为该格式，结果缓存在 %s（需要 Pillow）" % preprocess_cache_dir)
+    parser.add_argument("--preprocess-quality", type=int, default=preprocess_quality,
+                        help="转码为有损格式时的压缩质量（默认 %(default)s）")
+    parser.add_argument("--preprocess-size", default=None, metavar="WxH",
+                        help="预处理的目标尺寸，默认按工作流中的缩放节点自动确定")
+    parser.add_argument("--result-cache", action="store_true",
+                        help="启用生成结果缓存：同一工作流（图片输入之外完全相同）处理同一张图片时直接复用上次的结果，不再提交")
+    parser.add_argument("--result-cache-dir", default=result_cache_dir, help="生成结果缓存目录（默认 %(default)s）")
+    parser.add_argument("--result-cache-budget", type=float, default=result_cache_budget / 1024 ** 3,
+                        help="生成结果缓存的磁盘上限（GB），超出时删除最久没用过的结果（默认 %(default)s）")
+    parser.add_argument("--manifest", default=input_manifest_file,
+                        help="输入图片清单文件，按目录修改时间增量刷新（默认 %(default)s）")
+    parser.add_argument("--manifest-hash", action="store_true",
+                        help="建立清单时计算全部图片的内容哈希，之后的上传缓存查询不再读取图片")
+    parser.add_argument("--rebuild-manifest", action="store_true", help="忽略已有清单，重新遍历全部目录")
+    parser.add_argument("--http-pool-size", type=int, default=http_pool_size,
+                        help="每台服务器保持的最大 keep-alive 连接数（默认 %(default)s）")
+    parser.add_argument("--download-parallelism", type=int, default=download_parallelism,
+                        help="一个任务输出多张图片时同时下载的数量（默认 %(default)s）")
+    parser.add_argument("--local-dir", action="append", default=[], metavar="[HOST=]DIR",
+                        help="与本机共享文件系统的 ComfyUI 根目录，结果图片直接本地复制；"
+                             "多台服务器时写成 网址=目录，可重复指定")
+    parser.add_argument("--hosts", default=None,
+                        help="逗号分隔的多台 ComfyUI 服务器网址，任务派给排队最少的服务器")
+    parser.add_argument("--resume", action="store_true",
+                        help="跳过断点续跑日志中已完成的工作流和图片")
+    parser.add_argument("--journal", default=journal_file,
+                        help="断点续跑日志文件（默认 %(default)s）")
+    parser.add_argument("--order", choices=("model", "name"), default=job_order,
+                        help="工作流执行顺序：name 按文件名，model 让使用相同模型的工作流连续执行（默认 %(default)s）")
+    parser.add_argument("--watch", action="store_true",
+                        help="处理完运行日志中还没全部成功的工作流后继续监视工作流文件夹，新增或修改的工作流立即处理")
+    parser.add_argument("--watch-poll", action="store_true", help="监视模式不使用 inotify，改为定时扫描目录")
+    parser.add_argument("--watch-interval", type=float, default=2.0,
+                        help="定时扫描目录的间隔秒数（inotify 不可用或指定 --watch-poll 时，默认 %(default)s）")
+    parser.add_argument("--shard", default=None, metavar="i/n",
+                        help="多个客户端分担任务：按 (工作流, 图片) 的哈希只处理第 i 个分片（i 从 0 开始）")
+    parser.add_argument("--lease-dir", default=None,
+                        help="各客户端共享的租约目录（例如 NFS），保证每项任务只执行一次；"
+                             "处理完自己的分片后接管其他客户端没开始或已崩溃的任务")
+    parser.add_argument("--lease-ttl", type=float, default=300.0,
+                        help="租约有效期秒数，客户端停止续约超过这个时间后其他客户端可以接管（默认 %(default)s）")
+    parser.add_argument("--from-index", default=None, metavar="DB",
+                        help="从 workflow_index 的索引数据库获取工作流列表和模型信息（运行前先增量更新索引）")
+    parser.add_argument("--log-format", choices=("csv", "jsonl"), default=log_format,
+                        help="运行日志格式（默认 %(default)s）")
+    parser.add_argument("--metrics-file", default="png2png_metrics.prom",
+                        help="运行结束时导出的 Prometheus 文本文件（默认 %(default)s）")
+    parser.add_argument("--progress-interval", type=float, default=10,
+                        help="打印吞吐量和剩余时间的间隔秒数，0 表示不打印（默认 %(default)s）")
+    parser.add_argument("--summarize-logs", nargs="+", metavar="GLOB",
+                        help="汇总运行日志的耗时统计后退出，例如 --summarize-logs '*.json.csv'")
+    run_profiler.add_arguments(parser, "png2png_profile.txt")
+    args = parser.parse_args()
+    run_profiler.start_from_args(args)
+    if args.summarize_logs:
+        print_log_summary(summarize_run_logs(args.summarize_logs))
+        raise SystemExit(0)
+    log_format = args.log_format
+    job_order = args.order
+    download_parallelism = args.download_parallelism
+    http_pool = HttpSessionPool(max(args.http_pool_size, args.max_inflight + args.upload_workers
+                                    + args.download_workers + download_parallelism))
+    if args.hosts:
+        hosts = [h.strip() for h in args.hosts.split(",") if h.strip()]
+        url = hosts[0]
+    for item in args.local_dir:
+        host_url, _, local_dir = item.partition("=") if "=" in item else (url, "", item)
+        comfy_local_dirs[host_url.rstrip("/")] = local_dir
+    breaker_threshold = args.breaker_threshold
+    host_pool = HostPool(hosts or [url], breaker_threshold=breaker_threshold)
+    with run_profiler.stage("检查服务器"):
+        available_hosts = host_pool.check_all()
+    print(f"🖥️  可用服务器 {len(available_hosts)}/{len(host_pool.hosts)}: {available_hosts}")
+    completion_mode = args.completion
+    prompt_timeout = args.prompt_timeout
+    prompt_retries = args.prompt_retries
+    if args.clear_upload_cache and os.path.exists(upload_cache_file):
+        os.remove(upload_cache_file)
+    if not args.no_upload_cache:
+        upload_cache = UploadCache(upload_cache_file)
+    if args.result_cache:
+        result_cache_dir = args.result_cache_dir
+        result_cache_budget = int(args.result_cache_budget * 1024 ** 3)
+        result_cache = ResultCache(result_cache_dir, result_cache_budget)
+        print(f"♻️  结果缓存: {result_cache_dir}，已有 {result_cache.size / 1e6:.1f} MB"
+              f"（上限 {result_cache_budget / 1e9:.1f} GB）")
+    preprocess_format = args.preprocess
+    preprocess_quality = args.preprocess_quality
+    if args.preprocess_size:
+        preprocess_size = tuple(int(x) for x in args.preprocess_size.lower().split("x"))
+    if preprocess_format and Image is None:
+        print("⚠️  没有安装 Pillow，跳过上传前预处理")
+    input_manifest_file = args.manifest
+    manifest_with_hash = args.manifest_hash
+    if args.rebuild_manifest and os.path.exists(input_manifest_file):
+        os.remove(input_manifest_file)
+    if args.shard or args.lease_dir:
+        from work_lease import WorkClaims, parse_shard
+        try:
+            shard = parse_shard(args.shard) if args.shard else None
+        except ValueError as e:
+            parser.error(str(e))
+        work_claims = WorkClaims(shard, args.lease_dir, args.lease_ttl)
+        print(f"🤝 多客户端模式: 分片 {args.shard or '无'}，租约目录 {args.lease_dir or '无（静态分片）'}，"
+              f"客户端 {work_claims.owner}")
+    journal = CheckpointJournal(args.journal)
+    if args.resume:
+        print(f"🔖 续跑模式：日志中已有 {len(journal)} 条完成记录")
+
+    input_folder = args.input_folder
+    read_folder = args.read_folder
     
     error_workflow_folder = "error_workflow"
     os.makedirs(error_workflow_folder, exist_ok=True)
     
-    error_log_file = "error_workflows.csv"
-    if not os.path.exists(error_log_file):
-        with open(error_log_file, 'w', newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            writer.writerow(['工作流文件名', '错误时间', '工作流类型', '处理阶段', '错误信息'])
+    # 监视模式：在列出工作流之前开始监视，处理已有工作流期间新增的文件也不会漏掉
+    watcher = None
+    if args.watch:
+        from dir_watcher import DirWatcher
+        watcher = DirWatcher(input_folder, poll_interval=args.watch_interval, use_inotify=not args.watch_poll)
     
     # 获取所有 JSON 文件并排序
-    json_files = sorted([f for f in os.listdir(input_folder) 
-                        if f.endswith('.json') and not f.startswith('.')])
+    with run_profiler.stage("列出工作流"):
+        wf_index = None
+        parsed = {} # 按模型排序时已经解析的工作流，处理时直接使用，不再读取第二次
+        if args.from_index:
+            from workflow_index import WorkflowIndex
+            wf_index = WorkflowIndex(args.from_index)
+            wf_index.update(input_folder)
+            folder = os.path.abspath(input_folder)
+            indexed = [p for p in wf_index.query(root=folder, include_errors=True) if os.path.dirname(p) == folder]
+            json_files = sorted(os.path.basename(p) for p in indexed if not os.path.basename(p).startswith('.'))
+        else:
+            json_files = sorted([f for f in os.listdir(input_folder) 
+                                if f.endswith('.json') and not f.startswith('.')])
     
+        if job_order == "model" and wf_index is not None:
+            # 模型信息直接从索引读取，不需要再解析工作流
+            refs = wf_index.model_refs([os.path.join(folder, name) for name in json_files])
+            json_files, loads_before, loads_after = order_by_refs(
+                [(name, refs[os.path.join(folder, name)]) for name in json_files])
+            print(f"🧠 按模型排序: 预计模型加载 {loads_before} 次 -> {loads_after} 次"
+                  f"（减少 {loads_before - loads_after} 次）")
+        elif job_order == "model":
+            def read_workflow(name):
+                try:
+                    return json_codec.load(os.path.join(input_folder, name))
+                except Exception:
+                    return None
+            parsed = {name: read_workflow(name) for name in json_files}
+            json_files, loads_before, loads_after = order_by_model(list(parsed.items()))
+            print(f"🧠 按模型排序: 预计模型加载 {loads_before} 次 -> {loads_after} 次"
+                  f"（减少 {loads_before - loads_after} 次）")
+
     print(f"📊 发现 {len(json_files)} 个工作流文件")
     print(f"文件列表: {json_files}\n")
+
+    # 先按每个工作流都是图生图估算总任务数，遇到文生图工作流再修正
+    metrics = RunMetrics(report_interval=args.progress_interval)
+    run = WorkflowRun(read_folder, journal, metrics, resume=args.resume, error_folder=error_workflow_folder,
+                      max_inflight=args.max_inflight, pipeline=args.pipeline, upload_workers=args.upload_workers,
+                      download_workers=args.download_workers, batch_size=args.batch_size)
+    if watcher is not None:
+        # 监视模式只处理运行日志显示还没有全部成功的工作流（没有日志、有失败、没处理完或日志之后修改过）
+        def expected_inputs(name):
+            return workflow_expected_inputs(os.path.join(input_folder, name), run.images_per_workflow)
+        pending = [name for name in json_files
+                   if workflow_log_status(name, expected_inputs(name), workflow_path=os.path.join(input_folder, name)) != "done"]
+        print(f"👀 运行日志显示 {len(json_files) - len(pending)} 个工作流已全部成功，处理其余 {len(pending)} 个")
+        json_files = pending
+    metrics.add_total(len(json_files) * run.images_per_workflow)
+    if args.progress_interval > 0:
+        metrics.start_reporter()
     
-    processed_count = 0
-    error_count = 0
-    text_to_image_count = 0
-    image_to_image_count = 0
+    with run_profiler.stage("处理工作流"):
+        for position, pro in enumerate(json_files, 1):
+            process_workflow_file(run, pro, os.path.join(input_folder, pro), f"[{position}/{len(json_files)}]",
+                                  workflow=parsed.pop(pro, None))
     
-    for pro in json_files:
-        workflow_path = os.path.join(input_folder, pro)
-        workflow_has_error = False
-        workflow_error_msg = ""
-        error_stage = ""
-        workflow_type = "未知"
-        
-        try:
-            print(f"\n{'='*60}")
-            print(f"🔄 Processing workflow [{processed_count + 1}/{len(json_files)}]: {pro}")
-            print(f"{'='*60}")
-            
-            # ============ 阶段1: 读取工作流 ============
-            try:
-                with open(workflow_path, "r", encoding="utf-8") as f:
-                    workflow_data = f.read()
-                workflow = json.loads(workflow_data)
-                print("✅ 工作流读取成功")
-            except Exception as e:
-                error_stage = "文件读取/解析"
-                raise Exception(f"工作流文件读取失败: {e}")
-            
-            # ============ 阶段2: 准备输出目录 ============
-            write_folder_name = os.path.splitext(pro)[0]
-            write_folder = os.path.join("out", f"{write_folder_name}")
-            os.makedirs(write_folder, exist_ok=True)
-            
-            log_file = f"{pro}.csv"
-            
-            # ============ 阶段3: 判断工作流类型 ============
-            image_node_id = find_image_input_node(workflow)
-            
-            if image_node_id is None:
-                # 文生图工作流
-                workflow_type = "文生图"
-                print(f"🎨 检测到 [{workflow_type}] 工作流")
-                text_to_image_count += 1
-                
-                error_stage = "文生图处理"
-                success, err_msg = process_text_to_image_workflow(
-                    workflow, write_folder, log_file, write_folder_name
-                )
-                
-                if not success:
-                    workflow_has_error = True
-                    workflow_error_msg = err_msg
-                
-            else:
-                # 图生图工作流
-                workflow_type = "图生图"
-                print(f"🖼️  检测到 [{workflow_type}] 工作流")
-                print(f"✅ 找到图片输入节点: {image_node_id}")
-                image_to_image_count += 1
-                
-                error_stage = "图生图处理"
-                has_error, err_msg, count = process_image_to_image_workflow(
-                    workflow, image_node_id, read_folder, write_folder, log_file
-                )
-                
-                if has_error:
-                    workflow_has_error = True
-                    workflow_error_msg = err_msg
-                
-                print(f"✅ 工作流 {pro} 处理完成 (处理了 {count} 张图片)")
-            
-            # 工作流处理完成
-            processed_count += 1
-            
-            # 如果有错误，保存到错误文件夹
-            if workflow_has_error:
-                save_error_workflow(workflow_path, error_workflow_folder)
-                error_count += 1
-                
-                with open(error_log_file, 'a', newline='', encoding='utf-8') as f:
-                    writer = csv.writer(f)
-                    writer.writerow([
-                        pro,
-                        time.strftime('%Y-%m-%d %H:%M:%S'),
-                        workflow_type,
-                        error_stage,
-                        workflow_error_msg
-                    ])
-        
-        except Exception as e:
-            # 工作流级别的致命错误
-            print(f"\n❌ 工作流 {pro} 处理失败: {e}")
-            print(traceback.format_exc())
-            
-            error_count += 1
-            
-            # 保存到错误文件夹
+    total_files = len(json_files)
+
+    # ============ 接管其他客户端的任务 ============
+    if work_claims is not None and work_claims.lease_dir is not None:
+        # 自己的分片处理完后，接管其他分片中还没人开始的任务和租约过期（客户端崩溃）的任务，
+        # 直到全部任务都有完成标记；其他客户端还在处理的任务等租约结束后再检查
+        def workflow_items(name):
             try:
-                save_error_workflow(workflow_path, error_workflow_folder)
-            except:
-                pass
-            
-            # 记录到错误日志
-            with open(error_log_file, 'a', newline='', encoding='utf-8') as f:
-                writer = csv.writer(f)
-                writer.writerow([
-                    pro,
-                    time.strftime('%Y-%m-%d %H:%M:%S'),
-                    workflow_type,
-                    error_stage if error_stage else "工作流初始化",
-                    str(e)
-                ])
-            
-            print(f"⏭️  跳过该工作流，继续处理下一个...\n")
-            continue
+                workflow = json_codec.load(os.path.join(input_folder, name))
+            except Exception:
+                return None
+            if find_image_input_node(workflow) is None:
+                return [""]
+            return [os.path.relpath(path, read_folder).replace(os.sep, "/") for path, _ in iter_input_images(read_folder)]
+        work_claims.stealing = True
+        items = {name: workflow_items(name) for name in json_files}
+        while True:
+            claimable, leased = [], 0
+            for name in json_files:
+                if items[name] is None:
+                    continue
+                free, busy = work_claims.pending_counts(name, items[name])
+                if free:
+                    claimable.append(name)
+                leased += busy
+            if claimable:
+                before = work_claims.stats["claimed"] + work_claims.stats["taken_over"]
+                with run_profiler.stage("接管其他客户端的任务"):
+                    for pro in claimable:
+                        total_files += 1
+                        metrics.add_total(run.images_per_workflow)
+                        process_workflow_file(run, pro, os.path.join(input_folder, pro), "[接管]")
+                # 一项也没认领到（例如断点续跑日志中已完成但没有完成标记）时不再重复，避免空转
+                if work_claims.stats["claimed"] + work_claims.stats["taken_over"] > before:
+                    continue
+            if not leased:
+                break
+            print(f"⏳ 其他客户端还在处理 {leased} 项任务，{work_claims.ttl / 3:.0f}s 后检查是否有租约过期")
+            time.sleep(work_claims.ttl / 3)
+
+    # ============ 监视模式 ============
+    if watcher is not None:
+        print(f"\n👀 监视模式（{watcher.backend}）：等待 {input_folder} 中新增或修改的工作流，按 Ctrl+C 退出")
+        try:
+            while True:
+                for pro in watcher.changes(timeout=1.0):
+                    workflow_path = os.path.join(input_folder, pro)
+                    status = workflow_log_status(pro, workflow_expected_inputs(workflow_path, run.images_per_workflow),
+                                                 workflow_path=workflow_path)
+                    if status == "done":
+                        continue
+                    total_files += 1
+                    metrics.add_total(run.images_per_workflow)
+                    # 修改过的工作流全部重新处理，不跳过上一版本已完成的图片
+                    with run_profiler.stage("监视模式处理工作流"):
+                        process_workflow_file(run, pro, workflow_path, f"[监视 #{total_files - len(json_files)}]",
+                                              resume=args.resume and status != "changed")
+                    print(f"👀 继续监视 {input_folder} ...")
+        except KeyboardInterrupt:
+            print("\n👋 退出监视模式")
+        finally:
+            watcher.close()
     
     # ============ 最终统计 ============
     print(f"\n{'='*60}")
     print(f"📊 处理完成统计")
     print(f"{'='*60}")
-    print(f"总文件数: {len(json_files)}")
-    print(f"成功处理: {processed_count}")
-    print(f"  - 文生图: {text_to_image_count}")
-    print(f"  - 图生图: {image_to_image_count}")
-    print(f"失败数量: {error_count}")
-    print(f"未处理数: {len(json_files) - processed_count}")
+    print(f"总文件数: {total_files}")
+    print(f"成功处理: {run.processed}")
+    print(f"  - 文生图: {run.text_to_image}")
+    print(f"  - 图生图: {run.image_to_image}")
+    print(f"失败数量: {run.errors}")
+    print(f"未处理数: {total_files - run.processed}")
+    if work_claims is not None:
+        work_claims.close()
+        print(f"🤝 多客户端: {work_claims.summary()}")
+    journal.close()
+    get_log_sink().close()
+    metrics.stop_reporter()
+    metrics.print_summary()
+    if args.metrics_file:
+        metrics.write_prometheus(args.metrics_file)
+        print(f"📈 耗时直方图已导出: {args.metrics_file}")
+    with run_profiler.stage("保存清单与缓存"):
+        save_input_manifests()
+        if upload_cache is not None:
+            upload_cache.save()
+            print(f"上传缓存: 命中 {upload_cache.hits} 张，实际上传 {upload_cache.misses} 张")
+    if result_cache is not None:
+        print(f"结果缓存: 命中 {result_cache.hits} 次，未命中 {result_cache.misses} 次，"
+              f"占用 {result_cache.size / 1e6:.1f} MB")
+    if preprocess_stats["images"]:
+        print(f"上传前预处理: {preprocess_stats['images']} 张（缓存命中 {preprocess_stats['cache_hits']}），"
+              f"{preprocess_stats['bytes_in'] / 1e6:.1f} MB -> {preprocess_stats['bytes_out'] / 1e6:.1f} MB")
+    stats = http_pool.stats()
+    print(f"HTTP 连接: 请求 {stats['requests']} 次，新建连接 {stats['connections']} 个，复用 {stats['reused']} 次")
     
-    if error_count > 0:
-        print(f"\n⚠️  {error_count} 个工作流处理失败，已保存到 {error_workflow_folder}/")
-        print(f"详细错误信息请查看: {error_log_file}")
\ No newline at end of file
+    if run.errors > 0:
+        print(f"\n⚠️  {run.errors} 个工作流处理失败，已保存到 {error_workflow_folder}/")
+        print(f"详细错误信息请查看: {run.error_log_file}")
\ No newline at end of file
@@ -0,0 +1,102 @@
+import os
+import csv
+import json
+
+import json_codec
+from workflow_utils import find_image_input_node
+
+# 运行日志（<工作流>.json.csv 或 .json.jsonl）的读取和完成状态判断
+# png2png 写日志，png2png --watch 和 find_unprocessed_workflow 据此判断哪些工作流还需要处理；
+# 只依赖标准库，扫描脚本导入时不会拉入 requests 等依赖
+
+# 每个工作流日志（<工作流>.json.csv）的列
+RUN_LOG_FIELDS = ["index", "input", "output", "submit", "generate", "download", "total", "status", "error", "cache"]
+RUN_LOG_TIMING_FIELDS = ("submit", "generate", "download", "total")
+IMAGE_EXTS = ('.png', '.jpg', '.jpeg', '.bmp', '.webp') # 与 png2png.image_exts 相同
+
+def read_run_log(log_file):
+    '''
+    读取一个工作流日志（CSV 或 JSON Lines），返回字典列表，耗时列转成 float
+    '''
+    records = []
+    with open(log_file, "r", encoding="utf-8", newline="") as f:
+        if log_file.endswith(".jsonl"):
+            rows = (json.loads(line) for line in f if line.strip())
+        else:
+            rows = (dict(zip(RUN_LOG_FIELDS, row)) for row in csv.reader(f) if row)
+        for record in rows:
+            for key in RUN_LOG_TIMING_FIELDS:
+                value = record.get(key)
+                record[key] = float(value) if value not in (None, "") else None
+            records.append(record)
+    return records
+
+def workflow_log_status(workflow_name, expected=None, log_dir=".", workflow_path=None):
+    '''
+    根据运行日志中的 success / fail 行判断工作流的完成状态，<工作流>.csv 和 <工作流>.jsonl 都会读取
+    同一个输入有多行时以最后一行为准（重新处理时日志是追加的）
+
+    参数:
+        expected: 应有的输入数（图生图为图片数，文生图为 1），None 表示不检查数量，
+                  "unknown" 表示数量未知（不知道图生图读取的文件夹），日志中没有失败时不能断定已经处理完
+        workflow_path: 给出时，工作流文件比日志新则视为修改过、需要重新处理
+
+    返回:
+        str: "pending" 没有日志 / "done" 全部成功 / "failed" 有失败 / "partial" 没有处理完 / "changed" 日志之后修改过 /
+             "unknown" 成功的输入数无法与应有的数量比较
+    '''
+    logs = [p for p in (os.path.join(log_dir, f"{workflow_name}.{ext}") for ext in ("csv", "jsonl"))
+            if os.path.exists(p)]
+    if not logs:
+        return "pending"
+    logs.sort(key=os.path.getmtime)
+    if workflow_path is not None:
+        try:
+            if os.path.getmtime(workflow_path) > os.path.getmtime(logs[-1]):
+                return "changed"
+        except OSError:
+            pass
+    latest = {}
+    for log_file in logs:
+        try:
+            records = read_run_log(log_file)
+        except Exception as e:
+            print(f"⚠️  无法读取日志 {log_file}: {e}")
+            continue
+        for record in records:
+            latest[record.get("input")] = record.get("status")
+    if any(status == "fail" for status in latest.values()):
+        return "failed"
+    if not latest:
+        return "partial"
+    if expected == "unknown":
+        return "unknown"
+    if expected is not None and len(latest) < expected:
+        return "partial"
+    return "done"
+
+def count_input_images(read_folder, exts=IMAGE_EXTS):
+    '''
+    统计读取文件夹（含子文件夹）中的图片数，规则与 png2png 的输入清单相同：
+    跳过隐藏文件，不进入符号链接的目录；文件夹不存在时返回 0
+    '''
+    count = 0
+    for _, _, files in os.walk(read_folder):
+        count += sum(1 for name in files if name.lower().endswith(exts) and not name.startswith('.'))
+    return count
+
+def workflow_expected_inputs(workflow_path, image_count):
+    '''
+    一个工作流应有的输入数，作为 workflow_log_status 的 expected：
+    文生图为 1，图生图为读取文件夹中的图片数 image_count，image_count 为 None（不知道读取文件夹）时返回 "unknown"；
+    工作流无法读取时返回 None（不检查数量）
+    '''
+    try:
+        workflow = json_codec.load(workflow_path)
+    except Exception:
+        return None
+    if not isinstance(workflow, dict):
+        return None
+    if find_image_input_node(workflow) is None:
+        return 1
+    return "unknown" if image_count is None else image_count
@@ -0,0 +1,346 @@
+import os
+import sys
+import time
+import atexit
+import pstats
+import cProfile
+import threading
+import contextlib
+import tracemalloc
+
+# 运行性能分析（--profile 开启）：
+#   sample   定时采样全部线程的调用栈，统计每个函数的墙钟时间（自身 / 累计），并按调用栈归类为网络等待、JSON、日志写入等
+#   cprofile 用 cProfile 记录主线程和之后启动的线程的每次函数调用，另外导出 .prof 文件（可用 snakeviz 等工具查看）
+#            （Python 3.12+ 只能有一个 cProfile，见 PER_THREAD_CPROFILE）
+# 两种模式都会记录 stage() 标出的各阶段耗时，并用 tracemalloc 记录各阶段的内存峰值和主要分配位置
+# 没有开启时 stage() 直接返回空的上下文管理器，不产生额外开销
+# 进程池子进程中的耗时不在统计范围内，需要时用 --processes 1 在当前进程执行
+
+default_interval = 0.005 # 采样间隔（秒）
+top_functions = 40 # 报告中列出的函数数量
+top_allocations = 5 # 每个阶段列出的主要内存分配位置数量
+
+# 按调用栈归类：从最内层的帧往外找，第一个匹配的规则决定分类
+# 规则为 "文件名片段" 或 "文件名片段:函数名"（函数名以 . 结尾时匹配该类的全部方法）
+CATEGORIES = [
+    ("网络等待", ("socket.py", "ssl.py", "selectors.py", "http/client.py", "urllib3", "requests", "websocket")),
+    ("JSON 编解码", ("json/",)),
+    ("日志写入", ("csv.py", ":RunLogSink.", ":CheckpointJournal.")),
+    ("目录遍历", ("os.py:walk", ":iter_files")),
+]
+# 等待其他地方的结果：线程阻塞在锁或队列上时，按调用栈中的这些帧区分在等什么
+WAIT_CATEGORIES = [
+    ("等待任务完成", (":queue_prompt", ":CompletionWatcher.wait")),
+    ("等待子进程", ("multiprocessing/",)),
+]
+# 最内层的帧停在这些模块中时线程处于阻塞等待；工作线程最外层的帧总在这些模块中，所以只看最内层
+IDLE_MODULES = ("threading.py", "queue.py", "concurrent/futures/", "multiprocessing/")
+# 统计内存分配位置时排除分析工具自身
+ALLOCATION_FILTERS = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, __file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+]
+
+# Python 3.12 起 cProfile 基于 sys.monitoring：同一时刻只能有一个 cProfile 在运行（再启动会抛 ValueError），
+# 而且它本身就会记录全部线程，所以只在更早的版本中为每个新线程单独启动一个 cProfile
+PER_THREAD_CPROFILE = sys.version_info < (3, 12)
+
+_active = None # 运行时的 RunProfiler 实例
+_NULL_STAGE = contextlib.nullcontext()
+
+def _code_name(code):
+    return getattr(code, "co_qualname", code.co_name)
+
+def _match(rule, filename, name):
+    file_part, _, func_part = rule.partition(":")
+    if file_part and file_part not in filename:
+        return False
+    return not func_part or (func_part.endswith(".") and name.startswith(func_part)) or name == func_part
+
+def categorize(stack):
+    '''
+    stack: 从内到外的 (文件名, 函数名) 列表
+    '''
+    frames = [(filename.replace(os.sep, "/"), name) for filename, name in stack]
+    blocked = any(module in frames[0][0] for module in IDLE_MODULES)
+    for filename, name in frames:
+        for category, rules in WAIT_CATEGORIES if blocked else CATEGORIES + WAIT_CATEGORIES:
+            if any(_match(rule, filename, name) for rule in rules):
+                return category
+    return "线程空闲等待" if blocked else "其他（Python 代码）"
+
+class RunProfiler:
+    '''
+    一次运行的性能分析，结束时把报告写入 report_path
+
+    参数:
+        mode: "sample" 或 "cprofile"
+        interval: sample 模式的采样间隔（秒）
+        memory: 是否用 tracemalloc 记录各阶段的内存峰值（会让程序变慢，只看耗时时可以关闭）
+    '''
+    def __init__(self, report_path, mode="sample", interval=default_interval, memory=True):
+        self.report_path = report_path
+        self.mode = mode
+        self.interval = interval
+        self.memory = memory
+        self.started = time.time()
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self.stages = {}  # 阶段名 -> {"calls", "wall", "peak", "top"}
+        self._stack = []  # 主线程中正在执行的阶段 [名字, 开始时间, 内存峰值]
+        # sample 模式的统计（单位：秒）
+        self.samples = 0
+        self.self_time = {}
+        self.total_time = {}
+        self.category_time = {}
+        self.thread_time = {}
+        self._stop = threading.Event()
+        self._sampler = None
+        # cprofile 模式
+        self._profiles = []
+        self._profile = None
+
+    # ---------- 开始与结束 ----------
+
+    def start(self):
+        if self.memory:
+            tracemalloc.start()
+        if self.mode == "cprofile":
+            self._profile = cProfile.Profile()
+            if PER_THREAD_CPROFILE:
+                threading.setprofile(self._thread_hook)
+            self._profile.enable()
+        else:
+            self._sampler = threading.Thread(target=self._sample_loop, name="run_profiler", daemon=True)
+            self._sampler.start()
+
+    def _thread_hook(self, *args):
+        # 新线程第一次触发 profile 事件时为它单独启动一个 cProfile，结束时合并
+        profile = cProfile.Profile()
+        with self._lock:
+            self._profiles.append(profile)
+        profile.enable()
+
+    def stop(self):
+        self.elapsed = time.perf_counter() - self._start
+        if self.mode == "cprofile":
+            self._profile.disable()
+            if PER_THREAD_CPROFILE:
+                threading.setprofile(None)
+        else:
+            self._stop.set()
+            self._sampler.join()
+        while self._stack:
+            self._end_stage()  # 异常退出时没有结束的阶段
+        if self.memory:
+            self.memory_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    # ---------- 阶段 ----------
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if threading.current_thread() is not threading.main_thread():
+            # 工作线程中的阶段只累计耗时：内存峰值是整个进程共用的，多个线程同时重置会互相干扰
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                self._record_stage(name, time.perf_counter() - start, None, None)
+            return
+        if self.memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            for entry in self._stack:
+                entry[2] = max(entry[2], peak)
+            tracemalloc.reset_peak()
+        self._stack.append([name, time.perf_counter(), 0])
+        try:
+            yield
+        finally:
+            if self._stack and self._stack[-1][0] == name:
+                self._end_stage()
+
+    def _end_stage(self):
+        top = None
+        if self.memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            for entry in self._stack:
+                entry[2] = max(entry[2], peak)
+            snapshot = tracemalloc.take_snapshot().filter_traces(ALLOCATION_FILTERS)
+            stats = snapshot.statistics("lineno")[:top_allocations]
+            top = [(str(s.traceback[0]), s.size, s.count) for s in stats]
+        name, start, peak = self._stack.pop()
+        self._record_stage(name, time.perf_counter() - start, peak if self.memory else None, top)
+
+    def _record_stage(self, name, wall, peak, top):
+        with self._lock:
+            entry = self.stages.setdefault(name, {"calls": 0, "wall": 0.0, "peak": None, "top": None})
+            entry["calls"] += 1
+            entry["wall"] += wall
+            if peak is not None and (entry["peak"] is None or peak >= entry["peak"]):
+                entry["peak"], entry["top"] = peak, top
+
+    # ---------- 采样 ----------
+
+    def _sample_loop(self):
+        me = threading.get_ident()
+        last = time.perf_counter()
+        while not self._stop.wait(self.interval):
+            now = time.perf_counter()
+            dt, last = now - last, now
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_filename, _code_name(code), code.co_firstlineno))
+                    frame = frame.f_back
+                if not stack:
+                    continue
+                self._add(self.self_time, stack[0], dt)
+                for key in set(stack):
+                    self._add(self.total_time, key, dt)
+                self._add(self.category_time, categorize([(f, n) for f, n, _ in stack]), dt)
+                self._add(self.thread_time, names.get(ident, str(ident)), dt)
+            self.samples += 1
+
+    @staticmethod
+    def _add(table, key, dt):
+        table[key] = table.get(key, 0.0) + dt
+
+    # ---------- 报告 ----------
+
+    def report_lines(self):
+        lines = [
+            f"性能分析报告: {' '.join(sys.argv)}",
+            f"开始时间: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started))}  "
+            f"总耗时: {self.elapsed:.2f}s  模式: {self.mode}"
+            + (f"（间隔 {self.interval * 1000:.0f}ms，采样 {self.samples} 次）" if self.mode == "sample" else ""),
+        ]
+        if self.memory:
+            lines.append(f"tracemalloc 内存峰值: {self.memory_peak / 1e6:.1f} MB")
+
+        lines += ["", "== 阶段 ==", f"{'阶段':<30}{'次数':>8}{'耗时(s)':>12}{'占比':>8}{'内存峰值(MB)':>14}"]
+        for name, s in sorted(self.stages.items(), key=lambda item: -item[1]["wall"]):
+            peak = f"{s['peak'] / 1e6:.1f}" if s["peak"] is not None else "-"
+            share = s["wall"] / self.elapsed * 100 if self.elapsed else 0.0
+            lines.append(f"{name:<30}{s['calls']:>8}{s['wall']:>12.3f}{share:>7.1f}%{peak:>14}")
+        for name, s in self.stages.items():
+            if s["top"]:
+                lines.append(f"  {name} 结束时仍占用内存的主要分配位置:")
+                lines += [f"    {where}  {size / 1e6:.2f} MB / {count} 个对象" for where, size, count in s["top"]]
+
+        if self.mode == "sample":
+            total = sum(self.thread_time.values()) or 1.0
+            lines += ["", "== 耗时分类（全部线程的墙钟时间之和） =="]
+            for category, t in sorted(self.category_time.items(), key=lambda item: -item[1]):
+                lines.append(f"{category:<20}{t:>10.2f}s{t / total * 100:>7.1f}%")
+            lines += ["", "== 线程 =="]
+            for name, t in sorted(self.thread_time.items(), key=lambda item: -item[1]):
+                lines.append(f"{name:<40}{t:>10.2f}s")
+            lines += ["", f"== 函数墙钟时间（全部线程，按累计排序，前 {top_functions} 个） ==",
+                      f"{'累计(s)':>10}{'自身(s)':>10}  函数"]
+            for key, t in sorted(self.total_time.items(), key=lambda item: -item[1])[:top_functions]:
+                filename, name, lineno = key
+                lines.append(f"{t:>10.3f}{self.self_time.get(key, 0.0):>10.3f}  "
+                             f"{name} ({os.path.basename(filename)}:{lineno})")
+        else:
+            stats = self.cprofile_stats()
+            for sort_key, title in (("cumulative", "累计耗时"), ("tottime", "自身耗时")):
+                out = _StringLines()
+                stats.stream = out
+                stats.sort_stats(sort_key).print_stats(top_functions)
+                lines += ["", f"== 函数{title}（cProfile，前 {top_functions} 个） =="] + out.lines()
+            lines.append(f"完整数据: {self.report_path}.prof")
+            if not PER_THREAD_CPROFILE:
+                lines.append("注: Python 3.12+ 全部线程共用一个 cProfile，多个线程同时运行时各函数的耗时会互相重叠，"
+                             "线程间的耗时分布请用 sample 模式查看")
+        lines += ["", "注: 进程池子进程中的耗时不在统计范围内"]
+        return lines
+
+    def cprofile_stats(self):
+        stats = pstats.Stats(self._profile)
+        with self._lock:
+            profiles = list(self._profiles)
+        for profile in profiles:
+            try:
+                stats.add(profile)
+            except (TypeError, ValueError):
+                continue  # 没有记录到任何调用的线程
+        return stats
+
+    def write_report(self):
+        if self.mode == "cprofile":
+            self.cprofile_stats().dump_stats(self.report_path + ".prof")
+        with open(self.report_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(self.report_lines()) + "\n")
+
+class _StringLines:
+    def __init__(self):
+        self._parts = []
+
+    def write(self, text):
+        self._parts.append(text)
+
+    def lines(self):
+        return "".join(self._parts).rstrip("\n").split("\n")
+
+# ============ 模块级接口 ============
+
+def start(report_path, mode="sample", interval=default_interval, memory=True):
+    '''
+    开始性能分析，程序退出时自动写报告
+    '''
+    global _active
+    if _active is not None:
+        return _active
+    _active = RunProfiler(report_path, mode, interval, memory)
+    _active.start()
+    atexit.register(stop)
+    print(f"⏱️  性能分析已开启（{mode}{'，记录内存' if memory else ''}），报告: {report_path}")
+    return _active
+
+def stop():
+    '''
+    结束性能分析并写报告
+
+    返回:
+        str: 报告路径；没有开启时返回 None
+    '''
+    global _active
+    profiler, _active = _active, None
+    if profiler is None:
+        return None
+    profiler.stop()
+    profiler.write_report()
+    print(f"⏱️  性能分析报告已写入: {profiler.report_path}")
+    return profiler.report_path
+
+def stage(name):
+    '''
+    标记一个阶段：with run_profiler.stage("列出文件"): ...
+    '''
+    if _active is None:
+        return _NULL_STAGE
+    return _active.stage(name)
+
+def add_arguments(parser, default_report):
+    '''
+    给脚本的 argparse 添加 --profile 相关参数
+    '''
+    parser.add_argument("--profile", nargs="?", const=default_report, default=None, metavar="REPORT",
+                        help=f"开启性能分析，结束时把报告写入 REPORT（默认 {default_report}）")
+    parser.add_argument("--profile-mode", choices=("sample", "cprofile"), default="sample",
+                        help="sample 定时采样全部线程（开销小），cprofile 记录每次函数调用（默认 %(default)s）")
+    parser.add_argument("--profile-interval", type=float, default=default_interval,
+                        help="sample 模式的采样间隔秒数（默认 %(default)s）")
+    parser.add_argument("--profile-no-memory", action="store_true",
+                        help="不用 tracemalloc 记录内存峰值（tracemalloc 会让程序变慢，影响耗时数据）")
+
+def start_from_args(args):
+    if args.profile:
+        start(args.profile, args.profile_mode, args.profile_interval, not args.profile_no_memory)
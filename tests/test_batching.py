@@ -0,0 +1,76 @@
+import os
+import io
+import argparse
+import contextlib
+
+import pytest
+
+import png2png
+import bench_png2png
+from comfy_mock_server import MockComfyServer
+
+# 批量提交：多张图片合并成一个任务，结果按图片分回，与逐张提交时得到的输出相同
+
+WORKFLOW = {
+    "4": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "model.safetensors"}},
+    "1": {"class_type": "LoadImage", "inputs": {"image": "placeholder.png"}},
+    "2": {"class_type": "ImageScale", "inputs": {"image": ["1", 0], "width": 512, "height": 512}},
+    "5": {"class_type": "KSampler", "inputs": {"model": ["4", 0], "latent_image": ["2", 0]}},
+    "9": {"class_type": "SaveImage", "inputs": {"images": ["5", 0]}},
+    # 不依赖图片输入的输出分支
+    "6": {"class_type": "KSampler", "inputs": {"model": ["4", 0], "seed": 1}},
+    "7": {"class_type": "SaveImage", "inputs": {"images": ["6", 0]}},
+}
+
+def test_build_batched_prompt():
+    prompt, owner = png2png.build_batched_prompt(WORKFLOW, "1", ["a.png", "b.png"])
+
+    # 共用的节点只有一份
+    assert prompt["4"] == WORKFLOW["4"] and prompt["6"] == WORKFLOW["6"]
+    for i, image in enumerate(["a.png", "b.png"]):
+        p = f"b{i}_"
+        assert prompt[p + "1"]["inputs"]["image"] == image
+        assert prompt[p + "2"]["inputs"]["image"] == [p + "1", 0]
+        assert prompt[p + "5"]["inputs"] == {"model": ["4", 0], "latent_image": [p + "2", 0]}
+        # 不依赖图片的输出节点每张图片一份，引用共用的上游节点
+        assert prompt[p + "7"]["inputs"] == {"images": ["6", 0]}
+        assert owner[p + "9"] == i and owner[p + "7"] == i
+    assert set(prompt) == {"4", "6"} | {f"b{i}_{n}" for i in range(2) for n in ("1", "2", "5", "9", "7")}
+    # 原工作流不被修改
+    assert WORKFLOW["1"]["inputs"]["image"] == "placeholder.png"
+
+@pytest.fixture
+def server():
+    mock = MockComfyServer(latency=0.01, output_size=1000).start()
+    yield mock
+    png2png.close_completion_watchers()
+    mock.stop()
+
+def run_folder(tmp_path, server, name, batch_size):
+    args = argparse.Namespace(max_inflight=1, upload_workers=1, download_workers=1, completion="auto",
+                              prompt_timeout=30, shared_fs=False, upload_cache=False, result_cache=False,
+                              preprocess=None)
+    work_dir = os.path.join(tmp_path, name)
+    read_folder = os.path.join(tmp_path, "pic")
+    write_folder = os.path.join(work_dir, "out")
+    os.makedirs(write_folder)
+    bench_png2png.configure_png2png([server.url], args, work_dir)
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = png2png.process_image_to_image_workflow(WORKFLOW, "1", read_folder, write_folder,
+                                                         os.path.join(work_dir, "log.csv"), batch_size=batch_size,
+                                                         workflow_name="w.json")
+    png2png.log_sink.close()
+    return result, sorted(os.listdir(write_folder))
+
+def test_batched_outputs_match_single_prompts(tmp_path, server):
+    bench_png2png.make_images(os.path.join(tmp_path, "pic"), 5, 2000)
+
+    single, single_files = run_folder(tmp_path, server, "single", batch_size=1)
+    prompts = server.stats["prompts"]
+    batched, batched_files = run_folder(tmp_path, server, "batched", batch_size=2)
+
+    assert single == batched == (False, "", 5)
+    assert server.stats["prompts"] - prompts == 3
+    # 每张图片两个输出（依赖图片的和不依赖图片的），两种方式的输出文件相同
+    assert len(single_files) == 10
+    assert batched_files == single_files
@@ -0,0 +1,79 @@
+import time
+import argparse
+import threading
+
+import pytest
+
+import png2png
+import bench_png2png
+from comfy_mock_server import MockComfyServer
+
+# 任务完成检测：websocket 推送的完成事件、执行出错，以及运行中途 websocket 断开后退回 /history 轮询
+
+PROMPT = {"3": {"class_type": "KSampler", "inputs": {"seed": 1}},
+          "9": {"class_type": "SaveImage", "inputs": {"images": ["3", 0]}}}
+
+@pytest.fixture
+def mock(tmp_path):
+    servers = []
+
+    def start(**kwargs):
+        server = MockComfyServer(output_size=1000, **kwargs).start()
+        servers.append(server)
+        args = argparse.Namespace(max_inflight=1, upload_workers=1, download_workers=1, completion="auto",
+                                  prompt_timeout=30, shared_fs=False, upload_cache=False, result_cache=False,
+                                  preprocess=None)
+        bench_png2png.configure_png2png([server.url], args, str(tmp_path))
+        return server
+
+    yield start
+    png2png.close_completion_watchers()
+    for server in servers:
+        server.stop()
+
+def test_websocket_completion(mock):
+    server = mock(latency=0.5)
+    watcher = png2png.get_completion_watcher(server.url)
+    assert watcher.connected.is_set()
+
+    pid = png2png.push_prompt(PROMPT, server.url)
+    out_urls = png2png.queue_prompt(pid, base_url=server.url)
+
+    assert len(out_urls) == 1
+    # 完成事件到达后只查询一次 /history；轮询 0.5 秒的任务至少要查询 3 次
+    assert server.stats["history_requests"] == 1
+    # 服务器随后还会发送 executing(node=None)，已取走的任务不再记录
+    time.sleep(0.2)
+    assert watcher._finished == {}
+
+def test_websocket_execution_error(mock):
+    server = mock(latency=0.1, failure_rate=1.0)
+    pid = png2png.push_prompt(PROMPT, server.url)
+
+    with pytest.raises(png2png.PromptExecutionError, match="mock failure"):
+        png2png.queue_prompt(pid, base_url=server.url)
+    assert server.stats["history_requests"] == 1
+
+def test_websocket_drop_falls_back_to_polling(mock):
+    server = mock(latency=1.0)
+    watcher = png2png.get_completion_watcher(server.url)
+    assert watcher.connected.is_set()
+
+    pid = png2png.push_prompt(PROMPT, server.url)
+    threading.Timer(0.3, server.drop_websockets).start()
+    out_urls = png2png.queue_prompt(pid, base_url=server.url)
+
+    assert len(out_urls) == 1
+    assert not watcher.connected.is_set()
+    assert server.stats["history_requests"] > 1
+
+def test_failed_host_closes_its_watcher(mock):
+    server = mock(latency=0.1)
+    watcher = png2png.get_completion_watcher(server.url)
+    assert watcher.connected.is_set()
+
+    png2png.HostPool([server.url]).mark_failed(server.url, ConnectionError("down"))
+
+    assert server.url not in png2png._watchers
+    watcher._thread.join(timeout=5)
+    assert not watcher._thread.is_alive()
@@ -0,0 +1,83 @@
+import os
+import sys
+import json
+
+import pytest
+
+from extractJson import extract_json_files, NameRegistry, MANIFEST_NAME
+from json_scanner import iter_files
+
+# JSON 提取：重名处理（覆盖 / 重命名）在并行复制时的结果与逐个复制时相同，文件名登记表和按内容去重
+
+def write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(content)
+
+def read(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
+@pytest.fixture
+def tree(tmp_path):
+    root = str(tmp_path)
+    for i in range(40):
+        write(os.path.join(root, f"d{i}", "same.json"), '{"source": %d}' % i + " " * 1000 * i)
+        write(os.path.join(root, f"d{i}", f"only{i}.json"), "{}")
+    return root
+
+def test_overwrite_keeps_last_walked(tree, capsys):
+    out = os.path.join(tree, "json_workflow")
+    os.makedirs(out)
+    walked = [p for p in iter_files(tree, skip_dirs=[out]) if os.path.basename(p) == "same.json"]
+    extract_json_files(tree, "json_workflow", "overwrite", processes=4, link_mode="copy")
+
+    assert read(os.path.join(out, "same.json")) == read(walked[-1])
+    assert len(os.listdir(out)) == 41
+    assert "被同名文件覆盖:39" in capsys.readouterr().out
+
+def test_rename_numbers_in_walk_order(tree, capsys):
+    out = os.path.join(tree, "json_workflow")
+    os.makedirs(out)
+    walked = [p for p in iter_files(tree, skip_dirs=[out]) if os.path.basename(p) == "same.json"]
+    extract_json_files(tree, "json_workflow", "rename", processes=4, link_mode="copy")
+
+    assert read(os.path.join(out, "same.json")) == read(walked[0])
+    for n, path in enumerate(walked[1:], 1):
+        assert read(os.path.join(out, f"same_{n}.json")) == read(path)
+    assert not [name for name in os.listdir(out) if name.endswith(".tmp")]
+
+def test_name_registry(tmp_path, monkeypatch):
+    write(os.path.join(tmp_path, "a.json"), "{}")
+    write(os.path.join(tmp_path, "a_1.json"), "{}")
+    registry = NameRegistry(str(tmp_path))
+    assert "a.json" in registry and "b.json" not in registry
+    # 跳过已有的编号，同一个文件名的下一次重命名从上次用到的编号继续
+    assert registry.unique("a.json") == "a_2.json"
+    assert registry.unique("a.json") == "a_3.json"
+    registry.add("b.json")
+    assert "b.json" in registry
+
+    monkeypatch.setattr(sys, "platform", "darwin")
+    folded = NameRegistry(str(tmp_path))
+    assert "A.JSON" in folded
+    assert folded.unique("A.json") == "A_2.json"
+
+def test_dedup_stores_each_content_once(tree, capsys):
+    out = os.path.join(tree, "json_workflow")
+    write(os.path.join(tree, "copy", "same.json"), read(os.path.join(tree, "d3", "same.json")))
+    extract_json_files(tree, "json_workflow", "dedup", processes=2, link_mode="copy")
+
+    manifest = json.loads(read(os.path.join(out, MANIFEST_NAME)))
+    sources = manifest["sources"]
+    # 40 个内容不同的 same.json 各保存一份（copy/ 下的与 d3/ 下的相同），40 个内容都是 {} 的 only*.json 只保存一份
+    assert len(manifest["objects"]) == 41 and len(sources) == 81
+    assert sources[os.path.join("copy", "same.json")] == sources[os.path.join("d3", "same.json")]
+    for rel_path, name in sources.items():
+        assert read(os.path.join(out, name)) == read(os.path.join(tree, rel_path))
+    # 按路径顺序编号，再次运行时清单中已有的文件不再处理
+    assert sources[os.path.join("copy", "same.json")] == "same.json"
+    capsys.readouterr()
+    extract_json_files(tree, "json_workflow", "dedup", processes=2, link_mode="copy")
+    assert "清单中已有:81" in capsys.readouterr().out
+    assert len(os.listdir(out)) == 42
@@ -0,0 +1,78 @@
+import os
+import io
+import csv
+import argparse
+import contextlib
+
+import pytest
+
+import png2png
+import bench_png2png
+from comfy_mock_server import MockComfyServer
+
+# 多服务器派发：用两台速度不同的模拟服务器跑图生图流程，检查按速度分配任务和服务器不可用时的重新派发
+
+FAST_LATENCY = 0.05
+SLOW_LATENCY = 0.2
+
+@pytest.fixture
+def servers():
+    started = []
+
+    def start(*latencies):
+        for i, latency in enumerate(latencies):
+            started.append(MockComfyServer(latency=latency, output_size=1000, seed=i).start())
+        return started
+
+    yield start
+    png2png.close_completion_watchers()
+    for server in started:
+        server.stop()
+
+def run_images(tmp_path, host_urls, images, max_inflight, before_run=None):
+    '''
+    用 bench_png2png 的方式重置 png2png 后处理 images 张图片，返回运行日志的全部行
+    '''
+    args = argparse.Namespace(max_inflight=max_inflight, upload_workers=2, download_workers=2, completion="auto",
+                              prompt_timeout=30, shared_fs=False, upload_cache=False, result_cache=False,
+                              preprocess=None)
+    read_folder = os.path.join(tmp_path, "pic")
+    write_folder = os.path.join(tmp_path, "out")
+    log_file = os.path.join(tmp_path, "bench.json.csv")
+    bench_png2png.make_images(read_folder, images, 2000)
+    os.makedirs(write_folder)
+    bench_png2png.configure_png2png(host_urls, args, str(tmp_path))
+    if before_run is not None:
+        before_run()
+    with contextlib.redirect_stdout(io.StringIO()):
+        png2png.process_image_to_image_workflow(bench_png2png.BENCH_WORKFLOW, "1", read_folder, write_folder,
+                                                log_file, max_inflight=max_inflight, workflow_name="bench.json")
+    png2png.log_sink.close()
+    with open(log_file, "r", encoding="utf-8", newline="") as f:
+        return list(csv.reader(f))
+
+def test_work_split_follows_host_speed(tmp_path, servers):
+    fast, slow = servers(FAST_LATENCY, SLOW_LATENCY)
+    rows = run_images(tmp_path, [fast.url, slow.url], images=60, max_inflight=4)
+
+    assert len(rows) == 60 and all(row[7] == "success" for row in rows)
+    assert fast.stats["prompts"] + slow.stats["prompts"] == 60
+    # 快的服务器速度是慢的 4 倍，理想情况下分到 80% 的任务；平均分配时只有 50%
+    fast_share = fast.stats["prompts"] / 60
+    assert 0.7 <= fast_share <= 0.9, f"快服务器分到 {fast_share:.0%} 的任务"
+
+def test_failed_host_jobs_are_requeued(tmp_path, servers, monkeypatch):
+    dead, alive = servers(FAST_LATENCY, SLOW_LATENCY)
+    monkeypatch.setattr(png2png, "retry_base_delay", 0.01)
+
+    def kill_first_host():
+        # 健康检查通过后服务器停止：排队最少时优先选列表中的第一台，前几个任务一定先派给它
+        assert png2png.host_pool.check_all() == [dead.url, alive.url]
+        dead.stop()
+
+    rows = run_images(tmp_path, [dead.url, alive.url], images=10, max_inflight=2, before_run=kill_first_host)
+
+    assert len(rows) == 10 and all(row[7] == "success" for row in rows)
+    assert dead.stats["prompts"] == 0
+    assert alive.stats["prompts"] == 10
+    assert png2png.host_pool._state[dead.url]["up"] is False
@@ -0,0 +1,80 @@
+import os
+import time
+
+import png2png
+import run_logs
+
+# 输入图片清单：遍历规则、按目录修改时间增量刷新、内容哈希复用
+
+def touch(path, content=b"img"):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(content)
+
+def age_dirs(root, seconds=60):
+    # 刚修改过的目录不记录修改时间，测试中把目录时间调早，模拟之前的运行
+    past = time.time() - seconds
+    for folder, _, _ in os.walk(root):
+        os.utime(folder, (past, past))
+
+def make_tree(root):
+    touch(os.path.join(root, "b.png"))
+    touch(os.path.join(root, "a.JPG"))
+    touch(os.path.join(root, ".hidden.png"))
+    touch(os.path.join(root, "notes.txt"))
+    touch(os.path.join(root, "sub", "c.webp"))
+    touch(os.path.join(root, "sub", "deeper", "d.png"))
+    outside = os.path.join(os.path.dirname(root), "outside")
+    touch(os.path.join(outside, "e.png"))
+    os.symlink(outside, os.path.join(root, "linked"))
+
+def names(manifest):
+    return [os.path.relpath(path, manifest.root) for path, _ in manifest.images()]
+
+def test_listing_rules(tmp_path):
+    root = os.path.join(tmp_path, "pic")
+    make_tree(root)
+    manifest = png2png.InputManifest(root, os.path.join(tmp_path, "manifest.json")).refresh()
+    # 目录先序、文件名排序；跳过隐藏文件、非图片文件和符号链接的目录
+    assert names(manifest) == ["a.JPG", "b.png", os.path.join("sub", "c.webp"),
+                               os.path.join("sub", "deeper", "d.png")]
+    assert len(manifest) == 4
+    # find_unprocessed_workflow 统计图片数的规则相同
+    assert run_logs.count_input_images(root) == 4
+
+def test_incremental_refresh_reuses_unchanged_dirs(tmp_path):
+    root = os.path.join(tmp_path, "pic")
+    manifest_file = os.path.join(tmp_path, "manifest.json")
+    make_tree(root)
+    age_dirs(root)
+    first = png2png.InputManifest(root, manifest_file).refresh(with_hash=True)
+    first.save()
+    assert (first.listed, first.reused) == (3, 0)
+
+    second = png2png.InputManifest(root, manifest_file).refresh()
+    assert (second.listed, second.reused) == (0, 3)
+    assert names(second) == names(first)
+
+    # 新增文件只重新列出所在的目录
+    touch(os.path.join(root, "sub", "deeper", "f.png"))
+    third = png2png.InputManifest(root, manifest_file).refresh()
+    assert (third.listed, third.reused) == (1, 2)
+    assert os.path.join("sub", "deeper", "f.png") in names(third)
+
+def test_digest_reuses_recorded_hash(tmp_path):
+    root = os.path.join(tmp_path, "pic")
+    manifest_file = os.path.join(tmp_path, "manifest.json")
+    touch(os.path.join(root, "a.png"), b"first")
+    manifest = png2png.InputManifest(root, manifest_file).refresh(with_hash=True)
+    manifest.save()
+    path = os.path.join(root, "a.png")
+    assert manifest.digest(path) == png2png.file_sha256(path)
+    assert manifest.digest(os.path.join(tmp_path, "elsewhere.png")) is None
+
+    reloaded = png2png.InputManifest(root, manifest_file).refresh()
+    recorded = reloaded._files["a.png"]["sha256"]
+    assert recorded == png2png.file_sha256(path)
+
+    # 内容变化（大小不同）后重新计算
+    touch(path, b"second version")
+    assert reloaded.digest(path) == png2png.file_sha256(path) != recorded
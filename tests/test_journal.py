@@ -0,0 +1,78 @@
+import os
+import sys
+import json
+import subprocess
+
+import pytest
+
+import png2png
+from comfy_mock_server import MockComfyServer
+
+# 断点续跑日志：记录、重新读取，以及 --resume 跳过已完成的图片
+
+PNG2PNG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "png2png.py")
+
+def test_journal_survives_reopen_and_truncated_line(tmp_path):
+    path = os.path.join(tmp_path, "journal.jsonl")
+    journal = png2png.CheckpointJournal(path, fsync_every=1)
+    journal.record("a.json", "/pic/1.png", "/out/1.png")
+    journal.record("t.json", "", "/out/t.png")
+    journal.close()
+    # 崩溃时写了一半的最后一行
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"workflow": "a.json", "inp')
+
+    reopened = png2png.CheckpointJournal(path)
+    assert len(reopened) == 2
+    assert reopened.is_done("a.json", "/pic/1.png")
+    assert reopened.is_done("t.json")
+    assert not reopened.is_done("a.json", "/pic/2.png")
+    assert not reopened.is_done("b.json", "/pic/1.png")
+    reopened.close()
+
+@pytest.fixture
+def server():
+    mock = MockComfyServer(latency=0.01, output_size=1000).start()
+    yield mock
+    mock.stop()
+
+def run_png2png(root, server, *extra):
+    result = subprocess.run(
+        [sys.executable, PNG2PNG, "--hosts", server.url,
+         "--input-folder", os.path.join(root, "workflow"), "--read-folder", os.path.join(root, "pic"),
+         "--progress-interval", "0", "--metrics-file", "", *extra],
+        cwd=root, capture_output=True, text=True, timeout=120)
+    assert result.returncode == 0, result.stdout + result.stderr
+    return result.stdout
+
+def add_images(root, names):
+    for name in names:
+        with open(os.path.join(root, "pic", name), "wb") as f:
+            f.write(b"\x89PNG\r\n\x1a\n" + name.encode())
+
+def test_resume_skips_completed_images(tmp_path, server):
+    root = str(tmp_path)
+    os.makedirs(os.path.join(root, "workflow"))
+    os.makedirs(os.path.join(root, "pic"))
+    with open(os.path.join(root, "workflow", "a.json"), "w", encoding="utf-8") as f:
+        json.dump({"1": {"class_type": "LoadImage", "inputs": {"image": "x.png"}},
+                   "9": {"class_type": "SaveImage", "inputs": {"images": ["1", 0]}}}, f)
+    with open(os.path.join(root, "workflow", "t.json"), "w", encoding="utf-8") as f:
+        json.dump({"3": {"class_type": "KSampler", "inputs": {"seed": 1}},
+                   "9": {"class_type": "SaveImage", "inputs": {"images": ["3", 0]}}}, f)
+    add_images(root, ["p0.png", "p1.png", "p2.png"])
+
+    run_png2png(root, server, "--resume")
+    assert server.stats["prompts"] == 3 + 1
+
+    # 新增两张图片后续跑：只处理新图片，文生图工作流整个跳过
+    add_images(root, ["p3.png", "p4.png"])
+    run_png2png(root, server, "--resume")
+    assert server.stats["prompts"] == 4 + 2
+    journal = png2png.CheckpointJournal(os.path.join(root, png2png.journal_file))
+    assert len(journal) == 5 + 1
+    journal.close()
+
+    # 不加 --resume 时全部重新处理
+    run_png2png(root, server)
+    assert server.stats["prompts"] == 6 + 5 + 1
@@ -0,0 +1,48 @@
+import json
+
+import pytest
+
+import json_codec
+from json_codec import PromptTemplate
+
+# JSON 编解码：各实现的结果与标准库一致，请求体模板替换后与直接序列化相同
+
+BACKENDS = sorted(json_codec.BACKENDS)
+
+@pytest.fixture(params=BACKENDS)
+def backend(request):
+    previous = json_codec.use_backend(request.param)
+    yield request.param
+    json_codec.use_backend(previous)
+
+def test_round_trip(backend):
+    obj = {"1": {"class_type": "LoadImage", "inputs": {"image": "图片 \"a\".png", "seed": 2 ** 70, "cfg": 7.5}}}
+    data = json_codec.dumps(obj)
+    assert isinstance(data, bytes)
+    assert json.loads(data) == obj
+    assert json_codec.loads(data) == json_codec.loads(data.decode("utf-8")) == obj
+    # 带 BOM 的文件和标准库的扩展写法
+    assert json_codec.loads(json_codec.UTF8_BOM + b'{"a": 1}') == {"a": 1}
+    assert json_codec.loads(b'{"a": NaN}')["a"] != json_codec.loads(b'{"a": NaN}')["a"]
+    with pytest.raises(ValueError):
+        json_codec.loads(b'{"a": ')
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        json_codec.use_backend("simdjson")
+
+def test_prompt_template(backend):
+    marker = "__png2png_image__"
+    workflow = {"1": {"class_type": "LoadImage", "inputs": {"image": marker}},
+                "2": {"class_type": "SaveImage", "inputs": {"filename_prefix": "out"}}}
+    template = PromptTemplate({"prompt": workflow, "client_id": "c1"}, marker)
+    assert template.backend == backend
+    for name in ("a.png", 'quote"and\\backslash.png', "中文.png"):
+        expected = {"prompt": {**workflow, "1": {"class_type": "LoadImage", "inputs": {"image": name}}},
+                    "client_id": "c1"}
+        assert json.loads(template.render(name)) == expected
+
+    with pytest.raises(ValueError):
+        PromptTemplate({"a": marker, "b": marker}, marker)
+    with pytest.raises(ValueError):
+        PromptTemplate({"a": "x"}, marker)
@@ -0,0 +1,66 @@
+import os
+import random
+
+import png2png
+
+# 延迟直方图与 Prometheus 文本导出
+
+def test_percentile_relative_error():
+    histogram = png2png.LatencyHistogram()
+    rng = random.Random(1)
+    values = sorted(rng.expovariate(1) for _ in range(10000))
+    for value in values:
+        histogram.observe(value)
+    for q in (50, 95, 99):
+        exact = values[int(len(values) * q / 100) - 1]
+        assert exact <= histogram.percentile(q) <= exact * histogram.growth
+    assert histogram.count == 10000
+    assert histogram.percentile(50) is not None and png2png.LatencyHistogram().percentile(50) is None
+
+def test_cumulative_counts_are_exact():
+    histogram = png2png.LatencyHistogram()
+    rng = random.Random(2)
+    # 正好落在边界上的值和略大于边界的值都要有
+    values = [0.1] * 10 + [0.1000001] * 3 + [rng.uniform(0, 30) for _ in range(5000)] + [2000]
+    for value in values:
+        histogram.observe(value)
+    expected = [sum(v <= bound for v in values) for bound in png2png.PROMETHEUS_BUCKETS]
+    assert histogram.cumulative() == expected
+
+def test_merge_keeps_exact_counts():
+    a, b = png2png.LatencyHistogram(), png2png.LatencyHistogram()
+    for value in (0.05, 0.3, 7):
+        a.observe(value)
+    for value in (0.1, 0.3, 600):
+        b.observe(value)
+    a.merge(b)
+    assert a.count == 6
+    assert a.cumulative()[:4] == [1, 2, 2, 4]
+    assert a.cumulative()[-1] == 6
+
+def test_prometheus_text(tmp_path):
+    metrics = png2png.RunMetrics()
+    metrics.record({"host": "http://h1", "submit": 0.1, "generate": 3.0, "download": 0.2, "total": 3.3}, "a.json")
+    metrics.record({"host": "http://h1", "submit": 0.1, "generate": 30.0, "download": 0.2, "total": 30.3}, "a.json")
+    metrics.record_failure("a.json")
+    path = os.path.join(tmp_path, "metrics.prom")
+    metrics.write_prometheus(path)
+    with open(path, "r", encoding="utf-8") as f:
+        lines = f.read().splitlines()
+
+    labels = 'stage="generate",workflow="a.json",host="http://h1"'
+    assert f'png2png_stage_seconds_bucket{{{labels},le="2.5"}} 0' in lines
+    assert f'png2png_stage_seconds_bucket{{{labels},le="5"}} 1' in lines
+    assert f'png2png_stage_seconds_bucket{{{labels},le="25"}} 1' in lines
+    assert f'png2png_stage_seconds_bucket{{{labels},le="50"}} 2' in lines
+    assert f'png2png_stage_seconds_bucket{{{labels},le="+Inf"}} 2' in lines
+    assert f"png2png_stage_seconds_count{{{labels}}} 2" in lines
+    assert f"png2png_stage_seconds_sum{{{labels}}} 33.000000" in lines
+    assert "# TYPE png2png_stage_seconds histogram" in lines
+    assert 'png2png_images_total{status="success"} 2' in lines
+    assert 'png2png_images_total{status="fail"} 1' in lines
+    # 每个序列的 le 桶累计计数单调不减
+    for stage in ("submit", "generate", "download", "total"):
+        prefix = f'png2png_stage_seconds_bucket{{stage="{stage}",'
+        counts = [int(line.rsplit(" ", 1)[1]) for line in lines if line.startswith(prefix)]
+        assert counts == sorted(counts) and counts[-1] == 2
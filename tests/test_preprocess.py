@@ -0,0 +1,75 @@
+import os
+
+import pytest
+
+import png2png
+
+# 上传前预处理：按下游缩放节点推断尺寸、转码、磁盘缓存，以及不能处理时上传原图
+
+pytestmark = pytest.mark.skipif(png2png.Image is None, reason="需要 Pillow")
+
+SCALED = {
+    "1": {"class_type": "LoadImage", "inputs": {"image": "x.png"}},
+    "2": {"class_type": "ImageScale", "inputs": {"image": ["1", 0], "width": 512, "height": 256}},
+    "3": {"class_type": "ImageResize+", "inputs": {"image": ["1", 0], "width": 300, "height": 400}},
+}
+
+@pytest.fixture
+def prep_env(tmp_path, monkeypatch):
+    monkeypatch.setattr(png2png, "preprocess_format", "webp")
+    monkeypatch.setattr(png2png, "preprocess_size", None)
+    monkeypatch.setattr(png2png, "preprocess_cache_dir", os.path.join(tmp_path, "cache"))
+    monkeypatch.setattr(png2png, "_prepared_paths", {})
+    monkeypatch.setattr(png2png, "preprocess_stats", {"images": 0, "cache_hits": 0, "bytes_in": 0, "bytes_out": 0})
+    return tmp_path
+
+def noise_image(path, size, mode="RGB"):
+    img = png2png.Image.effect_noise(size, 40).convert(mode)
+    img.save(path)
+    return path
+
+def test_target_size_from_resize_nodes():
+    assert png2png.workflow_target_size(SCALED, "1") == (512, 400)
+    unscaled = dict(SCALED, **{"4": {"class_type": "VAEEncode", "inputs": {"pixels": ["1", 0]}}})
+    assert png2png.workflow_target_size(unscaled, "1") is None
+
+def test_params_only_when_enabled(prep_env, monkeypatch):
+    assert png2png.preprocess_params(SCALED, "1") == {"format": "webp", "quality": 90, "size": [512, 400]}
+    monkeypatch.setattr(png2png, "preprocess_format", None)
+    assert png2png.preprocess_params(SCALED, "1") is None
+    assert png2png.prepare_upload("anything.png", None) == "anything.png"
+
+def test_downscale_transcode_and_cache(prep_env, monkeypatch):
+    src = noise_image(os.path.join(prep_env, "big.png"), (1024, 1024))
+    prep = png2png.preprocess_params(SCALED, "1")
+
+    prepared = png2png.prepare_upload(src, prep)
+    assert prepared.startswith(png2png.preprocess_cache_dir) and prepared.endswith(".webp")
+    assert os.path.getsize(prepared) < os.path.getsize(src)
+    with png2png.Image.open(prepared) as img:
+        # 缩小后仍覆盖下游需要的尺寸
+        assert img.size == (512, 512)
+    # 同一次运行直接返回，下一次运行命中磁盘缓存
+    assert png2png.prepare_upload(src, prep) == prepared
+    monkeypatch.setattr(png2png, "_prepared_paths", {})
+    assert png2png.prepare_upload(src, prep) == prepared
+    assert png2png.preprocess_stats["images"] == 2 and png2png.preprocess_stats["cache_hits"] == 1
+
+def test_transparent_image_keeps_alpha_as_png(prep_env, monkeypatch):
+    monkeypatch.setattr(png2png, "preprocess_format", "jpeg")
+    src = noise_image(os.path.join(prep_env, "mask.png"), (1024, 1024), "RGBA")
+    prepared = png2png.prepare_upload(src, png2png.preprocess_params(SCALED, "1"))
+    assert prepared.endswith(".png")
+    with png2png.Image.open(prepared) as img:
+        assert img.mode == "RGBA"
+
+def test_unsupported_mode_uploads_original(prep_env):
+    src = os.path.join(prep_env, "cmyk.jpg")
+    png2png.Image.effect_noise((256, 256), 40).convert("CMYK").save(src)
+    assert png2png.prepare_upload(src, png2png.preprocess_params(SCALED, "1")) == src
+
+def test_larger_result_uploads_original(prep_env, monkeypatch):
+    monkeypatch.setattr(png2png, "preprocess_format", "png")
+    src = os.path.join(prep_env, "small.jpg")
+    png2png.Image.effect_noise((256, 256), 40).convert("RGB").save(src, quality=10)
+    assert png2png.prepare_upload(src, png2png.preprocess_params(SCALED, "1")) == src
@@ -0,0 +1,95 @@
+import os
+import io
+import time
+import argparse
+import contextlib
+
+import pytest
+
+import png2png
+import bench_png2png
+from comfy_mock_server import MockComfyServer
+
+# 生成结果缓存：命中、LRU 淘汰、重启后从目录恢复，以及端到端跳过已生成过的任务
+
+def write_outputs(folder, name, count, size):
+    out_path = os.path.join(folder, name)
+    for path in png2png.output_paths(out_path, count):
+        with open(path, "wb") as f:
+            f.write(os.urandom(size))
+    return out_path
+
+def test_put_get_and_miss(tmp_path):
+    cache = png2png.ResultCache(os.path.join(tmp_path, "cache"), budget=10_000)
+    out_path = write_outputs(tmp_path, "a.png", 2, 100)
+    cache.put("k1", out_path, 2)
+    # 有输出图片缺失时不缓存
+    cache.put("k2", write_outputs(tmp_path, "b.png", 1, 100), 2)
+
+    restored = os.path.join(tmp_path, "restored.png")
+    assert cache.get("k1", restored) == 2
+    for src, dest in zip(png2png.output_paths(out_path, 2), png2png.output_paths(restored, 2)):
+        with open(src, "rb") as a, open(dest, "rb") as b:
+            assert a.read() == b.read()
+    assert cache.get("k2", restored) is None
+    assert (cache.hits, cache.misses, cache.size) == (1, 1, 200)
+
+def test_lru_eviction_and_reload(tmp_path):
+    cache_dir = os.path.join(tmp_path, "cache")
+    cache = png2png.ResultCache(cache_dir, budget=250)
+    for key in ("old", "used", "new"):
+        cache.put(key, write_outputs(tmp_path, f"{key}.png", 1, 100), 1)
+        if key == "used":
+            time.sleep(0.01)
+            assert cache.get("old", os.path.join(tmp_path, "r.png")) == 1  # old 变成最近使用
+        time.sleep(0.01)
+    # 超出 250 字节时淘汰最久没用过的 used
+    assert sorted(os.listdir(cache_dir)) == ["new", "old"]
+    assert cache.size == 200
+
+    # 中断留下的临时目录在重启时清理，条目从目录恢复；预算变小时立即淘汰
+    os.makedirs(os.path.join(cache_dir, "x.1234.tmp"))
+    reloaded = png2png.ResultCache(cache_dir, budget=150)
+    assert sorted(os.listdir(cache_dir)) == ["new"]
+    assert reloaded.size == 100
+
+def test_key_ignores_server_filename(tmp_path, monkeypatch):
+    monkeypatch.setattr(png2png, "result_cache", png2png.ResultCache(os.path.join(tmp_path, "cache")))
+    monkeypatch.setattr(png2png, "preprocess_format", None)
+    a, b = os.path.join(tmp_path, "a.png"), os.path.join(tmp_path, "b.png")
+    for path, content in ((a, b"same"), (b, b"other")):
+        with open(path, "wb") as f:
+            f.write(content)
+    workflow = dict(bench_png2png.BENCH_WORKFLOW)
+    renamed = dict(workflow, **{"1": {"class_type": "LoadImage", "inputs": {"image": "uploaded_elsewhere.png"}}})
+    assert png2png.result_cache_key(workflow, "1", a) == png2png.result_cache_key(renamed, "1", a)
+    assert png2png.result_cache_key(workflow, "1", a) != png2png.result_cache_key(workflow, "1", b)
+    changed = dict(workflow, **{"2": dict(workflow["2"], inputs=dict(workflow["2"]["inputs"], width=256))})
+    assert png2png.result_cache_key(workflow, "1", a) != png2png.result_cache_key(changed, "1", a)
+
+@pytest.fixture
+def server():
+    mock = MockComfyServer(latency=0.01, output_size=1000).start()
+    yield mock
+    png2png.close_completion_watchers()
+    mock.stop()
+
+def test_second_run_is_served_from_cache(tmp_path, server):
+    args = argparse.Namespace(max_inflight=2, upload_workers=1, download_workers=1, completion="auto",
+                              prompt_timeout=30, shared_fs=False, upload_cache=False, result_cache=True,
+                              preprocess=None)
+    read_folder = os.path.join(tmp_path, "pic")
+    bench_png2png.make_images(read_folder, 4, 2000)
+    for run in ("first", "second"):
+        write_folder = os.path.join(tmp_path, run)
+        os.makedirs(write_folder)
+        bench_png2png.configure_png2png([server.url], args, str(tmp_path))
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = png2png.process_image_to_image_workflow(
+                bench_png2png.BENCH_WORKFLOW, "1", read_folder, write_folder,
+                os.path.join(tmp_path, f"{run}.csv"), max_inflight=2, workflow_name="w.json")
+        png2png.log_sink.close()
+        assert result == (False, "", 4)
+        assert len(os.listdir(write_folder)) == 4
+    assert server.stats["prompts"] == 4
+    assert png2png.result_cache.hits == 4
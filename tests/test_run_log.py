@@ -0,0 +1,70 @@
+import os
+import csv
+import json
+
+import png2png
+from run_logs import read_run_log
+
+# 运行日志写入器（CSV / JSON Lines）与耗时汇总
+
+def row(index, status, total=None):
+    # 失败的行没有耗时，与 record_image_failure 写入的一致
+    if status == "success":
+        timings = ["0.10", f"{total - 0.3:.2f}", "0.20", f"{total:.2f}"]
+    else:
+        timings = ["", "", "", ""]
+    return ([f"{index:04d}", f"/pic/{index}.png", f"/out/{index}.png"] + timings
+            + [status, "" if status == "success" else "boom", "miss"])
+
+def test_sink_writes_csv_and_jsonl(tmp_path):
+    csv_log = os.path.join(tmp_path, "a.json.csv")
+    jsonl_log = os.path.join(tmp_path, "a.json.jsonl")
+    error_log = os.path.join(tmp_path, "error_workflows.csv")
+    # 少量打开文件的上限，顺便检查关闭后重新打开时追加而不是覆盖
+    sink = png2png.RunLogSink(flush_every=1, max_open_files=1)
+    for i in range(1, 4):
+        sink.write(csv_log, row(i, "success", 1.0 * i))
+        sink.write(jsonl_log, row(i, "success", 1.0 * i))
+    sink.write(error_log, ["a.json", "2024-01-01 00:00:00", "图生图", "提交", "boom"],
+               png2png.ERROR_LOG_FIELDS, header=True)
+    sink.write(error_log, ["b.json", "2024-01-01 00:00:01", "文生图", "下载", "boom"],
+               png2png.ERROR_LOG_FIELDS, header=True)
+    sink.close()
+
+    with open(csv_log, "r", encoding="utf-8", newline="") as f:
+        assert list(csv.reader(f)) == [row(i, "success", 1.0 * i) for i in range(1, 4)]
+    with open(jsonl_log, "r", encoding="utf-8") as f:
+        records = [json.loads(line) for line in f]
+    assert [r["index"] for r in records] == ["0001", "0002", "0003"]
+    assert records[2]["total"] == 3.0 and records[2]["status"] == "success"
+    with open(error_log, "r", encoding="utf-8", newline="") as f:
+        lines = list(csv.reader(f))
+    assert lines[0] == png2png.ERROR_LOG_FIELDS and len(lines) == 3
+    # 两种格式读回的内容相同
+    assert read_run_log(csv_log) == read_run_log(jsonl_log)
+
+def test_summarize_run_logs(tmp_path, capsys):
+    sink = png2png.RunLogSink()
+    for i in range(1, 21):
+        sink.write(os.path.join(tmp_path, "a.json.csv"), row(i, "success", float(i)))
+    sink.write(os.path.join(tmp_path, "a.json.csv"), row(21, "fail"))
+    for i in range(1, 6):
+        sink.write(os.path.join(tmp_path, "b.json.jsonl"), row(i, "success", 100.0))
+    sink.close()
+    with open(os.path.join(tmp_path, "broken.json.csv"), "wb") as f:
+        f.write(b"\xff\xfe not utf-8")
+
+    summaries = png2png.summarize_run_logs([os.path.join(tmp_path, "*.json.csv"),
+                                            os.path.join(tmp_path, "*.json.jsonl")])
+    by_log = {os.path.basename(s["log"]): s for s in summaries}
+    assert set(by_log) == {"a.json.csv", "b.json.jsonl", "TOTAL"}
+    a = by_log["a.json.csv"]
+    assert (a["success"], a["fail"], a["cache_miss"]) == (20, 1, 21)
+    assert a["total_max"] == 20.0 and a["total_p50"] == 10.0 and a["total_p95"] == 19.0
+    assert by_log["TOTAL"]["success"] == 25 and by_log["TOTAL"]["total_max"] == 100.0
+    assert "跳过无法读取的日志" in capsys.readouterr().out
+
+    png2png.print_log_summary(summaries)
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0].split()[:3] == ["log", "ok", "fail"]
+    assert lines[-1].split()[:3] == ["TOTAL", "25", "1"]
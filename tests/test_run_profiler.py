@@ -0,0 +1,31 @@
+import os
+import threading
+
+import pytest
+
+import run_profiler
+
+# 性能分析：两种模式都能记录工作线程中的函数和各阶段耗时（cprofile 模式在 Python 3.12+ 也能启动）
+
+def busy_worker():
+    total = 0
+    for _ in range(20):
+        total += sum(i * i for i in range(20000))
+    return total
+
+@pytest.mark.parametrize("mode", ["cprofile", "sample"])
+def test_worker_threads_are_profiled(tmp_path, mode):
+    report = os.path.join(tmp_path, "profile.txt")
+    profiler = run_profiler.RunProfiler(report, mode, interval=0.001, memory=False)
+    profiler.start()
+    with profiler.stage("计算"):
+        worker = threading.Thread(target=busy_worker)
+        worker.start()
+        worker.join()
+    profiler.stop()
+    profiler.write_report()
+
+    with open(report, "r", encoding="utf-8") as f:
+        text = f.read()
+    assert "计算" in text and "busy_worker" in text
+    assert os.path.exists(report + ".prof") == (mode == "cprofile")
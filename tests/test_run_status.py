@@ -0,0 +1,120 @@
+import os
+import csv
+import json
+import time
+
+import pytest
+
+from dir_watcher import DirWatcher
+from run_logs import RUN_LOG_FIELDS, workflow_log_status, workflow_expected_inputs
+from find_unprocessed_workflow import find_unprocessed_workflows
+
+# 根据运行日志判断工作流的完成状态（--watch 和 find_unprocessed_workflow 使用），以及监视模式的目录监视
+
+IMG2IMG = {"1": {"class_type": "LoadImage", "inputs": {"image": "x.png"}},
+           "9": {"class_type": "SaveImage", "inputs": {"images": ["1", 0]}}}
+TXT2IMG = {"9": {"class_type": "SaveImage", "inputs": {"images": ["5", 0]}}}
+
+def write_workflow(folder, name, workflow, age=60):
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, name)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(workflow, f)
+    # 工作流比日志早，不算日志之后修改过
+    past = time.time() - age
+    os.utime(path, (past, past))
+    return path
+
+def write_log(log_dir, name, statuses, ext="csv"):
+    path = os.path.join(log_dir, f"{name}.{ext}")
+    rows = [dict(zip(RUN_LOG_FIELDS, [f"{i:04d}", image, "", "", "", "", "", status, "", ""]))
+            for i, (image, status) in enumerate(statuses, 1)]
+    with open(path, "a", encoding="utf-8", newline="") as f:
+        if ext == "csv":
+            csv.writer(f).writerows([row[k] for k in RUN_LOG_FIELDS] for row in rows)
+        else:
+            f.writelines(json.dumps(row) + "\n" for row in rows)
+
+def test_log_status(tmp_path):
+    log_dir = str(tmp_path)
+    assert workflow_log_status("a.json", 2, log_dir) == "pending"
+    write_log(log_dir, "a.json", [("p1.png", "success"), ("p2.png", "fail")])
+    assert workflow_log_status("a.json", 2, log_dir) == "failed"
+    # 重新处理时日志是追加的，同一个输入以最后一行为准；csv 和 jsonl 日志合在一起看
+    write_log(log_dir, "a.json", [("p2.png", "success")], ext="jsonl")
+    assert workflow_log_status("a.json", 2, log_dir) == "done"
+    assert workflow_log_status("a.json", 3, log_dir) == "partial"
+    assert workflow_log_status("a.json", None, log_dir) == "done"
+    assert workflow_log_status("a.json", "unknown", log_dir) == "unknown"
+
+    workflow_path = write_workflow(log_dir, "a.json", IMG2IMG, age=-60)
+    assert workflow_log_status("a.json", 2, log_dir, workflow_path=workflow_path) == "changed"
+
+def test_expected_inputs(tmp_path):
+    img2img = write_workflow(tmp_path, "i.json", IMG2IMG)
+    txt2img = write_workflow(tmp_path, "t.json", TXT2IMG)
+    assert workflow_expected_inputs(img2img, 5) == 5
+    assert workflow_expected_inputs(img2img, None) == "unknown"
+    assert workflow_expected_inputs(txt2img, None) == 1
+    assert workflow_expected_inputs(os.path.join(tmp_path, "missing.json"), 5) is None
+
+def test_find_unprocessed(tmp_path, capsys):
+    workflow_dir = os.path.join(tmp_path, "workflow")
+    output_dir = os.path.join(tmp_path, "workflow_left")
+    log_dir = str(tmp_path)
+    read_folder = os.path.join(tmp_path, "pic")
+    os.makedirs(read_folder)
+    for name in ("p1.png", "p2.png"):
+        open(os.path.join(read_folder, name), "wb").close()
+    write_workflow(workflow_dir, "full.json", IMG2IMG)
+    write_log(log_dir, "full.json", [("p1.png", "success"), ("p2.png", "success")])
+    write_workflow(workflow_dir, "half.json", IMG2IMG)
+    write_log(log_dir, "half.json", [("p1.png", "success")])
+    write_workflow(workflow_dir, "text.json", TXT2IMG)
+    write_log(log_dir, "text.json", [("", "success")])
+    write_workflow(workflow_dir, "new.json", TXT2IMG)
+
+    find_unprocessed_workflows(workflow_dir, output_dir, log_dir, read_folder)
+    assert sorted(os.listdir(output_dir)) == ["half.json", "new.json"]
+
+    # 不知道读取文件夹时，没有失败的图生图工作流不能算作已完成，也不复制
+    other_output = os.path.join(tmp_path, "left_without_folder")
+    capsys.readouterr()
+    find_unprocessed_workflows(workflow_dir, other_output, log_dir)
+    out = capsys.readouterr().out
+    assert sorted(os.listdir(other_output)) == ["new.json"]
+    assert "图生图图片数未知 2 个" in out and "half.json" in out and "full.json" in out
+
+def wait_for_changes(watcher, timeout=5.0):
+    deadline = time.time() + timeout
+    names = []
+    while time.time() < deadline and not names:
+        names = watcher.changes(timeout=0.1)
+    return names
+
+@pytest.mark.parametrize("use_inotify", [True, False])
+def test_dir_watcher(tmp_path, use_inotify):
+    folder = str(tmp_path)
+    write_workflow(folder, "existing.json", TXT2IMG)
+    watcher = DirWatcher(folder, poll_interval=0.05, use_inotify=use_inotify)
+    try:
+        if use_inotify and watcher.backend != "inotify":
+            pytest.skip("inotify 不可用")
+        assert watcher.changes(timeout=0.1) == []
+        write_workflow(folder, "new.json", TXT2IMG)
+        write_workflow(folder, ".hidden.json", TXT2IMG)
+        write_workflow(folder, "notes.txt", "")
+        assert wait_for_changes(watcher) == ["new.json"]
+        # 写到临时文件再改名（原子替换）也会报告
+        write_workflow(folder, "renamed.tmp", TXT2IMG)
+        os.replace(os.path.join(folder, "renamed.tmp"), os.path.join(folder, "existing.json"))
+        assert wait_for_changes(watcher) == ["existing.json"]
+    finally:
+        watcher.close()
+
+def test_dir_watcher_overflow_rechecks_folder(tmp_path, monkeypatch):
+    folder = str(tmp_path)
+    write_workflow(folder, "a.json", TXT2IMG)
+    watcher = DirWatcher(folder, use_inotify=False)
+    monkeypatch.setattr(watcher._backend, "wait", lambda timeout: (set(), True))
+    assert watcher.changes() == ["a.json"]
@@ -0,0 +1,38 @@
+import os
+import json
+import threading
+
+import png2png
+
+# 上传缓存的索引文件：多个上传线程同时写入时不能出错，写入失败也不能让任务失败
+
+def test_concurrent_put_saves_every_entry(tmp_path):
+    cache_file = os.path.join(tmp_path, "upload_cache.json")
+    cache = png2png.UploadCache(cache_file, save_every=1)
+    errors = []
+
+    def worker(t):
+        try:
+            for i in range(200):
+                cache.put(f"{t}-{i}", "http://host", f"{t}-{i}.png")
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(t,)) for t in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    cache.save()
+    with open(cache_file, "r", encoding="utf-8") as f:
+        assert len(json.load(f)["http://host"]) == 8 * 200
+    assert [name for name in os.listdir(tmp_path) if name.endswith(".tmp")] == []
+
+def test_save_failure_does_not_raise(tmp_path, capsys):
+    cache = png2png.UploadCache(os.path.join(tmp_path, "missing", "upload_cache.json"), save_every=1)
+    cache.put("digest", "http://host", "a.png")
+    assert "上传缓存保存失败" in capsys.readouterr().out
+    # 记录仍在内存中，下次保存时重试
+    assert cache._dirty == 1
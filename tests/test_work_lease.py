@@ -0,0 +1,156 @@
+import os
+import csv
+import sys
+import json
+import time
+import signal
+import subprocess
+
+import pytest
+
+from comfy_mock_server import MockComfyServer
+from work_lease import work_key
+
+# 多客户端分担任务：几个本地 png2png 进程共用一个租约目录，对同一台模拟服务器处理同一批任务，
+# 检查每项任务恰好处理一次，包括客户端崩溃留下的租约过期后被其他客户端接管的情况
+
+PNG2PNG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "png2png.py")
+LEASE_TTL = 1.5
+
+IMAGE_WORKFLOW = {"1": {"class_type": "LoadImage", "inputs": {"image": "placeholder.png"}},
+                  "9": {"class_type": "SaveImage", "inputs": {"images": ["1", 0]}}}
+TEXT_WORKFLOW = {"3": {"class_type": "KSampler", "inputs": {"seed": 1}},
+                 "9": {"class_type": "SaveImage", "inputs": {"images": ["3", 0]}}}
+
+@pytest.fixture
+def server():
+    servers = []
+
+    def start(latency):
+        servers.append(MockComfyServer(latency=latency, output_size=1000).start())
+        return servers[-1]
+
+    yield start
+    for s in servers:
+        s.stop()
+
+def make_task_folders(root, workflows, images):
+    '''
+    在 root 下生成 workflow/ 和 pic/，返回全部任务 {(工作流, 任务名)}（文生图的任务名为空字符串）
+    '''
+    os.makedirs(os.path.join(root, "workflow"))
+    os.makedirs(os.path.join(root, "pic"))
+    for i in range(images):
+        with open(os.path.join(root, "pic", f"p{i:02d}.png"), "wb") as f:
+            f.write(b"\x89PNG\r\n\x1a\n" + i.to_bytes(4, "big"))
+    items = set()
+    for name, workflow in workflows.items():
+        with open(os.path.join(root, "workflow", name), "w", encoding="utf-8") as f:
+            json.dump(workflow, f)
+        if "1" in workflow:
+            items |= {(name, f"p{i:02d}.png") for i in range(images)}
+        else:
+            items.add((name, ""))
+    return items
+
+def start_client(root, name, host_url, *extra):
+    '''
+    在独立的运行目录中启动一个 png2png 客户端（运行日志、断点续跑日志和结果都写在自己的目录里）
+    '''
+    cwd = os.path.join(root, name)
+    os.makedirs(cwd)
+    out = open(os.path.join(cwd, "stdout.txt"), "w", encoding="utf-8")
+    cmd = [sys.executable, PNG2PNG, "--hosts", host_url,
+           "--input-folder", os.path.join(root, "workflow"), "--read-folder", os.path.join(root, "pic"),
+           "--lease-dir", os.path.join(root, "leases"), "--lease-ttl", str(LEASE_TTL),
+           "--progress-interval", "0", "--metrics-file", "", "--order", "name", *extra]
+    proc = subprocess.Popen(cmd, cwd=cwd, stdout=out, stderr=subprocess.STDOUT)
+    proc.output_file = out
+    return proc
+
+def wait_clients(procs, timeout=120):
+    for proc in procs:
+        try:
+            proc.wait(timeout=timeout)
+        finally:
+            proc.output_file.close()
+    for proc in procs:
+        assert proc.returncode == 0, open(proc.output_file.name, encoding="utf-8").read()
+
+def successful_items(root, workflows):
+    '''
+    汇总全部客户端运行日志中的 success 行，返回 [(工作流, 任务名)]，同一项任务出现几次就有几个
+    '''
+    done = []
+    for client in sorted(os.listdir(root)):
+        for name in workflows:
+            log_file = os.path.join(root, client, f"{name}.csv")
+            if not os.path.exists(log_file):
+                continue
+            with open(log_file, "r", encoding="utf-8", newline="") as f:
+                for row in csv.reader(f):
+                    if row[7] == "success":
+                        item = "" if "1" not in workflows[name] else os.path.basename(row[1])
+                        done.append((name, item))
+    return done
+
+def lease_base(root, workflow_name, item):
+    key = work_key(workflow_name, item)
+    return os.path.join(root, "leases", key[:2], key)
+
+def client_output(root, name):
+    with open(os.path.join(root, name, "stdout.txt"), "r", encoding="utf-8") as f:
+        return f.read()
+
+def test_each_item_runs_once_across_sharded_clients(tmp_path, server):
+    root = str(tmp_path)
+    workflows = {"a.json": IMAGE_WORKFLOW, "b.json": IMAGE_WORKFLOW, "t.json": TEXT_WORKFLOW}
+    items = make_task_folders(root, workflows, images=8)
+    mock = server(0.02)
+
+    # 崩溃的客户端留下的租约：内容是别的客户端，修改时间早已超过有效期
+    stale = ("a.json", "p03.png")
+    base = lease_base(root, *stale)
+    os.makedirs(os.path.dirname(base))
+    with open(base + ".lease", "w", encoding="utf-8") as f:
+        json.dump({"owner": "crashed-client", "workflow": stale[0], "item": stale[1]}, f)
+    os.utime(base + ".lease", (time.time() - 10 * LEASE_TTL,) * 2)
+
+    procs = [start_client(root, f"client_{i}", mock.url, "--shard", f"{i}/3") for i in range(3)]
+    wait_clients(procs)
+
+    done = successful_items(root, workflows)
+    assert sorted(done) == sorted(items)
+    assert mock.stats["prompts"] == len(items)
+    assert all(os.path.exists(lease_base(root, *item) + ".done") for item in items)
+    assert not os.path.exists(base + ".lease")
+    outputs = [client_output(root, f"client_{i}") for i in range(3)]
+    assert sum("接管过期租约: a.json p03.png" in out for out in outputs) == 1
+
+def test_crashed_client_lease_expires_and_is_taken_over(tmp_path, server):
+    root = str(tmp_path)
+    workflows = {"a.json": IMAGE_WORKFLOW}
+    items = make_task_folders(root, workflows, images=4)
+    mock = server(0.5)
+
+    # 第一个客户端拿到租约、任务还没完成时被强制结束，不会释放租约
+    crashed = start_client(root, "crashed", mock.url)
+    leases = os.path.join(root, "leases")
+    deadline = time.time() + 30
+    while not any(name.endswith(".lease") for _, _, files in os.walk(leases) for name in files):
+        assert time.time() < deadline and crashed.poll() is None, "客户端没有创建租约"
+        time.sleep(0.02)
+    crashed.send_signal(signal.SIGKILL)
+    crashed.wait()
+    crashed.output_file.close()
+    orphaned = [item for item in items if os.path.exists(lease_base(root, *item) + ".lease")]
+    assert len(orphaned) == 1
+    assert not any(os.path.exists(lease_base(root, *item) + ".done") for item in items)
+
+    procs = [start_client(root, f"client_{i}", mock.url, "--shard", f"{i}/2") for i in range(2)]
+    wait_clients(procs)
+
+    assert sorted(successful_items(root, workflows)) == sorted(items)
+    assert all(os.path.exists(lease_base(root, *item) + ".done") for item in items)
+    outputs = [client_output(root, f"client_{i}") for i in range(2)]
+    assert sum(f"接管过期租约: {orphaned[0][0]} {orphaned[0][1]}" in out for out in outputs) == 1
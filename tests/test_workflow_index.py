@@ -0,0 +1,68 @@
+import os
+import json
+
+from workflow_index import WorkflowIndex
+
+# 工作流索引：增量更新、条件查询，以及按目录过滤时只匹配该目录本身
+
+IMG2IMG = {
+    "1": {"class_type": "LoadImage", "inputs": {"image": "x.png"}},
+    "4": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "sd_xl_base.safetensors"}},
+    "196": {"class_type": "AIO_Preprocessor", "inputs": {"preprocessor": "Zoe-DepthMapPreprocessor", "image": ["1", 0]}},
+}
+TXT2IMG = {
+    "4": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "v1-5.ckpt"}},
+    "9": {"class_type": "SaveImage", "inputs": {"images": ["4", 0]}},
+}
+
+def write(path, workflow):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        if isinstance(workflow, str):
+            f.write(workflow)
+        else:
+            json.dump(workflow, f)
+    return os.path.abspath(path)
+
+def test_update_and_query(tmp_path):
+    root = os.path.join(tmp_path, "wf")
+    a = write(os.path.join(root, "a.json"), IMG2IMG)
+    b = write(os.path.join(root, "sub", "b.json"), TXT2IMG)
+    broken = write(os.path.join(root, "broken.json"), "{not json")
+    index = WorkflowIndex(os.path.join(tmp_path, "index.db"))
+
+    counts = index.update(root, processes=1, verbose=False)
+    assert (counts["total"], counts["parsed"], counts["errors"]) == (3, 3, 1)
+    assert index.query(root) == sorted([a, b])
+    assert index.query(root, include_errors=True) == sorted([a, b, broken])
+    assert index.query(class_type="aio_*") == [a]
+    assert index.query(node_id="196", class_type="AIO_Preprocessor") == [a]
+    assert index.query(model="SD_XL*", model_kind="ckpt_name") == [a]
+    assert index.query(image_input=True) == [a] and index.query(image_input=False) == [b]
+    refs = index.model_refs([a, broken])
+    assert ("ckpt_name", "sd_xl_base.safetensors") in refs[a] and refs[broken] is None
+
+    # 修改时间变了但内容没变时不重新解析；删除的文件从索引中移除
+    os.utime(a, (1, 1))
+    os.remove(b)
+    counts = index.update(root, processes=1, verbose=False)
+    assert (counts["unchanged"], counts["touched"], counts["parsed"], counts["removed"]) == (1, 1, 0, 1)
+    assert index.query(root) == [a]
+    index.close()
+
+def test_root_filter_is_exact(tmp_path):
+    # 大小写不同的同级目录，以及 _ % 这类在 LIKE 中是通配符的目录名
+    inside = write(os.path.join(tmp_path, "Work_1", "a.json"), TXT2IMG)
+    other_case = write(os.path.join(tmp_path, "work_1", "a.json"), TXT2IMG)
+    wildcard = write(os.path.join(tmp_path, "WorkX1", "a.json"), TXT2IMG)
+    index = WorkflowIndex(os.path.join(tmp_path, "index.db"))
+    for folder in ("Work_1", "work_1", "WorkX1"):
+        index.update(os.path.join(tmp_path, folder), processes=1, verbose=False)
+
+    assert index.query(os.path.join(tmp_path, "Work_1")) == [inside]
+    assert index.query(os.path.join(tmp_path, "work_1")) == [other_case]
+    # 更新一个目录不会把其他目录的记录当成已删除
+    counts = index.update(os.path.join(tmp_path, "Work_1"), processes=1, verbose=False)
+    assert counts["removed"] == 0
+    assert index.query(include_errors=True) == sorted([inside, other_case, wildcard])
+    index.close()
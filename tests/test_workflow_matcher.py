@@ -0,0 +1,62 @@
+import os
+import json
+
+import pytest
+
+import workflow_matcher
+from workflow_matcher import NodeQuery, WorkflowMatcher
+
+# 工作流匹配器：查询解析、键名和值不区分大小写、字节预筛选，以及不同解析方式的结果一致
+
+ZOE = {
+    "1": {"class_type": "LoadImage", "inputs": {"image": "x.png"}},
+    "196": {"class_type": "AIO_Preprocessor", "inputs": {"preprocessor": "Zoe-DepthMapPreprocessor", "resolution": 512}},
+}
+
+def write(folder, name, content):
+    path = os.path.join(folder, name)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(content if isinstance(content, str) else json.dumps(content))
+    return path
+
+def test_parse_and_match():
+    query = NodeQuery.parse("node=196 preprocessor=zoe-* resolution=512")
+    assert (query.node_id, query.class_type, query.inputs) == ("196", None, {"preprocessor": "zoe-*", "resolution": "512"})
+    assert query.matches("196", ZOE["196"])
+    assert not query.matches("1", ZOE["196"])
+    assert not NodeQuery(preprocessor="canny").matches("196", ZOE["196"])
+    # 输入是连线（列表）时不与值比较
+    assert not NodeQuery(image="*").matches("2", {"class_type": "X", "inputs": {"image": ["1", 0]}})
+    with pytest.raises(ValueError):
+        NodeQuery.parse("node196")
+
+def test_node_keys_are_case_insensitive():
+    node = {"Class_Type": "AIO_Preprocessor", "Inputs": {"Preprocessor": "Zoe-DepthMapPreprocessor"}}
+    assert NodeQuery(class_type="aio_preprocessor", preprocessor="ZOE-*").matches("196", node)
+    # 界面格式的节点用 type 表示类型
+    assert NodeQuery(class_type="AIO_*").matches("7", {"type": "AIO_Preprocessor", "inputs": {}})
+
+def test_needles_skip_wildcards():
+    assert NodeQuery(class_type="*Preprocessor", preprocessor="zoe-d?pth").needles() == {b"preprocessor", b"zoe-d"}
+
+@pytest.mark.parametrize("backend", ["raw", "full"])
+def test_matcher(tmp_path, monkeypatch, backend):
+    monkeypatch.setattr(workflow_matcher, "ijson", None)
+    monkeypatch.setattr(workflow_matcher.json_codec, "backend", "orjson" if backend == "full" else "stdlib")
+    zoe = write(tmp_path, "zoe.json", ZOE)
+    ui = write(tmp_path, "ui.json", {"nodes": [{"id": 196, "type": "AIO_Preprocessor", "widgets_values": []}]})
+    other = write(tmp_path, "other.json", {"1": {"class_type": "LoadImage", "inputs": {"image": "x.png"}}})
+    mentions = write(tmp_path, "mentions.json", {"1": {"class_type": "Note", "inputs": {"text": "preprocessor: zoe-depthmap"}}})
+    broken = write(tmp_path, "broken.json", '{"1": {"inputs": {"preprocessor": "zoe-depthmap"')
+
+    matcher = WorkflowMatcher([NodeQuery(preprocessor="zoe-depthmap*")])
+    assert matcher(zoe) == (zoe, ["196"], "parsed")
+    assert matcher(other) == (other, [], "prefiltered")
+    # 关键字出现但节点不满足条件
+    assert matcher(mentions) == (mentions, [], "parsed")
+    path, matched, status = matcher(broken)
+    assert matched == [] and status not in ("parsed", "prefiltered")
+
+    by_class = WorkflowMatcher([NodeQuery(class_type="aio_preprocessor")], prefilter=False, first_only=False)
+    assert by_class(ui) == (ui, ["196"], "parsed")
+    assert by_class(zoe) == (zoe, ["196"], "parsed")
@@ -0,0 +1,278 @@
+import os
+import json
+import time
+import uuid
+import socket
+import hashlib
+import threading
+
+# 多个客户端分担同一批任务：
+#   分片 --shard i/n：按 (工作流, 图片) 的哈希固定分配，各客户端先处理自己的分片，不需要任何协调
+#   租约 --lease-dir：共享目录（例如 NFS）中每项任务一个租约文件，用 O_CREAT|O_EXCL 创建保证只有一个客户端拿到；
+#       持有期间后台线程定期更新修改时间，超过 ttl 没有更新视为客户端已崩溃，其他客户端可以接管；
+#       完成后写 .done（失败写 .failed）标记，之后任何客户端都不会再处理
+# 需要重试失败的任务时删除租约目录中的 *.failed 文件
+
+def parse_shard(text):
+    '''
+    解析 "i/n" 格式的分片参数（i 从 0 开始）
+
+    返回:
+        tuple: (i, n)
+    '''
+    try:
+        index, count = (int(x) for x in text.split("/"))
+    except ValueError:
+        raise ValueError(f"分片格式应为 i/n，例如 0/4: {text}")
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"分片序号应在 0 到 {count - 1} 之间: {text}")
+    return index, count
+
+def work_key(workflow_name, item):
+    '''
+    一项任务的键：工作流文件名 + 图片相对路径（文生图为空字符串），与客户端的挂载路径无关
+    '''
+    return hashlib.sha1(f"{workflow_name}\0{item}".encode("utf-8")).hexdigest()
+
+class WorkClaims:
+    '''
+    判断某项任务是否由本客户端处理，并维护本客户端持有的租约
+
+    参数:
+        shard: (i, n)，只认领哈希落在第 i 个分片的任务；None 表示不分片
+        lease_dir: 共享的租约目录；None 时只按分片静态分配，不创建租约
+        ttl: 租约有效期（秒），持有期间每 ttl/3 秒续约一次
+    '''
+    def __init__(self, shard=None, lease_dir=None, ttl=300.0):
+        self.shard = shard
+        self.lease_dir = lease_dir
+        self.ttl = ttl
+        self.stealing = False  # True 时也认领其他分片中没有租约或租约已过期的任务
+        self.owner = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self._lock = threading.Lock()
+        self._held = {}  # (工作流, 本地标识) -> 租约文件路径
+        self._clock_offset = 0.0
+        self._stop = threading.Event()
+        self._heartbeat = None
+        self.stats = {"claimed": 0, "taken_over": 0, "other_shard": 0, "finished": 0, "leased": 0, "lost": 0}
+        if lease_dir is not None:
+            os.makedirs(lease_dir, exist_ok=True)
+            self._clock_file = os.path.join(lease_dir, f".clock.{self.owner}")
+            self._sync_clock()
+
+    # ---------- 文件操作 ----------
+
+    def _base(self, key):
+        folder = os.path.join(self.lease_dir, key[:2])
+        os.makedirs(folder, exist_ok=True)
+        return os.path.join(folder, key)
+
+    def _sync_clock(self):
+        # 租约目录所在服务器的时间与本机可能不一致：touch 一个文件读回修改时间，得到两者的差
+        with open(self._clock_file, "w"):
+            pass
+        self._clock_offset = os.stat(self._clock_file).st_mtime - time.time()
+
+    def _now(self):
+        return time.time() + self._clock_offset
+
+    def _create(self, path, content):
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(content)
+        return True
+
+    def _content(self, workflow_name, item):
+        return json.dumps({"owner": self.owner, "workflow": workflow_name, "item": item,
+                           "time": time.strftime('%Y-%m-%d %H:%M:%S')}, ensure_ascii=False)
+
+    def _lease_owner(self, path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f).get("owner")
+        except (OSError, ValueError):
+            return None
+
+    def _finished(self, base):
+        return os.path.exists(base + ".done") or os.path.exists(base + ".failed")
+
+    def _expired(self, path):
+        '''
+        租约是否已过期；租约文件不存在时返回 None
+        '''
+        try:
+            return self._now() - os.stat(path).st_mtime > self.ttl
+        except FileNotFoundError:
+            return None
+
+    def _take_over(self, base, content):
+        '''
+        接管过期的租约：先用 O_EXCL 创建 .takeover 锁，在锁内再次确认过期后原子替换租约文件，
+        避免两个客户端同时判断过期后都认为自己拿到了任务
+        '''
+        lease, lock = base + ".lease", base + ".takeover"
+        if not self._create(lock, self.owner):
+            if self._expired(lock):
+                # 接管过程中崩溃留下的锁
+                try:
+                    os.remove(lock)
+                except OSError:
+                    pass
+            return False
+        try:
+            expired = self._expired(lease)
+            if expired is None:
+                return self._create(lease, content)
+            if not expired:
+                return False
+            tmp = f"{lease}.{self.owner}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(content)
+            os.replace(tmp, lease)
+            return True
+        finally:
+            try:
+                os.remove(lock)
+            except OSError:
+                pass
+
+    # ---------- 认领与完成 ----------
+
+    def in_shard(self, key):
+        return self.shard is None or int(key[:8], 16) % self.shard[1] == self.shard[0]
+
+    def claim(self, workflow_name, item, handle=None):
+        '''
+        尝试认领一项任务
+
+        参数:
+            item: 各客户端共用的任务名（图片相对路径，文生图为空字符串）
+            handle: 完成时传给 finish 的本地标识，默认与 item 相同
+
+        返回:
+            bool: 是否由本客户端处理
+        '''
+        key = work_key(workflow_name, item)
+        if not self.stealing and not self.in_shard(key):
+            self.stats["other_shard"] += 1
+            return False
+        if self.lease_dir is None:
+            self.stats["claimed"] += 1
+            return True
+        base = self._base(key)
+        if self._finished(base):
+            self.stats["finished"] += 1
+            return False
+        content = self._content(workflow_name, item)
+        taken_over = False
+        if not self._create(base + ".lease", content):
+            if not self._expired(base + ".lease") or not self._take_over(base, content):
+                self.stats["leased"] += 1
+                return False
+            taken_over = True
+        # 其他客户端先写完成标记再删除租约，拿到租约后再检查一次，避免刚完成的任务被重复执行
+        if self._finished(base):
+            self._release(base + ".lease")
+            self.stats["finished"] += 1
+            return False
+        with self._lock:
+            self._held[(workflow_name, handle if handle is not None else item)] = base + ".lease"
+            self.stats["taken_over" if taken_over else "claimed"] += 1
+        if taken_over:
+            print(f"🤝 接管过期租约: {workflow_name} {item}")
+        self._start_heartbeat()
+        return True
+
+    def finish(self, workflow_name, handle, ok=True):
+        '''
+        任务结束：写完成（或失败）标记并删除租约
+        '''
+        with self._lock:
+            lease = self._held.pop((workflow_name, handle), None)
+        if lease is None:
+            return
+        base = lease[:-len(".lease")]
+        self._create(base + (".done" if ok else ".failed"), self._content(workflow_name, handle))
+        self._release(lease)
+
+    def pending_counts(self, workflow_name, items):
+        '''
+        统计一个工作流中还能认领的任务数和其他客户端正在处理的任务数（接管前检查用）
+
+        返回:
+            tuple: (可认领数, 租约有效数)
+        '''
+        claimable = leased = 0
+        for item in items:
+            base = self._base(work_key(workflow_name, item))
+            if self._finished(base):
+                continue
+            expired = self._expired(base + ".lease")
+            if expired is False:
+                leased += 1
+            else:
+                claimable += 1
+        return claimable, leased
+
+    def _release(self, lease):
+        if self._lease_owner(lease) == self.owner:
+            try:
+                os.remove(lease)
+            except OSError:
+                pass
+
+    # ---------- 续约 ----------
+
+    def _start_heartbeat(self):
+        with self._lock:
+            if self._heartbeat is not None:
+                return
+            self._heartbeat = threading.Thread(target=self._renew_loop, daemon=True)
+        self._heartbeat.start()
+
+    def _renew_loop(self):
+        while not self._stop.wait(self.ttl / 3):
+            try:
+                self._sync_clock()
+            except OSError:
+                pass
+            with self._lock:
+                held = list(self._held.items())
+            for handle, lease in held:
+                if self._lease_owner(lease) != self.owner:
+                    # 续约间隔内卡住太久，租约已被其他客户端接管
+                    print(f"⚠️ 租约已被其他客户端接管: {handle[0]} {handle[1]}")
+                    with self._lock:
+                        self._held.pop(handle, None)
+                        self.stats["lost"] += 1
+                    continue
+                try:
+                    os.utime(lease)
+                except OSError:
+                    pass
+
+    def summary(self):
+        s = self.stats
+        return (f"认领 {s['claimed']} 项，接管过期 {s['taken_over']} 项，其他分片 {s['other_shard']} 项，"
+                f"其他客户端已完成 {s['finished']} 项 / 处理中 {s['leased']} 项，租约丢失 {s['lost']} 项")
+
+    def close(self):
+        '''
+        停止续约并释放还没有完成的租约，其他客户端可以立即认领
+        '''
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+        with self._lock:
+            held = list(self._held.values())
+            self._held.clear()
+        for lease in held:
+            self._release(lease)
+        if self.lease_dir is not None:
+            try:
+                os.remove(self._clock_file)
+            except OSError:
+                pass
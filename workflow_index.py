@@ -0,0 +1,288 @@
+import os
+import time
+import sqlite3
+import hashlib
+import argparse
+
+import json_codec
+from json_scanner import iter_files, parallel_map, ScanStats
+from workflow_utils import find_image_input_node, workflow_model_refs, workflow_nodes, MODEL_INPUT_WEIGHTS
+
+# 工作流归档的持久化索引（SQLite）：
+# 记录每个工作流的路径、大小、修改时间、内容哈希、节点类型、图片输入节点和用到的模型，
+# 按修改时间增量更新（修改时间变了但内容哈希没变时不重新解析），查询直接走数据库索引
+
+index_file = "workflow_index.db" # 索引数据库文件
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS workflows (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime_ns INTEGER,
+    sha256 TEXT,
+    image_node TEXT,
+    node_count INTEGER,
+    error TEXT,
+    indexed_at REAL
+);
+CREATE TABLE IF NOT EXISTS nodes (
+    path TEXT,
+    node_id TEXT,
+    class_type TEXT COLLATE NOCASE
+);
+CREATE TABLE IF NOT EXISTS models (
+    path TEXT,
+    kind TEXT,
+    name TEXT COLLATE NOCASE
+);
+CREATE INDEX IF NOT EXISTS nodes_path ON nodes(path);
+CREATE INDEX IF NOT EXISTS nodes_class ON nodes(class_type);
+CREATE INDEX IF NOT EXISTS nodes_id ON nodes(node_id);
+CREATE INDEX IF NOT EXISTS models_path ON models(path);
+CREATE INDEX IF NOT EXISTS models_name ON models(kind, name);
+"""
+
+def index_workflow_file(task):
+    '''
+    在子进程中读取并解析一个工作流
+    old_sha 与文件当前的哈希相同时说明内容没变（只是修改时间变了），不再解析
+
+    返回:
+        dict: 索引记录；unchanged 为 True 时只需要更新大小和修改时间
+    '''
+    path, size, mtime_ns, old_sha = task
+    record = {"path": path, "size": size, "mtime_ns": mtime_ns, "sha256": None, "unchanged": False,
+              "image_node": None, "nodes": [], "models": [], "error": None}
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        record["sha256"] = hashlib.sha256(data).hexdigest()
+        if record["sha256"] == old_sha:
+            record["unchanged"] = True
+            return record
+        workflow = json_codec.loads(data)
+        if not isinstance(workflow, dict):
+            raise ValueError("顶层不是 JSON 对象")
+        record["image_node"] = find_image_input_node(workflow)
+        record["nodes"] = [(node_id, node.get("class_type", node.get("type")) or "")
+                           for node_id, node in workflow_nodes(workflow)]
+        record["models"] = sorted(workflow_model_refs(workflow))
+    except (OSError, ValueError, UnicodeDecodeError) as e:
+        record["error"] = str(e)
+    return record
+
+def root_prefix(root):
+    '''
+    目录的绝对路径加结尾分隔符，用 substr(path, 1, 长度) = 前缀 过滤该目录下的工作流：
+    LIKE 不区分大小写，会把大小写不同的同级目录也匹配进来
+    '''
+    return os.path.abspath(root).rstrip(os.sep) + os.sep
+
+def like_pattern(pattern):
+    '''
+    把 * ? 通配符转换成 SQL LIKE 模式（LIKE 对 ASCII 不区分大小写）
+    '''
+    escaped = pattern.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return escaped.replace("*", "%").replace("?", "_")
+
+class WorkflowIndex:
+    '''
+    工作流索引
+
+    参数:
+        db_path: SQLite 数据库文件
+    '''
+    def __init__(self, db_path=index_file):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def update(self, root, processes=None, verbose=True):
+        '''
+        增量更新 root 下的全部工作流：
+        大小和修改时间都没变的文件跳过；变化的文件在子进程中计算哈希，哈希也没变时只更新修改时间，否则重新解析；
+        已经删除的文件从索引中移除
+
+        返回:
+            dict: 各类文件的数量
+        '''
+        root = os.path.abspath(root)
+        prefix = root_prefix(root)
+        known = {path: (size, mtime_ns, sha) for path, size, mtime_ns, sha in self.conn.execute(
+            "SELECT path, size, mtime_ns, sha256 FROM workflows WHERE substr(path, 1, ?) = ?",
+            (len(prefix), prefix))}
+        counts = {"total": 0, "unchanged": 0, "touched": 0, "parsed": 0, "errors": 0, "removed": 0}
+        seen = set()
+
+        def changed_files():
+            for path in iter_files(root, include_hidden=True):
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                path = os.path.abspath(path)
+                seen.add(path)
+                counts["total"] += 1
+                old = known.get(path)
+                if old and old[0] == st.st_size and old[1] == st.st_mtime_ns:
+                    counts["unchanged"] += 1
+                    continue
+                yield path, st.st_size, st.st_mtime_ns, old[2] if old else None
+
+        stats = ScanStats()
+        with self.conn:
+            for record in parallel_map(index_workflow_file, changed_files(), processes, stats=stats):
+                if record["unchanged"]:
+                    counts["touched"] += 1
+                    self.conn.execute("UPDATE workflows SET size = ?, mtime_ns = ? WHERE path = ?",
+                                      (record["size"], record["mtime_ns"], record["path"]))
+                    continue
+                counts["parsed"] += 1
+                if record["error"]:
+                    counts["errors"] += 1
+                self._store(record)
+            for path in set(known) - seen:
+                counts["removed"] += 1
+                self._delete(path)
+        if verbose:
+            print(f"🗃️  索引更新: 共 {counts['total']} 个工作流，未变化 {counts['unchanged']}，"
+                  f"仅修改时间变化 {counts['touched']}，重新解析 {counts['parsed']}（出错 {counts['errors']}），"
+                  f"移除 {counts['removed']}；解析速度 {stats.summary()}")
+        return counts
+
+    def _delete(self, path):
+        for table in ("workflows", "nodes", "models"):
+            self.conn.execute(f"DELETE FROM {table} WHERE path = ?", (path,))
+
+    def _store(self, record):
+        path = record["path"]
+        self._delete(path)
+        self.conn.execute(
+            "INSERT INTO workflows (path, size, mtime_ns, sha256, image_node, node_count, error, indexed_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (path, record["size"], record["mtime_ns"], record["sha256"], record["image_node"],
+             len(record["nodes"]), record["error"], time.time()))
+        self.conn.executemany("INSERT INTO nodes (path, node_id, class_type) VALUES (?, ?, ?)",
+                              [(path, node_id, class_type) for node_id, class_type in record["nodes"]])
+        self.conn.executemany("INSERT INTO models (path, kind, name) VALUES (?, ?, ?)",
+                              [(path, kind, name) for kind, name in record["models"]])
+
+    def query(self, root=None, class_type=None, node_id=None, model=None, model_kind=None,
+              image_input=None, include_errors=False):
+        '''
+        查询符合全部条件的工作流路径（按路径排序）
+
+        参数:
+            root: 只返回该目录下的工作流
+            class_type / model: 节点类型 / 模型名，不区分大小写，支持 * ? 通配符
+            node_id: 节点ID，与 class_type 同时给出时要求是同一个节点
+            model_kind: 模型输入名，例如 ckpt_name、lora_name、preprocessor
+            image_input: True 只返回图生图工作流，False 只返回文生图工作流
+        '''
+        # 子查询不关联外层的行，只执行一次，节点类型和模型名的前缀匹配可以使用索引
+        sql = ["SELECT path FROM workflows WHERE 1 = 1"]
+        params = []
+        if not include_errors:
+            sql.append("AND error IS NULL")
+        if root:
+            prefix = root_prefix(root)
+            sql.append("AND substr(path, 1, ?) = ?")
+            params += [len(prefix), prefix]
+        if image_input is not None:
+            sql.append("AND image_node IS NOT NULL" if image_input else "AND image_node IS NULL")
+        if class_type or node_id:
+            sub = ["SELECT path FROM nodes WHERE 1 = 1"]
+            if class_type:
+                sub.append("AND class_type LIKE ? ESCAPE '\\'")
+                params.append(like_pattern(class_type))
+            if node_id:
+                sub.append("AND node_id = ?")
+                params.append(str(node_id))
+            sql.append(f"AND path IN ({' '.join(sub)})")
+        if model or model_kind:
+            sub = ["SELECT path FROM models WHERE 1 = 1"]
+            if model_kind:
+                sub.append("AND kind = ?")
+                params.append(model_kind.lower())
+            if model:
+                sub.append("AND name LIKE ? ESCAPE '\\'")
+                params.append(like_pattern(model))
+            sql.append(f"AND path IN ({' '.join(sub)})")
+        sql.append("ORDER BY path")
+        return [row[0] for row in self.conn.execute(" ".join(sql), params)]
+
+    def candidates(self, node_query, root=None):
+        '''
+        用索引缩小 workflow_matcher.NodeQuery 的候选文件范围（结果仍需用匹配器确认）
+        索引中有的条件（节点ID、节点类型、模型输入）直接在数据库中过滤，其余条件交给匹配器
+        '''
+        kwargs = {"root": root}
+        if node_query.node_id is not None:
+            kwargs["node_id"] = node_query.node_id
+        if node_query.class_type is not None:
+            kwargs["class_type"] = node_query.class_type
+        for key, value in node_query.inputs.items():
+            if key in MODEL_INPUT_WEIGHTS:
+                kwargs["model_kind"], kwargs["model"] = key, value
+                break
+        return self.query(**kwargs)
+
+    def file_info(self, paths):
+        '''
+        返回 {路径: (大小, sha256)}，只包含已索引的路径
+        '''
+        wanted = set(paths)
+        return {path: (size, sha) for path, size, sha in self.conn.execute("SELECT path, size, sha256 FROM workflows")
+                if path in wanted}
+
+    def model_refs(self, paths):
+        '''
+        返回 {路径: 模型集合}，与 workflow_utils.workflow_model_refs 的结果格式相同；未索引或解析出错的路径为 None
+        '''
+        wanted = set(paths)
+        refs = {path: set() for path, error in self.conn.execute("SELECT path, error FROM workflows")
+                if path in wanted and error is None}
+        for path, kind, name in self.conn.execute("SELECT path, kind, name FROM models"):
+            if path in refs:
+                refs[path].add((kind, name))
+        return {path: frozenset(refs[path]) if path in refs else None for path in paths}
+
+# ============ 主程序入口 ============
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="工作流归档索引：增量建立索引并快速查询")
+    parser.add_argument("--db", default=index_file, help="索引数据库文件（默认 %(default)s）")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_update = sub.add_parser("update", help="增量更新某个目录下的索引")
+    p_update.add_argument("root", nargs="?", default=".", help="工作流所在目录")
+    p_update.add_argument("--processes", type=int, default=None, help="并行解析的进程数（默认 CPU 核数）")
+
+    p_query = sub.add_parser("query", help="查询工作流，每行输出一个路径")
+    p_query.add_argument("--root", default=None, help="只查询该目录下的工作流")
+    p_query.add_argument("--class-type", default=None, help="包含该类型的节点，例如 'AIO_Preprocessor'，支持通配符")
+    p_query.add_argument("--node", default=None, help="包含该节点ID")
+    p_query.add_argument("--model", default=None, help="用到该模型，例如 'sd_xl*'，支持通配符")
+    p_query.add_argument("--kind", default=None, help="模型输入名，例如 ckpt_name / lora_name / preprocessor")
+    group = p_query.add_mutually_exclusive_group()
+    group.add_argument("--image-to-image", action="store_true", help="只返回图生图工作流")
+    group.add_argument("--text-to-image", action="store_true", help="只返回文生图工作流")
+    p_query.add_argument("--count", action="store_true", help="只输出数量")
+    args = parser.parse_args()
+
+    index = WorkflowIndex(args.db)
+    if args.command == "update":
+        index.update(args.root, args.processes)
+    else:
+        start = time.time()
+        image_input = True if args.image_to_image else False if args.text_to_image else None
+        paths = index.query(args.root, args.class_type, args.node, args.model, args.kind, image_input)
+        elapsed = (time.time() - start) * 1000
+        if not args.count:
+            for path in paths:
+                print(path)
+        print(f"🔎 共 {len(paths)} 个工作流，查询耗时 {elapsed:.1f} ms")
+    index.close()
@@ -0,0 +1,213 @@
+import re
+import json
+import fnmatch
+
+import json_codec
+
+try:
+    import ijson  # 可选依赖；安装后边读文件边解析，没有安装时整体解析（有 orjson 时）或用 raw_decode 逐个节点解析
+except ImportError:
+    ijson = None
+
+# 工作流 JSON 的通用匹配器：
+# 1. 声明式查询：任意节点的 节点ID / class_type / 输入 满足条件，键名不区分大小写，值支持 * ? 通配符
+# 2. 解析前先在原始字节中查找查询里的关键字，不包含的文件直接跳过（大部分文件在这一步就被排除）
+# 3. 需要解析时逐个节点解析，找到匹配后立即停止，不会把整个大文件一次性变成 Python 对象
+
+# 在 JSON 文本中一定原样出现的字符（不会被转义），只用这些字符组成的片段做字节预筛选
+SAFE_NEEDLE = re.compile(r"[A-Za-z0-9 _.\-]{3,}")
+PREFILTER_CHUNK = 1 << 20
+
+class NodeQuery:
+    '''
+    对单个节点的查询条件，全部条件都满足时匹配
+
+    参数:
+        node_id: 节点ID（例如 "196"），None 表示任意节点
+        class_type: 节点类型，不区分大小写，支持通配符；也会匹配界面格式工作流中的 "type"
+        inputs: 输入名 -> 期望值，输入名不区分大小写；字符串值不区分大小写并支持通配符，
+                数字等其他值按字符串比较
+    '''
+    def __init__(self, node_id=None, class_type=None, **inputs):
+        self.node_id = None if node_id is None else str(node_id)
+        self.class_type = class_type.lower() if class_type else None
+        self.inputs = {k.lower(): str(v).lower() for k, v in inputs.items()}
+
+    @classmethod
+    def parse(cls, spec):
+        '''
+        从文本解析查询，例如 "node=196 preprocessor=zoe-depthmappreprocessor" 或 "class_type=*Preprocessor"
+        node 和 class_type 是特殊的键，其余的键都是输入名
+        '''
+        kwargs = {}
+        for token in spec.split():
+            key, sep, value = token.partition("=")
+            if not sep:
+                raise ValueError(f"查询条件格式应为 键=值: {token}")
+            kwargs["node_id" if key.lower() == "node" else key] = value
+        node_id = kwargs.pop("node_id", None)
+        class_type = kwargs.pop("class_type", None)
+        return cls(node_id, class_type, **kwargs)
+
+    def __repr__(self):
+        parts = [f"node={self.node_id}"] if self.node_id else []
+        parts += [f"class_type={self.class_type}"] if self.class_type else []
+        parts += [f"{k}={v}" for k, v in self.inputs.items()]
+        return f"NodeQuery({' '.join(parts)})"
+
+    def needles(self):
+        '''
+        匹配的文件中一定出现的字节片段（小写），用于解析前的预筛选
+        '''
+        needles = set()
+        # 节点ID 在界面格式中是数字，不带引号，所以和其他文本一样只取片段本身
+        texts = [self.node_id or "", self.class_type or ""] + list(self.inputs) + list(self.inputs.values())
+        for text in texts:
+            # 通配符和可能被转义的字符把文本切成片段，取最长的安全片段
+            pieces = SAFE_NEEDLE.findall(text)
+            if pieces:
+                needles.add(max(pieces, key=len).lower().encode())
+        return needles
+
+    def matches(self, node_id, node):
+        if self.node_id is not None and str(node_id) != self.node_id:
+            return False
+        if not isinstance(node, dict):
+            return False
+        # 节点的键名（inputs / class_type / type）与输入名一样不区分大小写
+        node = {k.lower() if isinstance(k, str) else k: v for k, v in node.items()}
+        if self.class_type is not None:
+            class_type = node.get("class_type", node.get("type"))
+            if not isinstance(class_type, str) or not fnmatch.fnmatchcase(class_type.lower(), self.class_type):
+                return False
+        if self.inputs:
+            inputs = node.get("inputs")
+            if not isinstance(inputs, dict):
+                return False
+            lowered = {k.lower() if isinstance(k, str) else k: v for k, v in inputs.items()}
+            for key, pattern in self.inputs.items():
+                value = lowered.get(key)
+                if value is None or isinstance(value, (list, dict)):
+                    return False
+                if not fnmatch.fnmatchcase(str(value).lower(), pattern):
+                    return False
+        return True
+
+def find_needles(path, needles, chunk_size=PREFILTER_CHUNK):
+    '''
+    分块读取文件，返回其中出现过的字节片段集合（不区分大小写），全部找到后立即停止读取
+    '''
+    remaining = set(needles)
+    if not remaining:
+        return set()
+    overlap = max(len(n) for n in remaining) - 1
+    tail = b""
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            window = tail + chunk.lower()
+            remaining = {n for n in remaining if n not in window}
+            if not remaining:
+                break
+            tail = window[-overlap:] if overlap > 0 else b""
+    return set(needles) - remaining
+
+def iter_nodes_ijson(path):
+    '''
+    用 ijson 边读边解析，依次返回顶层的 (键, 值)
+    '''
+    with open(path, "rb") as f:
+        yield from ijson.kvitems(f, "")
+
+def iter_nodes_full(path):
+    '''
+    整体解析后依次返回顶层的 (键, 值)：有 orjson 时整体解析比 raw_decode 逐个节点解析快得多
+    '''
+    workflow = json_codec.load(path)
+    if not isinstance(workflow, dict):
+        raise ValueError("顶层不是 JSON 对象")
+    yield from workflow.items()
+
+def iter_nodes_raw(path):
+    '''
+    不依赖第三方库的逐个节点解析：用 raw_decode 依次解析顶层对象的每个值
+    文本仍需读入内存，但同一时刻只有一个节点被转换成 Python 对象，找到匹配后剩余部分不再解析
+    '''
+    with open(path, "r", encoding="utf-8") as f:
+        text = f.read()
+    decoder = json.JSONDecoder()
+    ws = re.compile(r"\s*")
+    pos = ws.match(text, 0).end()
+    if text[pos:pos + 1] != "{":
+        raise ValueError("顶层不是 JSON 对象")
+    pos = ws.match(text, pos + 1).end()
+    if text[pos:pos + 1] == "}":
+        return
+    while True:
+        key, pos = decoder.raw_decode(text, pos)
+        pos = ws.match(text, pos).end()
+        if text[pos:pos + 1] != ":":
+            raise ValueError(f"位置 {pos} 处缺少 ':'")
+        value, pos = decoder.raw_decode(text, ws.match(text, pos + 1).end())
+        yield key, value
+        pos = ws.match(text, pos).end()
+        if text[pos:pos + 1] == ",":
+            pos = ws.match(text, pos + 1).end()
+        elif text[pos:pos + 1] == "}":
+            return
+        else:
+            raise ValueError(f"位置 {pos} 处缺少 ',' 或 '}}'")
+
+def iter_workflow_nodes(path):
+    '''
+    依次返回工作流中的 (节点ID, 节点)
+    API 格式的顶层键就是节点ID；界面格式（顶层有 "nodes" 列表）时逐个返回列表中的节点
+    '''
+    if ijson is not None:
+        items = iter_nodes_ijson(path)
+    elif json_codec.backend == "orjson":
+        items = iter_nodes_full(path)
+    else:
+        items = iter_nodes_raw(path)
+    for key, value in items:
+        if key == "nodes" and isinstance(value, list):
+            for node in value:
+                if isinstance(node, dict):
+                    yield str(node.get("id", "")), node
+        else:
+            yield key, value
+
+class WorkflowMatcher:
+    '''
+    任意一个查询匹配到任意一个节点时，文件匹配
+    实例可以直接交给 json_scanner.scan 作为 worker（在子进程中执行）
+
+    调用返回:
+        tuple: (文件路径, 匹配的节点ID列表, 状态)；状态为 "prefiltered"（预筛选排除）/ "parsed" / 错误信息
+    '''
+    def __init__(self, queries, prefilter=True, first_only=True):
+        self.queries = list(queries)
+        self.prefilter = prefilter
+        self.first_only = first_only
+        self._needles = [q.needles() for q in self.queries]
+        self._all_needles = set().union(*self._needles)
+
+    def __call__(self, path):
+        try:
+            queries = self.queries
+            if self.prefilter:
+                # 只保留关键字全部出现的查询，一个都不剩时不用解析
+                found = find_needles(path, self._all_needles)
+                queries = [q for q, needles in zip(self.queries, self._needles) if needles <= found]
+                if not queries:
+                    return path, [], "prefiltered"
+            matched = []
+            for node_id, node in iter_workflow_nodes(path):
+                if any(q.matches(node_id, node) for q in queries):
+                    matched.append(node_id)
+                    if self.first_only:
+                        break
+            return path, matched, "parsed"
+        except (ValueError, OSError, UnicodeDecodeError) as e:
+            return path, [], str(e) or type(e).__name__
+        except Exception as e:  # ijson 的解析错误
+            return path, [], f"{type(e).__name__}: {e}"
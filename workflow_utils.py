@@ -0,0 +1,63 @@
+# 工作流字典的纯函数工具：只检查已经解析好的工作流，不访问网络和文件，
+# png2png、workflow_index 等脚本共用，导入时不会拉入 requests 等依赖
+
+# 加载模型的节点输入名 -> 估计的加载代价（相对值），排序时先按代价大的模型分组
+# ComfyUI 只缓存上一个任务的节点结果，相邻两个工作流的模型不同时加载节点会重新执行
+MODEL_INPUT_WEIGHTS = {
+    "ckpt_name": 10,
+    "unet_name": 10,
+    "model_name": 5,
+    "clip_name": 3,
+    "clip_name1": 3,
+    "clip_name2": 3,
+    "control_net_name": 3,
+    "vae_name": 2,
+    "preprocessor": 2,
+    "ipadapter_file": 2,
+    "lora_name": 1,
+}
+
+def find_image_input_node(workflow):
+    """
+    查找工作流中的图片输入节点
+
+    返回:
+        str: 节点ID（如果找到）
+        None: 如果没有找到（表示这是文生图工作流）
+    """
+    for node_id, node in workflow.items():
+        if isinstance(node, dict) and ("class_type" in node or "type" in node):
+            if "LoadImageFromUrlOrPath" in node.get("class_type", "") or "LoadImage" in node.get("class_type", ""):
+                return node_id
+    return None  # 没有找到图片输入节点
+
+def workflow_nodes(workflow):
+    '''
+    依次返回工作流中的 (节点ID, 节点)，与 workflow_matcher.iter_workflow_nodes 的规则相同：
+    界面格式（顶层有 "nodes" 列表）时返回列表中的节点
+    '''
+    for key, value in workflow.items():
+        if key == "nodes" and isinstance(value, list):
+            for node in value:
+                if isinstance(node, dict):
+                    yield str(node.get("id", "")), node
+        elif isinstance(value, dict):
+            yield str(key), value
+
+def workflow_model_refs(workflow):
+    '''
+    返回工作流用到的模型集合 {(输入名小写, 模型名), ...}
+    节点的键名和输入名都不区分大小写；值为连线、空字符串或 "None" 的输入不算
+    '''
+    refs = set()
+    for node in workflow.values():
+        if not isinstance(node, dict):
+            continue
+        inputs = next((v for k, v in node.items() if isinstance(k, str) and k.lower() == "inputs"), None)
+        if not isinstance(inputs, dict):
+            continue
+        for key, value in inputs.items():
+            key = key.lower()
+            if key in MODEL_INPUT_WEIGHTS and isinstance(value, str) and value and value.lower() != "none":
+                refs.add((key, value))
+    return frozenset(refs)
@@ -1,39 +1,81 @@
 import os
-import json
 import shutil
+import argparse
 
-def find_and_copy_zoe_json(base_dir):
-    target_dir = os.path.join(base_dir, "zoe-related")
-    os.makedirs(target_dir, exist_ok=True) # 创建zoe-related文件夹
+import run_profiler
+from json_scanner import scan, parallel_map, ScanStats
+from workflow_matcher import NodeQuery, WorkflowMatcher
 
-    for root, _, files in os.walk(base_dir): # 遍历当前文件夹
-        for filename in files:
-            if filename.lower().endswith(".json"): # 找到所有json工作流文件
-                file_path = os.path.join(root, filename) # 合成绝对路径
+# 默认查询：节点 196 的 preprocessor 输入为 zoe 深度预处理器（键名、值都不区分大小写）
+ZOE_QUERY = "node=196 preprocessor=zoe-depthmappreprocessor"
 
+def index_candidates(index_db, base_dir, queries, skip_dir, processes=None):
+    '''
+    增量更新索引后，用索引筛选出可能匹配的工作流（仍需匹配器确认）
+    '''
+    from workflow_index import WorkflowIndex
+    index = WorkflowIndex(index_db)
+    try:
+        index.update(base_dir, processes)
+        candidates = set()
+        for query in queries:
+            candidates.update(index.candidates(query, root=base_dir))
+    finally:
+        index.close()
+    skip_prefix = os.path.abspath(skip_dir) + os.sep
+    return sorted(p for p in candidates if not p.startswith(skip_prefix))
+
+def find_and_copy_zoe_json(base_dir, processes=None, queries=(ZOE_QUERY,), target_name="zoe-related", index_db=None):
+    '''
+    查找匹配任意一个查询的工作流并复制到 target_name 文件夹
+
+    参数:
+        queries: 查询条件文本，格式见 NodeQuery.parse
+        index_db: workflow_index 的索引数据库，给出时只匹配索引筛选出的候选文件，不再遍历目录
+    '''
+    target_dir = os.path.join(base_dir, target_name)
+    os.makedirs(target_dir, exist_ok=True) # 创建输出文件夹
+
+    matcher = WorkflowMatcher([NodeQuery.parse(q) for q in queries])
+    print(f"🔎 查询条件: {matcher.queries}")
+
+    # 遍历当前文件夹（跳过输出目录），多个进程并行匹配，匹配结果一出来就复制
+    stats = ScanStats()
+    prefiltered = 0
+    if index_db:
+        with run_profiler.stage("索引筛选"):
+            candidates = index_candidates(index_db, base_dir, matcher.queries, target_dir, processes)
+        print(f"🗃️  索引筛选出 {len(candidates)} 个候选文件")
+        stats = ScanStats()  # 只统计匹配阶段
+        results = parallel_map(matcher, candidates, processes, stats=stats)
+    else:
+        results = scan(base_dir, matcher, skip_dirs=[target_dir],
+                       include_hidden=True, processes=processes, stats=stats)
+    with run_profiler.stage("扫描匹配与复制"):
+        for file_path, matched, status in results:
+            if status == "prefiltered":
+                prefiltered += 1
+            elif status != "parsed":
+                print(f"⚠️ 跳过文件 {file_path}，错误: {status}")
+            elif matched:
                 try:
-                    with open(file_path, "r", encoding="utf-8") as f:
-                        data = json.load(f) # 加载读取json文件
-
-                    # 转换为不区分大小写的键名访问
-                    def get_case_insensitive(d, key): # 参数1:json文件，参数2:要访问的键
-                        for k in d:
-                            if k.lower() == key.lower(): # 转换为小写进行搜索
-                                return d[k]
-                        return None
-
-                    section_196 = get_case_insensitive(data, "196") # 查找键值196
-                    if isinstance(section_196, dict):  # 三部查询，直到找到preprocessor
-                        inputs = get_case_insensitive(section_196, "inputs")
-                        if isinstance(inputs, dict):
-                            preprocessor = get_case_insensitive(inputs, "preprocessor")
-                            if isinstance(preprocessor, str) and preprocessor.lower() == "zoe-depthmappreprocessor".lower():
-                                shutil.copy2(file_path, target_dir)
-                                print(f"✅ 发现并复制: {file_path}")
-                except (json.JSONDecodeError, OSError) as e: # 异常抛出
+                    shutil.copy2(file_path, target_dir)
+                    print(f"✅ 发现并复制: {file_path}（节点 {', '.join(matched)}）")
+                except OSError as e:
                     print(f"⚠️ 跳过文件 {file_path}，错误: {e}")
 
-    print("\n🎯 处理完成，所有匹配文件已复制到 'zoe-related' 文件夹。")
+    print(f"\n📊 {stats.summary()}，其中 {prefiltered} 个文件在预筛选中排除，无需解析")
+    print(f"\n🎯 处理完成，所有匹配文件已复制到 '{target_name}' 文件夹。")
 
 if __name__ == "__main__":
-    find_and_copy_zoe_json(os.getcwd())
+    parser = argparse.ArgumentParser(description="查找并复制匹配查询条件的工作流（默认查找使用 zoe 深度预处理器的工作流）")
+    parser.add_argument("--processes", type=int, default=None, help="并行解析的进程数（默认 CPU 核数）")
+    parser.add_argument("--query", action="append", default=None,
+                        help="查询条件，例如 'class_type=*Preprocessor preprocessor=zoe*'，可重复指定（任意一个匹配即可）")
+    parser.add_argument("--target", default="zoe-related", help="匹配文件的复制目标文件夹")
+    parser.add_argument("--from-index", default=None, metavar="DB",
+                        help="使用 workflow_index 的索引数据库筛选候选文件（先增量更新索引）")
+    run_profiler.add_arguments(parser, "zoe-related_profile.txt")
+    args = parser.parse_args()
+    run_profiler.start_from_args(args)
+    find_and_copy_zoe_json(os.getcwd(), args.processes, args.query or [ZOE_QUERY], args.target, args.from_index)